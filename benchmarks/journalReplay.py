@@ -0,0 +1,336 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+"""Replay of a recorded event journal against stand-in endpoints.
+
+    Feeds a journal recorded by the agent ("journal" in the configuration)
+    back into OLTDevice/ONOSAdaptor at 1x to 100x the recorded speed:
+
+      - Every recorded OLT is served by a stand-in openolt gRPC server. Its
+        EnableIndication stream sends the recorded ONU discoveries, ONU
+        indications and flow statistics, the OMCI requests are answered
+        with the recorded responses (same ONU, message type and entity) and
+        the other RPCs are acknowledged and counted.
+      - A stand-in controller accepts the OpenFlow connection of each OLT,
+        sends the recorded controller messages and discards the replies.
+
+    The FLOW items of the journal are not injected, the FLOW_MODs of the
+    replayed OpenFlow messages generate them again. At the end the queue
+    wait and handler time histograms (src.agentMetrics) are printed.
+
+    The agent runs in a temporary directory, so the subscribers.info of
+    the recording (--subscribers) keeps the ONU IDs of the journal.
+
+    Usage:
+        python -m benchmarks.journalReplay JOURNAL [--speed X] [--engine asyncio|thread]
+                                                  [--subscribers FILE] [--onu-workers N]
+"""
+
+import argparse
+import collections
+import logging
+import os
+import queue
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+from concurrent import futures
+
+import grpc
+from voltha_protos import openolt_pb2
+from voltha_protos import openolt_pb2_grpc
+
+import openFlowAgent
+from src.agentMetrics import registry
+from src.agentQueue import oltQueue, ONU_DISC, ONU_IND, FLOW_STATS
+from src.agentWorkers import AgentWorkers
+from src.eventJournal import read_journal, decode_item, decode_omci, ITEM, OF_FRAME, OMCI
+from src.ofEngine import OFChannelEngine
+from src.oltDevice import OLTDevice
+
+_omci_header = struct.Struct("!HBBHH") # tci, message type, device id, entity class, entity id
+
+# RPCs of the stand-in OLT that are only acknowledged
+ACK_RPCS = ("ActivateOnu", "FlowAdd", "FlowRemove", "PerformGroupOperation", "DeleteGroup",
+            "CreateTrafficSchedulers", "RemoveTrafficSchedulers",
+            "CreateTrafficQueues", "RemoveTrafficQueues")
+
+def omci_key(intf_id, onu_id, frame):
+    """Key matching an OMCI request with its recorded response"""
+
+    tci, message_type, device_id, entity_class, entity_id = _omci_header.unpack_from(frame, 0)
+    return (intf_id, onu_id, message_type & 0x1f, entity_class, entity_id)
+
+def item_indication(item):
+    """openolt Indication of a recorded OLT queue item"""
+
+    data = item.data
+    if item.kind == ONU_DISC:
+        serial_number = openolt_pb2.SerialNumber(vendor_id = data.vendor_id, vendor_specific = data.vendor_specific)
+        return openolt_pb2.Indication(onu_disc_ind = openolt_pb2.OnuDiscIndication(intf_id = data.intf_id,
+                                                                                    serial_number = serial_number))
+    elif item.kind == ONU_IND:
+        return openolt_pb2.Indication(onu_ind = openolt_pb2.OnuIndication(intf_id = data.intf_id, onu_id = data.onu_id,
+                                                                          oper_state = data.oper_state,
+                                                                          admin_state = data.admin_state,
+                                                                          fail_reason = data.fail_reason))
+    elif item.kind == FLOW_STATS:
+        return openolt_pb2.Indication(flow_stats = openolt_pb2.FlowStats(flow_id = data.flow_id,
+                                                                         rx_bytes = data.rx_bytes,
+                                                                         rx_packets = data.rx_packets,
+                                                                         tx_bytes = data.tx_bytes,
+                                                                         tx_packets = data.tx_packets,
+                                                                         timestamp = data.timestamp))
+    return None
+
+class StandInOLT(openolt_pb2_grpc.OpenoltServicer):
+    """openolt gRPC server answering with the recorded OLT behaviour"""
+
+    def __init__(self, datapath_id, omciResponses):
+        """Initialize variables:
+                datapath_id (string): recorded datapath ID ("00:00:" + device_id)
+                omciResponses (dict): omci_key -> deque(recorded OMCI frames)
+        """
+
+        self.device_id = datapath_id[len("00:00:"):]
+        self.omciResponses = omciResponses
+        self.indications = queue.Queue()
+        self.calls = collections.Counter()
+
+    def GetDeviceInfo(self, request, context):
+        self.calls["GetDeviceInfo"] += 1
+        return openolt_pb2.DeviceInfo(vendor = "replay", model = "stand-in", device_id = self.device_id,
+                                      device_serial_number = self.device_id, pon_ports = 16,
+                                      onu_id_start = 1, onu_id_end = 127,
+                                      alloc_id_start = 1024, alloc_id_end = 16383,
+                                      gemport_id_start = 1024, gemport_id_end = 65535,
+                                      flow_id_start = 1, flow_id_end = 16383)
+
+    def EnableIndication(self, request, context):
+        self.calls["EnableIndication"] += 1
+        while context.is_active():
+            try:
+                yield self.indications.get(timeout = 1)
+            except queue.Empty:
+                continue
+
+    def OmciMsgOut(self, request, context):
+        self.calls["OmciMsgOut"] += 1
+
+        frame = bytes.fromhex(request.pkt.decode("utf-8"))
+        responses = self.omciResponses.get(omci_key(request.intf_id, request.onu_id, frame))
+        if not responses:
+            self.calls["OmciMsgOut unanswered"] += 1
+            return openolt_pb2.Empty()
+
+        # The last response is kept for the retries of the same request
+        response = responses.popleft() if len(responses) > 1 else responses[0]
+        pkt = frame[0:2] + response[2:] # Transaction ID of the request
+        self.indications.put(openolt_pb2.Indication(omci_ind = openolt_pb2.OmciIndication(intf_id = request.intf_id,
+                                                                                         onu_id = request.onu_id,
+                                                                                         pkt = pkt)))
+        return openolt_pb2.Empty()
+
+def _ack_rpc(name):
+    def rpc(self, request, context):
+        self.calls[name] += 1
+        return openolt_pb2.Empty()
+    return rpc
+
+for _name in ACK_RPCS:
+    setattr(StandInOLT, _name, _ack_rpc(_name))
+
+class StandInController:
+    """TCP server taking the OpenFlow connections of the OLTs"""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.received = 0 # Bytes sent by the agent
+
+    def accept(self, timeout):
+        self.sock.settimeout(timeout)
+        conn, addr = self.sock.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target = self._discard, args = (conn,), daemon = True).start()
+        return conn
+
+    def _discard(self, conn):
+        try:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                self.received += len(data)
+        except OSError:
+            pass
+
+def load_journal(path):
+    """Get the datapaths (in order of appearance), the timed events to
+        replay as list((seconds, datapath_id, type, payload)) and the
+        recorded OMCI responses of each datapath.
+    """
+
+    datapaths = []
+    events = []
+    omciResponses = collections.defaultdict(lambda: collections.defaultdict(collections.deque))
+
+    for record_type, timestamp, datapath_id, payload in read_journal(path):
+        if datapath_id not in datapaths:
+            datapaths.append(datapath_id)
+
+        if record_type == OMCI:
+            intf_id, onu_id, frame = decode_omci(payload)
+            omciResponses[datapath_id][omci_key(intf_id, onu_id, frame)].append(frame)
+        elif record_type == OF_FRAME:
+            events.append((timestamp, datapath_id, OF_FRAME, payload))
+        elif record_type == ITEM:
+            item = decode_item(datapath_id, payload)
+            if item.source == "olt":
+                events.append((timestamp, datapath_id, ITEM, item_indication(item)))
+
+    return datapaths, events, omciResponses
+
+def start_olt(datapath_id, responses, controller, engine, onu_workers, timeout):
+    """Start the stand-in OLT of a datapath and connect an OLTDevice to it
+        and to the stand-in controller.
+    """
+
+    standIn = StandInOLT(datapath_id, responses)
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers = 16))
+    openolt_pb2_grpc.add_OpenoltServicer_to_server(standIn, server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+
+    device = OLTDevice(ip_address = "127.0.0.1", port = port, onu_workers = onu_workers)
+    if device.generate() != datapath_id:
+        raise RuntimeError("Stand-in OLT of %s not reachable" % datapath_id)
+
+    openFlowAgent.deviceList[datapath_id] = device
+    device.enable_olt()
+    device.enable_controller(ipONOS = "127.0.0.1", portONOS = controller.port, engine = engine)
+    conn = controller.accept(timeout)
+
+    return standIn, server, conn
+
+def replay(events, standIns, connections, speed):
+    """Deliver the events at their recorded time divided by speed"""
+
+    if not events:
+        return 0.0
+
+    t0 = events[0][0]
+    start = time.perf_counter()
+    late = 0.0
+
+    for timestamp, datapath_id, record_type, payload in events:
+        delay = start + (timestamp - t0) / speed - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            late = max(late, -delay)
+
+        if record_type == OF_FRAME:
+            connections[datapath_id].sendall(payload)
+        elif payload is not None:
+            standIns[datapath_id].indications.put(payload)
+
+    return late
+
+def wait_drained(timeout):
+    """Wait until the OLT queues and the ONU executors are empty"""
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if oltQueue.qsize() == 0 and all(device.executor.pending() == 0
+                                         for device in openFlowAgent.deviceList.values()):
+            return True
+        time.sleep(0.05)
+
+    return False
+
+def main():
+    parser = argparse.ArgumentParser(description = "Event journal replay")
+    parser.add_argument("journal", help = "journal recorded by the agent")
+    parser.add_argument("--speed", type = float, default = 1.0, help = "replay speed, 1 to 100")
+    parser.add_argument("--engine", choices = ("asyncio", "thread"), default = "asyncio")
+    parser.add_argument("--subscribers", help = "subscribers.info of the recording")
+    parser.add_argument("--onu-workers", type = int, default = 8)
+    parser.add_argument("--drain-timeout", type = float, default = 60.0, help = "seconds to wait for the queues")
+    parser.add_argument("--log-level", default = "WARNING")
+    args = parser.parse_args()
+
+    if not 1 <= args.speed <= 100:
+        parser.error("--speed must be between 1 and 100")
+
+    logging.getLogger().setLevel(args.log_level)
+
+    journal = os.path.abspath(args.journal)
+    datapaths, events, omciResponses = load_journal(journal)
+    duration = (events[-1][0] - events[0][0]) if events else 0.0
+    print(f"Journal: {len(datapaths)} OLTs, {len(events)} events, {duration:.1f} s recorded")
+
+    # The subscribers.info written by the agent is kept out of the working directory
+    workdir = tempfile.mkdtemp(prefix = "agent-replay-")
+    if args.subscribers:
+        shutil.copy(args.subscribers, os.path.join(workdir, "subscribers.info"))
+    os.chdir(workdir)
+
+    engine = None
+    if args.engine == "asyncio":
+        engine = OFChannelEngine()
+        engine.start()
+
+    controller = StandInController()
+    standIns, servers, connections = {}, [], {}
+    for datapath_id in datapaths:
+        standIns[datapath_id], server, connections[datapath_id] = start_olt(datapath_id, omciResponses[datapath_id],
+                                                                            controller, engine, args.onu_workers,
+                                                                            timeout = 10)
+        servers.append(server)
+
+    workers = AgentWorkers(oltQueue, openFlowAgent.dispatch_item)
+    workers.start()
+
+    start = time.perf_counter()
+    late = replay(events, standIns, connections, args.speed)
+    fed = time.perf_counter() - start
+    drained = wait_drained(args.drain_timeout)
+    elapsed = time.perf_counter() - start
+
+    print(f"Replay at {args.speed:g}x: fed in {fed:.2f} s (max lag {late * 1e3:.1f} ms), "
+          f"handled in {elapsed:.2f} s{'' if drained else ' (queues NOT drained)'}")
+    for datapath_id, standIn in standIns.items():
+        print(f"  {datapath_id}: " + ", ".join(f"{name} {count}" for name, count in sorted(standIn.calls.items())))
+    print(f"  controller: {controller.received} bytes received")
+
+    for name in ("queue_wait", "handler_time"):
+        for labels, stats in sorted(registry.snapshot().get(name, {}).items()):
+            print(f"  {name} {'/'.join(labels)}: {stats['count']} | mean {stats['mean'] * 1e3:.2f} ms, "
+                  f"p50 {stats['p50'] * 1e3:.2f} ms, p99 {stats['p99'] * 1e3:.2f} ms, max {stats['max'] * 1e3:.2f} ms")
+
+    workers.stop()
+    for server in servers:
+        server.stop(grace = None)
+    shutil.rmtree(workdir, ignore_errors = True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+"""Throughput benchmark of the OpenFlow receive buffer.
+
+    Replays an OpenFlow session split in random TCP segments through
+    OFReceiveBuffer and checks that every message is rebuilt. The session is
+    read from a capture file (raw controller to agent TCP payload) or, when no
+    file is given, generated with the usual ONOS messages.
+
+    Usage:
+        python -m benchmarks.ofBuffer_bench [--capture FILE] [--messages N]
+                                            [--max-segment BYTES] [--seed N]
+"""
+
+import argparse
+import random
+import socket
+import struct
+import threading
+import time
+
+from pyof.v0x04.common.action import ActionOutput, ActionPush, ActionSetField, ListOfActions
+from pyof.v0x04.common.flow_instructions import (InstructionApplyAction, InstructionGotoTable,
+                                                 InstructionMeter, ListOfInstruction)
+from pyof.v0x04.common.flow_match import Match, OxmOfbMatchField, OxmTLV, VlanId
+from pyof.v0x04.controller2switch.barrier_request import BarrierRequest
+from pyof.v0x04.controller2switch.flow_mod import FlowMod, FlowModCommand
+from pyof.v0x04.controller2switch.multipart_request import MultipartRequest, MultipartType
+from pyof.v0x04.symmetric.echo_request import EchoRequest
+
+from src.ofBuffer import OFReceiveBuffer
+
+def flow_mod_template(rnd):
+    """FLOW_MOD as sent by ONOS for a subscriber: in_port + VLAN match,
+        VLAN push/set, meter and goto table.
+    """
+
+    vlan = rnd.randint(1, 4094) | VlanId.OFPVID_PRESENT.value
+    match = Match(oxm_match_fields=[
+        OxmTLV(oxm_field=OxmOfbMatchField.OFPXMT_OFB_IN_PORT,
+               oxm_value=rnd.randint(1, 0x7fffffff).to_bytes(4, 'big')),
+        OxmTLV(oxm_field=OxmOfbMatchField.OFPXMT_OFB_VLAN_VID,
+               oxm_value=vlan.to_bytes(2, 'big'))])
+    actions = ListOfActions([
+        ActionPush(action_type=0x11, ethertype=0x8100),
+        ActionSetField(field=OxmTLV(oxm_field=OxmOfbMatchField.OFPXMT_OFB_VLAN_VID,
+                                    oxm_value=vlan.to_bytes(2, 'big'))),
+        ActionOutput(port=0x14)])
+    instructions = ListOfInstruction([InstructionApplyAction(actions=actions),
+                                      InstructionMeter(meter_id=rnd.randint(1, 100)),
+                                      InstructionGotoTable(table_id=1)])
+
+    return FlowMod(xid=0, cookie=rnd.getrandbits(64), cookie_mask=0, table_id=0,
+                   command=FlowModCommand.OFPFC_ADD, idle_timeout=0, hard_timeout=0,
+                   priority=rnd.randint(0, 65535), buffer_id=0xffffffff,
+                   out_port=0xffffffff, out_group=0xffffffff, flags=0,
+                   match=match, instructions=instructions).pack()
+
+def generate_session(n_messages, seed):
+    """Generate a controller session: mostly FLOW_MODs mixed with echoes,
+        barriers and multipart requests. The messages are taken from a pool
+        of packed templates and only the xid is rewritten, pyof packing is
+        too slow to build every message.
+    """
+
+    rnd = random.Random(seed)
+    flowMods = [flow_mod_template(rnd) for i in range(64)]
+    echo = EchoRequest(xid=0).pack()
+    barrier = BarrierRequest(xid=0).pack()
+    multipart = MultipartRequest(xid=0, multipart_type=MultipartType.OFPMP_PORT_DESC, flags=0).pack()
+
+    messages = []
+    for xid in range(n_messages):
+        choice = rnd.random()
+        if choice < 0.70:
+            message = bytearray(rnd.choice(flowMods))
+        elif choice < 0.80:
+            message = bytearray(echo)
+        elif choice < 0.90:
+            message = bytearray(barrier)
+        else:
+            message = bytearray(multipart)
+
+        struct.pack_into("!I", message, 4, xid)
+        messages.append(message)
+
+    return b''.join(messages), n_messages
+
+def segment(stream, max_segment, seed):
+    """Split the stream in random sized segments, as TCP may deliver it"""
+
+    rnd = random.Random(seed)
+    segments = []
+    offset = 0
+
+    while offset < len(stream):
+        size = rnd.randint(1, max_segment)
+        segments.append(stream[offset:offset + size])
+        offset += size
+
+    return segments
+
+def bench_feed(segments):
+    """Feed the segments straight into the buffer"""
+
+    rxBuffer = OFReceiveBuffer()
+    n_frames = n_bytes = 0
+
+    start = time.perf_counter()
+    for seg in segments:
+        rxBuffer.feed(seg)
+        for frame in rxBuffer.frames():
+            n_frames += 1
+            n_bytes += len(frame)
+    elapsed = time.perf_counter() - start
+
+    return n_frames, n_bytes, elapsed
+
+def bench_socket(segments):
+    """Send the segments through a local socket and read them with recv_into"""
+
+    rx, tx = socket.socketpair()
+    rxBuffer = OFReceiveBuffer()
+    n_frames = n_bytes = 0
+
+    def sender():
+        for seg in segments:
+            tx.sendall(seg)
+        tx.close()
+
+    th = threading.Thread(target = sender, daemon = True)
+
+    start = time.perf_counter()
+    th.start()
+    while rxBuffer.recv_from(rx) > 0:
+        for frame in rxBuffer.frames():
+            n_frames += 1
+            n_bytes += len(frame)
+    elapsed = time.perf_counter() - start
+
+    th.join()
+    rx.close()
+
+    return n_frames, n_bytes, elapsed
+
+def count_messages(stream):
+    """Count the OpenFlow messages of a captured stream"""
+
+    count = offset = 0
+    while offset + 8 <= len(stream):
+        length = int.from_bytes(stream[offset + 2:offset + 4], 'big')
+        if length < 8:
+            break
+        offset += length
+        count += 1
+
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description = "OFReceiveBuffer throughput benchmark")
+    parser.add_argument("--capture", help = "raw OpenFlow stream captured from the controller")
+    parser.add_argument("--messages", type = int, default = 100000, help = "generated session size")
+    parser.add_argument("--max-segment", type = int, default = 1500, help = "maximum TCP segment size")
+    parser.add_argument("--seed", type = int, default = 1)
+    args = parser.parse_args()
+
+    if args.capture:
+        with open(args.capture, "rb") as fp:
+            stream = fp.read()
+        n_messages = count_messages(stream)
+    else:
+        stream, n_messages = generate_session(args.messages, args.seed)
+
+    segments = segment(stream, args.max_segment, args.seed)
+
+    print(f"Session: {n_messages} messages, {len(stream)} bytes, {len(segments)} segments")
+
+    for name, bench in (("feed", bench_feed), ("recv_into", bench_socket)):
+        n_frames, n_bytes, elapsed = bench(segments)
+        status = "OK" if (n_frames == n_messages and n_bytes == len(stream)) else "LOST MESSAGES"
+        print(f"{name:>10}: {n_frames} frames in {elapsed:.3f} s | "
+              f"{n_frames / elapsed:,.0f} msg/s | {n_bytes / elapsed / 1e6:.1f} MB/s | {status}")
+
+if __name__ == '__main__':
+    main()
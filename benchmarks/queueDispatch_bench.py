@@ -0,0 +1,246 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+"""Per-event dispatch overhead of the agent queue items.
+
+    Compares the former queue items (dict-backed payloads selected by an
+    if/elif chain of class name comparisons) with the slotted items and
+    the handler table by kind. Each event is built, put on a ClassQueue,
+    taken and dispatched to a no-op device, as done by the OLT workers.
+
+    The paced run offers the events at a fixed rate (100k events/s by
+    default) and reports the share of the per-event budget used by the
+    queue and the dispatch.
+
+    Usage:
+        python -m benchmarks.queueDispatch_bench [--events N] [--rate EVENTS_S] [--seed N]
+"""
+
+import argparse
+import random
+import time
+
+from src.agentQueue import (ClassQueue, QueueItem, OnuDisc, OnuInd, FlowStatsInd, Flow,
+                            ONU_DISC, ONU_IND, FLOW_STATS, FLOW)
+
+class Device:
+    """OLTDevice stand-in, the handlers do nothing"""
+
+    def initialize_onu(self, intf_id, vendor_id, vendor_specific):
+        pass
+
+    def create_ports(self, intf_id, onu_id, oper_state, admin_state):
+        pass
+
+    def update_Flow_statistics(self, flow_id, rx_bytes, rx_packets, tx_bytes, tx_packets, timestamp):
+        pass
+
+    def configureFlows(self, flow_id, flow_action):
+        pass
+
+deviceList = {"00:00:0000000000000001": Device()}
+
+# Former queue items
+
+class LegacyOnuDisc:
+    def __init__(self, intf_id, vendor_id, vendor_specific):
+        self.intf_id = intf_id
+        self.vendor_id = vendor_id
+        self.vendor_specific = vendor_specific
+
+class LegacyOnuInd:
+    def __init__(self, intf_id, onu_id, oper_state, admin_state, fail_reason):
+        self.intf_id = intf_id
+        self.onu_id = onu_id
+        self.oper_state = oper_state
+        self.admin_state = admin_state
+        self.fail_reason = fail_reason
+
+class LegacyFlowStatsInd:
+    def __init__(self, flow_id, rx_bytes, rx_packets, tx_bytes, tx_packets, timestamp):
+        self.flow_id = flow_id
+        self.rx_bytes = rx_bytes
+        self.rx_packets = rx_packets
+        self.tx_bytes = tx_bytes
+        self.tx_packets = tx_packets
+        self.timestamp = timestamp
+
+class LegacyFlow:
+    def __init__(self, cookie, command):
+        self.flow_id = cookie
+        self.flow_action = command
+
+class LegacyQueueItem:
+    def __init__(self, datapath_id, source, data, kind):
+        self.datapath_id = datapath_id
+        self.source = source
+        self.data = data
+        self.kind = kind # Only used to select the ClassQueue class
+
+    def isClass(self, dataType):
+        return dataType == self.data.__class__.__name__
+
+def legacy_handle_item(item):
+    if (item.datapath_id not in deviceList):
+        return
+
+    if item.source == "olt":
+        if item.isClass("OnuDisc"):
+            deviceList[item.datapath_id].initialize_onu(item.data.intf_id, item.data.vendor_id, item.data.vendor_specific)
+        elif item.isClass("OnuInd"):
+            if (item.data.fail_reason == 0):
+                deviceList[item.datapath_id].create_ports(item.data.intf_id, item.data.onu_id, item.data.oper_state, item.data.admin_state)
+        elif item.isClass("FlowStatsInd"):
+            deviceList[item.datapath_id].update_Flow_statistics(item.data.flow_id,
+                                                                item.data.rx_bytes,
+                                                                item.data.rx_packets,
+                                                                item.data.tx_bytes,
+                                                                item.data.tx_packets,
+                                                                item.data.timestamp)
+    elif item.source == "onos":
+        if item.isClass("Flow"):
+            deviceList[item.datapath_id].configureFlows(item.data.flow_id, item.data.flow_action)
+
+# Current queue items, same handlers as openFlowAgent
+
+def handle_onu_disc(device, onuDisc):
+    device.initialize_onu(onuDisc.intf_id, onuDisc.vendor_id, onuDisc.vendor_specific)
+
+def handle_onu_ind(device, onuInd):
+    if (onuInd.fail_reason == 0):
+        device.create_ports(onuInd.intf_id, onuInd.onu_id, onuInd.oper_state, onuInd.admin_state)
+
+def handle_flow_stats(device, flowStats):
+    device.update_Flow_statistics(flowStats.flow_id, flowStats.rx_bytes, flowStats.rx_packets,
+                                  flowStats.tx_bytes, flowStats.tx_packets, flowStats.timestamp)
+
+def handle_flow(device, flow):
+    device.configureFlows(flow.flow_id, flow.flow_action)
+
+itemHandlers = {
+    ONU_DISC: handle_onu_disc,
+    ONU_IND: handle_onu_ind,
+    FLOW_STATS: handle_flow_stats,
+    FLOW: handle_flow,
+}
+
+def handle_item(item):
+    device = deviceList.get(item.datapath_id)
+    if device is None:
+        return
+
+    handler = itemHandlers.get(item.kind)
+    if handler is None:
+        return
+
+    handler(device, item.data)
+
+# Event generation
+
+def legacy_event(kind, i, datapath_id):
+    if kind == ONU_DISC:
+        return LegacyQueueItem(datapath_id, "olt", LegacyOnuDisc(0, b"GCOD", b"\x00\x00\x00\x01"), ONU_DISC)
+    elif kind == ONU_IND:
+        return LegacyQueueItem(datapath_id, "olt", LegacyOnuInd(0, i & 0x7f, 1, 1, 0), ONU_IND)
+    elif kind == FLOW_STATS:
+        return LegacyQueueItem(datapath_id, "olt", LegacyFlowStatsInd(i, 1500, 1, 1500, 1, i), FLOW_STATS)
+    return LegacyQueueItem(datapath_id, "onos", LegacyFlow(i, 0), FLOW)
+
+def event(kind, i, datapath_id):
+    if kind == ONU_DISC:
+        return QueueItem(datapath_id, "olt", OnuDisc(0, b"GCOD", b"\x00\x00\x00\x01"))
+    elif kind == ONU_IND:
+        return QueueItem(datapath_id, "olt", OnuInd(0, i & 0x7f, 1, 1, 0))
+    elif kind == FLOW_STATS:
+        return QueueItem(datapath_id, "olt", FlowStatsInd(i, 1500, 1, 1500, 1, i))
+    return QueueItem(datapath_id, "onos", Flow(i, 0))
+
+def event_kinds(n_events, seed):
+    """Kinds of the events: mostly statistics, as sent by a busy OLT"""
+
+    rnd = random.Random(seed)
+    return rnd.choices((ONU_DISC, ONU_IND, FLOW_STATS, FLOW), weights = (1, 4, 80, 15), k = n_events)
+
+def bench(kinds, make_event, handle):
+    """Build, queue, take and dispatch every event. Returns the seconds used."""
+
+    datapath_id = next(iter(deviceList))
+    agentQueue = ClassQueue()
+
+    start = time.perf_counter()
+    for i, kind in enumerate(kinds):
+        agentQueue.put(make_event(kind, i, datapath_id))
+        handle(agentQueue.get())
+    return time.perf_counter() - start
+
+def bench_dispatch(kinds, make_event, handle):
+    """Dispatch only, the events are built beforehand"""
+
+    datapath_id = next(iter(deviceList))
+    items = [make_event(kind, i, datapath_id) for i, kind in enumerate(kinds)]
+
+    start = time.perf_counter()
+    for item in items:
+        handle(item)
+    return time.perf_counter() - start
+
+def bench_paced(kinds, rate, make_event, handle):
+    """Offer the events at 'rate' events/s. Returns the busy seconds and
+        the total seconds of the run.
+    """
+
+    datapath_id = next(iter(deviceList))
+    agentQueue = ClassQueue()
+    period = 1.0 / rate
+    busy = 0.0
+
+    start = time.perf_counter()
+    deadline = start
+    for i, kind in enumerate(kinds):
+        deadline += period
+        t0 = time.perf_counter()
+        agentQueue.put(make_event(kind, i, datapath_id))
+        handle(agentQueue.get())
+        t1 = time.perf_counter()
+        busy += t1 - t0
+
+        while t1 < deadline:
+            t1 = time.perf_counter()
+    return busy, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description = "Queue item dispatch benchmark")
+    parser.add_argument("--events", type = int, default = 200000, help = "events per run")
+    parser.add_argument("--rate", type = int, default = 100000, help = "offered events/s of the paced run")
+    parser.add_argument("--seed", type = int, default = 1)
+    args = parser.parse_args()
+
+    kinds = event_kinds(args.events, args.seed)
+    budget = 1e9 / args.rate
+
+    print(f"Events: {args.events} | budget at {args.rate:,} events/s: {budget:.0f} ns/event")
+
+    for name, make_event, handle in (("legacy", legacy_event, legacy_handle_item),
+                                     ("slots+table", event, handle_item)):
+        dispatch = bench_dispatch(kinds, make_event, handle) / args.events * 1e9
+        total = bench(kinds, make_event, handle) / args.events * 1e9
+        busy, elapsed = bench_paced(kinds, args.rate, make_event, handle)
+        print(f"{name:>12}: dispatch {dispatch:6.0f} ns/event | build+queue+dispatch {total:6.0f} ns/event | "
+              f"paced {args.events / elapsed:,.0f} events/s, {busy / args.events * 1e9:.0f} ns/event, "
+              f"{100 * busy / elapsed:.1f} % busy")
+
+if __name__ == '__main__':
+    main()
@@ -15,12 +15,21 @@
 """
 
 import sys
+import os
 import json
 import logging
-import src.agentQueue
-from src.agentQueue import oltQueue
+import signal
+import threading
+import time
+import concurrent.futures
+from src.agentLoop import AgentLoop
+from src.agentMetrics import registry
+from src.agentQueue import oltQueue, ONU_DISC, ONU_IND, FLOW_STATS, FLOW, KIND_NAMES
+from src.agentWorkers import AgentWorkers
+from src.eventJournal import EventJournal
 from src.oltDevice import OLTDevice
 from src.onosAdaptor import ONOSAdaptor
+from src.ofEngine import OFChannelEngine
 
 deviceList = {}
 
@@ -31,84 +40,378 @@ logging.basicConfig(level=logging.DEBUG, format='%(asctime)s | %(levelname)s: %(
                         logging.StreamHandler(sys.stdout)
                     ])
 
-def main():
-    logging.info("Starting OpenFlow Agent...")
+def handle_onu_disc(device, onuDisc):
+    device.initialize_onu(onuDisc.intf_id, onuDisc.vendor_id, onuDisc.vendor_specific)
 
-    file_json = "openFlow_agent.config"
+def handle_onu_ind(device, onuInd):
+    if (onuInd.fail_reason == 0): # FAIL_REASON_NONE
+        device.create_ports(onuInd.intf_id, onuInd.onu_id, onuInd.oper_state, onuInd.admin_state)
+    else:
+        logging.error("ONU Indication error:")
+        if onuInd.fail_reason == 1: # RANGING_FAILURE
+            logging.error("****Activarion Fail Reason: RANGING")
+        elif onuInd.fail_reason == 2: # PASSWORD_AUTHENTICATION_FAILURE
+            logging.error("****Activarion Fail Reason: PASSWORD AUTHENTICATION")
+        elif onuInd.fail_reason == 3: # LOS_FAILURE
+            logging.error("****Activarion Fail Reason: LOS")
+        elif onuInd.fail_reason == 4: # ONU_ALARM_FAILURE
+            logging.error("****Activarion Fail Reason: ONU ALARM")
+        elif onuInd.fail_reason == 5: # SWITCH_OVER_FAILURE
+            logging.error("****Activarion Fail Reason: SWITCH OVER")
+
+def handle_flow_stats(device, flowStats):
+    device.update_Flow_statistics(flowStats.flow_id,
+                                  flowStats.rx_bytes,
+                                  flowStats.rx_packets,
+                                  flowStats.tx_bytes,
+                                  flowStats.tx_packets,
+                                  flowStats.timestamp)
+    logging.info("Received OLT Flow Stats indication")
+
+def handle_flow(device, flow):
+    device.configureFlows(flow.flow_id, flow.flow_action)
+
+# Handler of each queue item kind, called as handler(device, item.data)
+itemHandlers = {
+    ONU_DISC: handle_onu_disc,
+    ONU_IND: handle_onu_ind,
+    FLOW_STATS: handle_flow_stats,
+    FLOW: handle_flow,
+}
+
+def handle_item(item):
+    """Handle an OLT indication or a controller request taken from the queue"""
+
+    device = deviceList.get(item.datapath_id)
+    if device is None:
+        return
+
+    handler = itemHandlers.get(item.kind)
+    if handler is None:
+        logging.error("Queue item kind %d not found", item.kind)
+        return
+
+    # Time waited since the item was queued (OLT queue and ONU lane) and
+    # time spent by the handler
+    kind = KIND_NAMES[item.kind]
+    start = time.monotonic()
+    registry.observe("queue_wait", start - item.enqueued, item.datapath_id, kind)
+    try:
+        handler(device, item.data)
+    finally:
+        registry.observe("handler_time", time.monotonic() - start, item.datapath_id, kind)
+
+def dispatch_item(item):
+    """Run the item on the executor of its OLT: the items of the same ONU
+        are handled in order and the ones of different ONUs in parallel.
+    """
+
+    device = deviceList.get(item.datapath_id)
+    if device is None:
+        return None
+
+    return device.executor.submit(device.item_key(item), handle_item, item)
+
+def retry_delays(first = 1, maximum = 60):
+    """Seconds to wait between the attempts, doubled up to maximum"""
+
+    delay = first
+    while True:
+        yield delay
+        delay = min(2 * delay, maximum)
+
+class ManagedOLT:
+    """OLT of the configuration file. It is brought up by its own thread
+        and torn down when it is removed from the configuration, without
+        touching the other OLTs.
+    """
+
+    def __init__(self, olt, controller, engine, agentLoop = None):
+        """Initialize variables:
+                olt (dict): OLT entry of the configuration
+                controller (dict): SDN-controller entry of the configuration
+                engine (OFChannelEngine): engine of the OpenFlow channels, None for a thread per OLT
+                agentLoop (AgentLoop): event loop of the grpc.aio OLT channels, None for blocking channels
+        """
 
-    with open(file_json) as fp:
-        config = json.load(fp)
+        self.olt = olt
+        self.controller = controller
+        self.engine = engine
+        self.agentLoop = agentLoop
 
-        for olt in config["olts"]:
-            voip_start = olt["voip_extension_start"] if "voip_extension_start" in olt else 1111
-            voip_end = olt["voip_extension_end"] if "voip_extension_end" in olt else 9999
-            device = OLTDevice(ip_address = olt["ip_address"], port = olt["port"],
-                               voip_extensions_start = voip_start, voip_extensions_end = voip_end)
+        self.device = None
+        self.datapath_id = None
+        self.stop = threading.Event() # Set to stop retrying
+        self.thread = threading.Thread(target = self.bring_up, name = "bring-up-%s:%d" % (olt["ip_address"], olt["port"]),
+                                       daemon = True)
 
-            datapath_id = device.generate()
+    def start(self):
+        self.thread.start()
 
+    def bring_up(self):
+        """Connect the OLT and its OpenFlow channel. Each step has its own
+            deadline and is retried in the background until it succeeds, so
+            an unreachable OLT or controller does not delay the other OLTs.
+        """
+
+        olt = self.olt
+        controller = self.controller
+
+        voip_start = olt["voip_extension_start"] if "voip_extension_start" in olt else 1111
+        voip_end = olt["voip_extension_end"] if "voip_extension_end" in olt else 9999
+        device = OLTDevice(ip_address = olt["ip_address"], port = olt["port"],
+                           voip_extensions_start = voip_start, voip_extensions_end = voip_end,
+                           onu_workers = olt.get("onu_workers", 8), agentLoop = self.agentLoop,
+                           rpc = olt.get("rpc"))
+        # Closed by shutdown even if the OLT never answers
+        self.device = device
+
+        delays = retry_delays()
+        while True:
+            datapath_id = device.generate(timeout = olt.get("timeout", 5))
             if (datapath_id != ""):
-                logging.info("Registered OLT:")
-                logging.info("****IP address: %s", olt["ip_address"])
-                logging.info("****Port: %d", olt["port"])
-                logging.info("****Datapath ID: %s", datapath_id)
+                break
 
-                deviceList[datapath_id] = device
+            delay = next(delays)
+            logging.error("OLT %s:%d does not respond, retrying in %d s", olt["ip_address"], olt["port"], delay)
+            if self.stop.wait(delay):
+                return
 
-                device.enable_olt()
-                device.enable_controller(ipONOS = config["SDN-controller"]["ip_address"], portONOS = config["SDN-controller"]["port"])
-            else:
-                logging.error("OLT %s:%d does not respond", olt["ip_address"], olt["port"])
+        logging.info("Registered OLT:")
+        logging.info("****IP address: %s", olt["ip_address"])
+        logging.info("****Port: %d", olt["port"])
+        logging.info("****Datapath ID: %s", datapath_id)
 
-    if len(deviceList) == 0:
-        logging.error("OLTs not found")
-        return
+        self.datapath_id = datapath_id
+        deviceList[datapath_id] = device
+
+        delays = retry_delays()
+        while not self.stop.is_set():
+            try:
+                device.enable_controller(ipONOS = controller["ip_address"], portONOS = controller["port"],
+                                         engine = self.engine,
+                                         write_max_bytes = controller.get("write_max_bytes", 65536),
+                                         write_max_delay = controller.get("write_max_delay", 0.001),
+                                         timeout = controller.get("connect_timeout", 5))
+                break
+            except (OSError, TimeoutError, concurrent.futures.TimeoutError) as e:
+                delay = next(delays)
+                logging.error("OLT %s can not connect with the controller (%s), retrying in %d s",
+                              datapath_id, str(e) or e.__class__.__name__, delay)
+                if self.stop.wait(delay):
+                    return
+
+        # The OLT indications are handled once the controller can be notified
+        if not self.stop.is_set():
+            device.enable_olt()
+
+    def shutdown(self, workers):
+        """Stop the bring-up, disconnect the OLT and drop its queue"""
+
+        self.stop.set()
+        self.thread.join()
+
+        if self.device is None:
+            return
+
+        self.device.shutdown()
+        if self.datapath_id is None:
+            logging.info("Removed OLT %s:%d", self.olt["ip_address"], self.olt["port"])
+            return
+
+        deviceList.pop(self.datapath_id, None)
+        workers.remove_worker(self.datapath_id)
+        oltQueue.remove_partition(self.datapath_id)
+
+        logging.info("Removed OLT %s (%s:%d)", self.datapath_id, self.olt["ip_address"], self.olt["port"])
+
+# OLTs of the configuration: key(ip_address, port), value(ManagedOLT)
+managedOLTs = {}
+
+def apply_olts(olts, controller, engine, workers, agentLoop = None):
+    """Bring up the OLTs added to the configuration and tear down the removed
+        ones. An OLT whose entry has changed is brought up again, the others
+        keep running untouched.
+    """
+
+    wanted = {}
+    for olt in olts:
+        if not valid_olt(olt):
+            logging.error("Wrong OLT entry in the configuration, skipped: %s", olt)
+            continue
+        wanted[(olt["ip_address"], olt["port"])] = olt
+
+    for key, managed in list(managedOLTs.items()):
+        if wanted.get(key) != managed.olt:
+            logging.info("OLT %s:%d %s the configuration", key[0], key[1],
+                         "changed in" if key in wanted else "removed from")
+            managed.shutdown(workers)
+            del managedOLTs[key]
+
+    for key, olt in wanted.items():
+        if key not in managedOLTs:
+            managed = managedOLTs[key] = ManagedOLT(olt, controller, engine, agentLoop)
+            managed.start()
+
+def valid_olt(olt):
+    """Check the fields of an OLT entry needed to bring it up"""
+
+    return (isinstance(olt, dict) and isinstance(olt.get("ip_address"), str)
+            and isinstance(olt.get("port"), int) and not isinstance(olt.get("port"), bool))
+
+def load_config(file_json):
+    """Read the configuration file, None if it can not be read"""
+
+    try:
+        with open(file_json) as fp:
+            config = json.load(fp)
+    except (OSError, ValueError) as e:
+        logging.error("Configuration %s not loaded: %s", file_json, e)
+        return None
+
+    if not isinstance(config, dict):
+        logging.error("Configuration %s not loaded: not a JSON object", file_json)
+        return None
+
+    return config
+
+def config_mtime(file_json):
+    """Modification time of the configuration file, None if it can not be read"""
+
+    try:
+        return os.stat(file_json).st_mtime
+    except OSError as e:
+        logging.error("Configuration %s not found: %s", file_json, e)
+        return None
+
+def watch_config(file_json, config, engine, workers, agentLoop = None, reload = None):
+    """Reload the OLT list when the configuration file changes or on SIGHUP.
+        It blocks the calling thread (the main one, for the signal).
+
+    Args:
+            reload (threading.Event): set to force a reload, by default an
+                                      event set on SIGHUP
+    """
+
+    if reload is None:
+        reload = threading.Event()
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, lambda signum, frame: reload.set())
+
+    interval = config.get("config_watch_interval", 5) or None # None: only SIGHUP
+    controller = config["SDN-controller"] # Kept until the agent is restarted
+    mtime = config_mtime(file_json)
 
-    #Queue for OLT an ONOS actions
     while True:
-        try:
-            item = oltQueue.get(block = True, timeout = 3)
-        except src.agentQueue.queue.Empty:
+        reload.wait(interval)
+
+        # The file may be missing while it is replaced, the running
+        # configuration is kept until it can be read
+        newMtime = config_mtime(file_json)
+        if newMtime is None:
+            # A SIGHUP is not kept for later, it would wake the loop at once
+            reload.clear()
             continue
 
-        if (item.datapath_id not in deviceList):
+        if not (reload.is_set() or newMtime != mtime):
             continue
 
-        if item.source == "olt":
-            if item.isClass("OnuDisc"):
-                deviceList[item.datapath_id].initialize_onu(item.data.intf_id, item.data.vendor_id, item.data.vendor_specific)
-
-            elif item.isClass("OnuInd"):
-                if (item.data.fail_reason == 0): # FAIL_REASON_NONE
-                    deviceList[item.datapath_id].create_ports(item.data.intf_id, item.data.onu_id, item.data.oper_state, item.data.admin_state)
-                else:
-                    logging.error("ONU Indication error:")
-                    if item.data.fail_reason == 1: # RANGING_FAILURE
-                        logging.error("****Activarion Fail Reason: RANGING")
-                    elif item.data.fail_reason == 2: # PASSWORD_AUTHENTICATION_FAILURE
-                        logging.error("****Activarion Fail Reason: PASSWORD AUTHENTICATION")
-                    elif item.data.fail_reason == 3: # LOS_FAILURE
-                        logging.error("****Activarion Fail Reason: LOS")
-                    elif item.data.fail_reason == 4: # ONU_ALARM_FAILURE
-                        logging.error("****Activarion Fail Reason: ONU ALARM")
-                    elif item.data.fail_reason == 5: # SWITCH_OVER_FAILURE
-                        logging.error("****Activarion Fail Reason: SWITCH OVER")
-
-            elif item.isClass("FlowStatsInd"):
-                deviceList[item.datapath_id].update_Flow_statistics(item.data.flow_id,
-                                                                    item.data.rx_bytes,
-                                                                    item.data.rx_packets,
-                                                                    item.data.tx_bytes,
-                                                                    item.data.tx_packets,
-                                                                    item.data.timestamp)
-                logging.info("Received OLT Flow Stats indication")
-            else:
-                logging.error("Queue OLT Indication not found")
-        elif item.source == "onos":
-            if item.isClass("Flow"):
-                deviceList[item.datapath_id].configureFlows(item.data.flow_id, item.data.flow_action)
-
-        oltQueue.task_done()
+        reload.clear()
+        mtime = newMtime
+
+        config = reload_config(file_json, config, controller, engine, workers, agentLoop)
+
+def reload_config(file_json, config, controller, engine, workers, agentLoop = None):
+    """Apply the OLTs of the configuration file. The running OLTs are kept
+        if it can not be applied.
+
+    Return:
+        dict: the configuration now applied, 'config' if it was not read
+
+    Args:
+            file_json (string): configuration file
+            config (dict): configuration applied until now
+            controller (dict): SDN-controller entry the OLTs connect to
+    """
+
+    newConfig = load_config(file_json)
+    if newConfig is None:
+        return config
+
+    olts = newConfig.get("olts", [])
+    if not isinstance(olts, list):
+        logging.error("Configuration %s not applied: \"olts\" is not a list", file_json)
+        return config
+
+    # Warned once per change
+    if newConfig.get("SDN-controller") != config.get("SDN-controller"):
+        logging.warning("SDN-controller changes are applied on restart")
+
+    logging.info("Reloading the OLTs of %s", file_json)
+    try:
+        apply_olts(olts, controller, engine, workers, agentLoop)
+    except Exception:
+        logging.exception("Configuration %s not fully applied, the running OLTs are kept", file_json)
+
+    return newConfig
+
+def main():
+    logging.info("Starting OpenFlow Agent...")
+
+    file_json = "openFlow_agent.config"
+
+    config = load_config(file_json)
+    if config is None:
+        return
+
+    # Share of each priority class (control, activation, stats) of the OLT queues,
+    # items of each class kept in memory per OLT (see src.agentQueue.KIND_POLICIES)
+    try:
+        oltQueue.configure(config.get("queue_weights"), config.get("queue_limits"),
+                           config.get("queue_spill_dir"))
+    except ValueError as e:
+        logging.error("Wrong queue configuration in %s: %s", file_json, e)
+        return
+
+    # Recording mode: journal of the OLT and controller inputs, see benchmarks/journalReplay.py
+    if config.get("journal"):
+        oltQueue.journal = EventJournal(config["journal"])
+
+    # OpenFlow channels: "asyncio" serves every OLT on one event loop,
+    # "thread" uses a blocking thread per OLT
+    agentLoop = AgentLoop()
+    engine = None
+    if config["SDN-controller"].get("engine", "asyncio") == "asyncio":
+        engine = OFChannelEngine(agentLoop)
+
+    # OLT gRPC channels: "asyncio" reads the indications of every OLT on the
+    # same event loop, "thread" uses a blocking channel and stream thread per OLT
+    oltLoop = None
+    if config.get("olt_engine", "thread") == "asyncio":
+        oltLoop = agentLoop
+
+    if engine is not None or oltLoop is not None:
+        agentLoop.start()
+
+    if len(config["olts"]) == 0:
+        logging.warning("OLTs not found, waiting for a configuration change")
+
+    #Queue for OLT an ONOS actions, one worker per OLT feeding the ONU workers
+    registry.register_gauge("queue_depth", oltQueue.depth)
+    workers = AgentWorkers(oltQueue, dispatch_item, metrics_interval = config.get("metrics_interval", 60))
+    workers.start()
+
+    # Every OLT is brought up by its own thread
+    apply_olts(config["olts"], config["SDN-controller"], engine, workers, oltLoop)
+
+    try:
+        watch_config(file_json, config, engine, workers, oltLoop)
+    finally:
+        for managed in managedOLTs.values():
+            managed.stop.set()
+        workers.stop()
+        if oltQueue.journal is not None:
+            oltQueue.journal.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,86 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import asyncio
+import logging
+import threading
+
+class AgentLoop:
+    """Asyncio event loop running on its own thread.
+
+        A single instance is shared by every OLT of the agent, so the
+        OpenFlow sessions (and any other asyncio based connection) are
+        multiplexed on one thread instead of one blocking thread each.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = None
+
+    def start(self):
+        """Start the event loop thread"""
+
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target = self._run, name = "agent-loop", daemon = True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stop(self):
+        """Stop the event loop thread"""
+
+        if self._thread is None:
+            return
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._thread = None
+
+    def in_loop(self):
+        """Check if the caller is running on the event loop thread"""
+
+        return self._thread is not None and threading.get_ident() == self._thread.ident
+
+    def submit(self, coro):
+        """Run a coroutine on the event loop from any thread.
+
+        Return:
+            concurrent.futures.Future with the coroutine result.
+
+        Args:
+                coro (coroutine): coroutine to run
+        """
+
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call_soon(self, callback, *args):
+        """Run a callback on the event loop. When the caller is already on
+            the loop thread the callback is executed right away.
+
+        Args:
+                callback (callable): function to run
+                args: callback arguments
+        """
+
+        if self.in_loop():
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
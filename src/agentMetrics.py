@@ -0,0 +1,151 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import bisect
+import logging
+import threading
+
+# Upper bounds in seconds of the histogram buckets: 10 us to ~84 s, x2 per bucket
+DEFAULT_BOUNDS = tuple(1e-5 * 2 ** i for i in range(24))
+
+class Histogram:
+    """Distribution of durations in fixed exponential buckets.
+
+        observe() is a bisect and a few additions under a lock, so it can
+        be called for every queue item. The percentiles are estimated from
+        the buckets (upper bound of the bucket holding the percentile).
+    """
+
+    __slots__ = ("bounds", "buckets", "count", "total", "max", "_lock")
+
+    def __init__(self, bounds = DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1) # The last one holds the values over the bounds
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.buckets[i] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, q):
+        """Get the estimated q-th percentile (0 < q <= 100), 0.0 without values"""
+
+        with self._lock:
+            buckets = list(self.buckets)
+            count = self.count
+            maximum = self.max
+
+        if count == 0:
+            return 0.0
+
+        rank = q / 100 * count
+        seen = 0
+        for i, n in enumerate(buckets):
+            seen += n
+            if seen >= rank:
+                return min(self.bounds[i], maximum) if i < len(self.bounds) else maximum
+
+        return maximum
+
+    def snapshot(self):
+        """Get the summary of the histogram as a dict"""
+
+        with self._lock:
+            count, total, maximum = self.count, self.total, self.max
+
+        return {
+            "count": count,
+            "mean": (total / count) if count else 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": maximum,
+        }
+
+class MetricsRegistry:
+    """In-process registry of the agent metrics.
+
+        The histograms are identified by a name and a tuple of labels
+        (e.g. ("queue_wait", ("00:00:...", "flow"))) and created on first
+        use. The gauges are functions called when the metrics are read.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = dict() # (name, labels) -> Histogram
+        self.gauges = dict() # name -> callable
+
+    def histogram(self, name, *labels):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+
+        return histogram
+
+    def observe(self, name, value, *labels):
+        self.histogram(name, *labels).observe(value)
+
+    def register_gauge(self, name, function):
+        """Set a gauge read by calling function() on every snapshot"""
+
+        with self._lock:
+            self.gauges[name] = function
+
+    def snapshot(self):
+        """Get every metric as dict(name, dict(labels, value))"""
+
+        with self._lock:
+            histograms = list(self.histograms.items())
+            gauges = list(self.gauges.items())
+
+        metrics = dict()
+        for (name, labels), histogram in histograms:
+            metrics.setdefault(name, {})[labels] = histogram.snapshot()
+
+        for name, function in gauges:
+            try:
+                metrics[name] = function()
+            except Exception:
+                logging.exception("Error reading the metric %s", name)
+
+        return metrics
+
+    def log_metrics(self):
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+
+        for (name, labels), histogram in histograms:
+            stats = histogram.snapshot()
+            if stats["count"] == 0:
+                continue
+
+            logging.info("Metric %s %s: %d | mean %.2f ms, p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms",
+                         name, "/".join(str(label) for label in labels), stats["count"],
+                         stats["mean"] * 1e3, stats["p50"] * 1e3, stats["p90"] * 1e3,
+                         stats["p99"] * 1e3, stats["max"] * 1e3)
+
+registry = MetricsRegistry()
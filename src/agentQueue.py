@@ -14,17 +14,382 @@
     limitations under the License.
 """
 
+import logging
+import pickle
 import queue
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
 
-oltQueue = queue.Queue()
+# Priority classes of the queue items, from the most to the least urgent
+CONTROL = "control" # Controller changes (FLOW_MOD)
+ACTIVATION = "activation" # ONU discovery and activation
+STATS = "stats" # Flow statistics
+
+PRIORITY_CLASSES = (CONTROL, ACTIVATION, STATS)
+
+# Items taken from each class per scheduling round when all are waiting
+DEFAULT_WEIGHTS = {CONTROL: 8, ACTIVATION: 4, STATS: 1}
+
+# Items kept in memory per class and OLT
+DEFAULT_LIMITS = {CONTROL: 4096, ACTIVATION: 1024, STATS: 8192}
+
+# Policies applied to a new item when its class is full
+BLOCK = "block" # The producer waits for room
+DROP_OLDEST = "drop-oldest" # The oldest item of the class is discarded
+SPILL = "spill" # The item is written to disk until there is room
+
+# Kinds of the queue items (QueueItem.kind)
+ONU_DISC = 0
+ONU_IND = 1
+FLOW_STATS = 2
+FLOW = 3
+
+# Priority class and full class policy of each kind. The OLT indications
+# must not block: the same gRPC stream carries the OMCI responses the
+# workers are waiting for.
+KIND_CLASSES = (ACTIVATION, ACTIVATION, STATS, CONTROL)
+KIND_POLICIES = (SPILL, SPILL, DROP_OLDEST, BLOCK)
+
+# Name of each kind in the logs and metrics
+KIND_NAMES = ("onu_disc", "onu_ind", "flow_stats", "flow")
+
+def item_class(item):
+    """Priority class of a QueueItem"""
+    return KIND_CLASSES[item.kind]
+
+def check_limits(limits):
+    """Raise ValueError if a class can not keep at least one item in memory"""
+
+    for cls, limit in limits.items():
+        if limit < 1:
+            raise ValueError("Queue limit of the %s class must be at least 1, got %s" % (cls, limit))
+
+class SpillFile:
+    """FIFO of queue items stored in a temporary file"""
+
+    _length = struct.Struct("!I")
+
+    def __init__(self, directory = None):
+        self._fp = None
+        self._directory = directory
+        self._readOffset = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, record):
+        if self._fp is None:
+            self._fp = tempfile.TemporaryFile(prefix = "agent-spill-", dir = self._directory)
+
+        data = pickle.dumps(record, protocol = pickle.HIGHEST_PROTOCOL)
+        self._fp.seek(0, 2)
+        self._fp.write(self._length.pack(len(data)))
+        self._fp.write(data)
+        self._count += 1
+
+    def popleft(self):
+        self._fp.seek(self._readOffset)
+        length = self._length.unpack(self._fp.read(self._length.size))[0]
+        record = pickle.loads(self._fp.read(length))
+        self._readOffset += self._length.size + length
+        self._count -= 1
+
+        if self._count == 0:
+            # Reuse the file from the start
+            self._fp.truncate(0)
+            self._readOffset = 0
+
+        return record
+
+class ClassQueue:
+    """FIFO per priority class served by weighted round robin.
+
+        Each round takes up to 'weight' items of every class in priority
+        order, so the control items go first and a flood of statistics
+        can only take its share of the worker. It keeps the interface of
+        queue.Queue used by the workers (put, get, task_done, qsize).
+
+        The statistics still waiting for a flow are merged with the new
+        ones (FlowStatsInd.merge), so the stats class holds at most one
+        item per flow whatever the indication rate is.
+
+        Each class keeps up to 'limit' items in memory, beyond that the
+        policy of the item kind (KIND_POLICIES) applies: the producer is
+        blocked, the oldest item is dropped or the item is spilled to disk
+        and read back in order when there is room.
+    """
+
+    def __init__(self, weights = None, limits = None, spill_dir = None):
+        self.weights = dict(DEFAULT_WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+        self.limits = dict(DEFAULT_LIMITS)
+        if limits:
+            self.limits.update(limits)
+        check_limits(self.limits)
+
+        self._lock = threading.Lock()
+        self._notEmpty = threading.Condition(self._lock)
+        self._notFull = threading.Condition(self._lock)
+        self._queues = {cls: deque() for cls in PRIORITY_CLASSES} # cls -> deque(item)
+        self._spills = {cls: SpillFile(spill_dir) for cls in PRIORITY_CLASSES}
+        self._credits = dict(self.weights)
+        self._size = 0
+        self._unfinished = 0
+        self._waitingStats = dict() # flow_id -> queued FlowStatsInd item
+
+        self.merged = 0 # Statistics merged into a waiting item
+        self.dropped = 0 # Items discarded by DROP_OLDEST
+        self.spilled = 0 # Items written to disk by SPILL
+        self.blocked = 0 # Producers blocked by BLOCK
+
+    def put(self, item, block = True, timeout = None):
+        item.enqueued = time.monotonic()
+
+        with self._lock:
+            self._put(item, block, timeout)
+
+    def put_many(self, items, block = True, timeout = None):
+        """Put several items taking the lock once"""
+
+        enqueued = time.monotonic()
+        with self._lock:
+            for item in items:
+                item.enqueued = enqueued
+                self._put(item, block, timeout)
+
+    def _put(self, item, block, timeout):
+        cls = item_class(item)
+        if item.kind == FLOW_STATS:
+            waiting = self._waitingStats.get(item.data.flow_id)
+            if waiting is not None:
+                waiting.merge(item)
+                self.merged += 1
+                return
+
+        fifo = self._queues[cls]
+        limit = self.limits[cls]
+        policy = KIND_POLICIES[item.kind]
+
+        if policy == SPILL and (len(fifo) >= limit or self._spills[cls]):
+            # Also when it is not full, so the class keeps its order
+            self._spills[cls].append(item)
+            self.spilled += 1
+            self._admit()
+            return
+
+        if len(fifo) >= limit:
+            if policy == DROP_OLDEST:
+                old = fifo.popleft()
+                if old.kind == FLOW_STATS:
+                    self._waitingStats.pop(old.data.flow_id, None)
+                self._size -= 1
+                self._unfinished -= 1
+                self.dropped += 1
+            elif not block:
+                raise queue.Full
+            else:
+                self.blocked += 1
+                if not self._notFull.wait_for(lambda: len(fifo) < limit, timeout):
+                    raise queue.Full
+
+        if item.kind == FLOW_STATS:
+            self._waitingStats[item.data.flow_id] = item
+
+        fifo.append(item)
+        self._admit()
+
+    def _admit(self):
+        self._size += 1
+        self._unfinished += 1
+        self._notEmpty.notify()
+
+    def get(self, block = True, timeout = None):
+        with self._lock:
+            if not block:
+                if self._size == 0:
+                    raise queue.Empty
+            elif not self._notEmpty.wait_for(lambda: self._size > 0, timeout):
+                raise queue.Empty
+
+            cls = self._next_class()
+            self._credits[cls] -= 1
+            self._size -= 1
+
+            fifo = self._queues[cls]
+            item = fifo.popleft()
+            if item.kind == FLOW_STATS:
+                self._waitingStats.pop(item.data.flow_id, None)
+
+            if self._spills[cls]:
+                fifo.append(self._spills[cls].popleft())
+            else:
+                self._notFull.notify_all()
+
+            return item
+
+    def _next_class(self):
+        for rnd in range(2):
+            for cls in PRIORITY_CLASSES:
+                if self._queues[cls] and self._credits[cls] > 0:
+                    return cls
+
+            # Every waiting class used its share, start a new round
+            self._credits = {cls: max(1, weight) for cls, weight in self.weights.items()}
+
+    def task_done(self):
+        with self._lock:
+            self._unfinished -= 1
+
+    def qsize(self):
+        with self._lock:
+            return self._size
+
+    def full(self, cls):
+        """True while a new item of the class would hit its limit"""
+
+        with self._lock:
+            return len(self._queues[cls]) >= self.limits[cls]
+
+    def wait_not_full(self, cls, timeout = None):
+        """Block until the class has room. Returns False on timeout."""
+
+        with self._lock:
+            return self._notFull.wait_for(lambda: len(self._queues[cls]) < self.limits[cls], timeout)
+
+    def depth(self):
+        """Get the waiting items of each class as dict(class, (items, oldest wait in seconds)),
+            the spilled items are included.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            return {cls: (len(q) + len(self._spills[cls]), (now - q[0].enqueued) if q else 0.0)
+                    for cls, q in self._queues.items()}
+
+class ShardedQueue:
+    """Agent queue partitioned by OLT (datapath_id).
+
+        Every OLT has its own ClassQueue, so the items of a busy OLT do not
+        delay the other ones. put() keeps the interface of queue.Queue, the
+        partitions are consumed by the AgentWorkers (src.agentWorkers).
+    """
+
+    def __init__(self, weights = None, limits = None, spill_dir = None):
+        self._lock = threading.Lock()
+        self.partitions = dict() # datapath_id -> ClassQueue
+
+        # Configuration of the new partitions
+        self.weights = dict(DEFAULT_WEIGHTS)
+        self.limits = dict(DEFAULT_LIMITS)
+        self.spill_dir = None
+        self.configure(weights, limits, spill_dir)
+
+        # Called as on_partition(datapath_id, partition) for each new partition
+        self.on_partition = None
+
+        # src.eventJournal.EventJournal recording the queued items, if any
+        self.journal = None
+
+    def configure(self, weights = None, limits = None, spill_dir = None):
+        """Update the configuration of the new partitions, raises ValueError
+            on a limit below 1
+        """
+
+        if limits:
+            check_limits(limits)
+            self.limits.update(limits)
+        if weights:
+            self.weights.update(weights)
+        if spill_dir is not None:
+            self.spill_dir = spill_dir
+
+    def partition(self, datapath_id):
+        """Get the queue of an OLT, creating it if needed"""
+
+        with self._lock:
+            partition = self.partitions.get(datapath_id)
+            created = partition is None
+            if created:
+                partition = self.partitions[datapath_id] = ClassQueue(self.weights, self.limits, self.spill_dir)
+
+        if created and self.on_partition is not None:
+            self.on_partition(datapath_id, partition)
+
+        return partition
+
+    def remove_partition(self, datapath_id):
+        """Discard the queue of a removed OLT with its waiting items"""
+
+        with self._lock:
+            return self.partitions.pop(datapath_id, None)
+
+    def put(self, item, block = True, timeout = None):
+        if self.journal is not None:
+            self.journal.record_item(item)
+
+        self.partition(item.datapath_id).put(item, block, timeout)
+
+    def put_many(self, items, block = True, timeout = None):
+        """Put several items of the same OLT at once"""
+
+        if len(items) == 0:
+            return
+
+        if self.journal is not None:
+            for item in items:
+                self.journal.record_item(item)
+
+        self.partition(items[0].datapath_id).put_many(items, block, timeout)
+
+    def qsize(self):
+        with self._lock:
+            partitions = list(self.partitions.values())
+
+        return sum(partition.qsize() for partition in partitions)
+
+    def depth(self):
+        """Get the per class depth of every OLT as dict(datapath_id, ClassQueue.depth())"""
+
+        with self._lock:
+            partitions = list(self.partitions.items())
+
+        return {datapath_id: partition.depth() for datapath_id, partition in partitions}
+
+    def log_depth(self):
+        with self._lock:
+            partitions = list(self.partitions.items())
+
+        for datapath_id, partition in partitions:
+            depth = partition.depth()
+            if not any(items for items, _ in depth.values()):
+                continue
+
+            logging.info("Queue of OLT %s: %s | merged %d, dropped %d, spilled %d, blocked %d",
+                         datapath_id,
+                         ", ".join("%s %d (oldest %.1f s)" % (cls, items, wait)
+                                   for cls, (items, wait) in depth.items()),
+                         partition.merged, partition.dropped, partition.spilled, partition.blocked)
+
+oltQueue = ShardedQueue()
 
 class OnuDisc:
+    __slots__ = ("intf_id", "vendor_id", "vendor_specific")
+    kind = ONU_DISC
+
     def __init__(self, intf_id, vendor_id, vendor_specific):
         self.intf_id = intf_id
         self.vendor_id = vendor_id
         self.vendor_specific = vendor_specific
 
 class OnuInd:
+    __slots__ = ("intf_id", "onu_id", "oper_state", "admin_state", "fail_reason")
+    kind = ONU_IND
+
     def __init__(self, intf_id, onu_id, oper_state, admin_state, fail_reason):
         self.intf_id = intf_id
         self.onu_id = onu_id
@@ -33,6 +398,9 @@ class OnuInd:
         self.fail_reason = fail_reason
 
 class FlowStatsInd:
+    __slots__ = ("flow_id", "rx_bytes", "rx_packets", "tx_bytes", "tx_packets", "timestamp")
+    kind = FLOW_STATS
+
     def __init__(self, flow_id, rx_bytes, rx_packets, tx_bytes, tx_packets, timestamp):
         self.flow_id = flow_id
         self.rx_bytes = rx_bytes
@@ -41,16 +409,48 @@ class FlowStatsInd:
         self.tx_packets = tx_packets
         self.timestamp = timestamp
 
+    def merge(self, other):
+        """Add the counters of a later indication of the same flow"""
+
+        self.rx_bytes += other.rx_bytes
+        self.rx_packets += other.rx_packets
+        self.tx_bytes += other.tx_bytes
+        self.tx_packets += other.tx_packets
+        self.timestamp = max(self.timestamp, other.timestamp)
+
 class Flow:
+    __slots__ = ("flow_id", "flow_action")
+    kind = FLOW
+
     def __init__(self, cookie, command):
         self.flow_id = cookie
         self.flow_action = command
 
 class QueueItem:
-    def __init__(self, datapath_id, source, data):
+    __slots__ = ("datapath_id", "source", "data", "kind", "on_done", "enqueued")
+
+    def __init__(self, datapath_id, source, data, on_done = None):
         self.datapath_id = datapath_id
         self.source = source
         self.data = data
+        self.kind = data.kind # Selects the handler of the item
+        self.on_done = on_done # Called when the item has been handled
+        self.enqueued = None # time.monotonic() of the put on the queue
+
+    def merge(self, other):
+        """Merge a later item with the same data into this one, which is
+            still waiting on the queue.
+        """
+
+        self.data.merge(other.data)
+
+        if other.on_done is not None:
+            if self.on_done is None:
+                self.on_done = other.on_done
+            else:
+                first, second = self.on_done, other.on_done
+                self.on_done = lambda: (first(), second())
 
-    def isClass(self, dataType):
-        return dataType == self.data.__class__.__name__
+    def complete(self):
+        if self.on_done is not None:
+            self.on_done()
@@ -0,0 +1,162 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from src.agentMetrics import registry
+from src.indicationDemux import indicationDemux
+
+class AgentWorkers:
+    """Supervisor of the per-OLT workers of the agent queue.
+
+        Each partition of the ShardedQueue is drained by its own worker
+        thread. The supervisor starts a worker when a partition is created,
+        restarts the workers that die and stops all of them.
+
+        The handler may run the item itself or hand it to an executor and
+        return the concurrent.futures.Future of the work, then the item is
+        completed when the future is done. At most max_inflight items of an
+        OLT are handed over at once, the rest wait on the partition where
+        the priority classes decide which one goes next.
+    """
+
+    def __init__(self, agentQueue, handler, check_interval = 5, max_inflight = 16, metrics_interval = 60):
+        """Initialize variables:
+                agentQueue (ShardedQueue): queue partitioned by OLT
+                handler (callable): function called as handler(item), it
+                                    may return a Future
+                check_interval (float): seconds between worker checks
+                max_inflight (int): items of an OLT handled at the same time
+                metrics_interval (float): seconds between logs of the metrics registry
+        """
+
+        self.agentQueue = agentQueue
+        self.handler = handler
+        self.check_interval = check_interval
+        self.max_inflight = max_inflight
+        self.metrics_interval = metrics_interval
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._supervisor = None
+        self.workers = dict() # datapath_id -> Thread
+
+    def start(self):
+        self.agentQueue.on_partition = self._start_worker
+        with self.agentQueue._lock:
+            partitions = list(self.agentQueue.partitions.items())
+
+        for datapath_id, partition in partitions:
+            self._start_worker(datapath_id, partition)
+
+        self._supervisor = threading.Thread(target = self._supervise, name = "agent-supervisor", daemon = True)
+        self._supervisor.start()
+
+    def stop(self):
+        """Stop the workers after the item they are handling"""
+
+        self._stop.set()
+        with self._lock:
+            workers = list(self.workers.values())
+
+        for th in workers:
+            th.join()
+
+    def remove_worker(self, datapath_id):
+        """Stop the worker of a removed OLT. It ends by itself after the
+            item it is handling, or after the queue wait timeout.
+        """
+
+        with self._lock:
+            self.workers.pop(datapath_id, None)
+
+    def join(self):
+        """Block until the workers are stopped"""
+
+        self._supervisor.join()
+
+    def _start_worker(self, datapath_id, partition):
+        if self._stop.is_set():
+            return
+
+        with self._lock:
+            th = self.workers.get(datapath_id)
+            if th is not None and th.is_alive():
+                return
+
+            th = threading.Thread(target = self._work, args = (datapath_id, partition),
+                                  name = "agent-worker-%s" % datapath_id, daemon = True)
+            self.workers[datapath_id] = th
+            th.start()
+
+    def _work(self, datapath_id, partition):
+        inflight = threading.BoundedSemaphore(self.max_inflight)
+        me = threading.current_thread()
+
+        # Until the agent stops or the worker is removed
+        while not self._stop.is_set() and self.workers.get(datapath_id) is me:
+            if not inflight.acquire(timeout = 3):
+                continue
+
+            try:
+                item = partition.get(block = True, timeout = 3)
+            except queue.Empty:
+                inflight.release()
+                continue
+
+            future = None
+            try:
+                future = self.handler(item)
+            except Exception:
+                logging.exception("Error handling queue item of OLT %s", datapath_id)
+            finally:
+                if isinstance(future, Future):
+                    future.add_done_callback(lambda f, item = item: self._item_done(datapath_id, item, inflight, f))
+                else:
+                    self._item_done(datapath_id, item, inflight)
+                partition.task_done()
+
+    def _item_done(self, datapath_id, item, inflight, future = None):
+        if future is not None and not future.cancelled() and future.exception() is not None:
+            logging.error("Error handling queue item of OLT %s", datapath_id, exc_info = future.exception())
+
+        inflight.release()
+
+        # Releases the OFPT_BARRIER_REPLYs waiting for this item
+        item.complete()
+
+    def _supervise(self):
+        lastMetrics = time.monotonic()
+
+        while not self._stop.wait(self.check_interval):
+            with self._lock:
+                dead = [datapath_id for datapath_id, th in self.workers.items() if not th.is_alive()]
+
+            for datapath_id in dead:
+                logging.error("Worker of OLT %s stopped, restarting it", datapath_id)
+                self._start_worker(datapath_id, self.agentQueue.partition(datapath_id))
+
+            self.agentQueue.log_depth()
+            indicationDemux.log_depth()
+
+            if time.monotonic() - lastMetrics >= self.metrics_interval:
+                lastMetrics = time.monotonic()
+                registry.log_metrics()
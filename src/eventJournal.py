@@ -0,0 +1,230 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import logging
+import struct
+import threading
+import time
+
+# Local imports
+import src.agentQueue
+
+# Journal file: header + records. Every record has a fixed header (type,
+# seconds since the start of the journal, datapath index, payload length)
+# followed by the payload.
+MAGIC = b"OFAJ"
+VERSION = 1
+
+_file_header = struct.Struct("!4sBd") # magic, version, start (time.time())
+_record_header = struct.Struct("!BdHI")
+
+# Record types
+DATAPATH = 0 # Payload: datapath_id (utf-8), defines the next datapath index
+ITEM = 1 # Payload: item kind and source + fields of the payload (see _item_fields)
+OF_FRAME = 2 # Payload: OpenFlow message received from the controller
+OMCI = 3 # Payload: intf_id, onu_id + OMCI frame received from the OLT
+
+SOURCES = ("olt", "onos")
+
+_item_header = struct.Struct("!BB") # kind, source index
+_omci_header = struct.Struct("!II")
+_bytes_length = struct.Struct("!H")
+
+# Payload fields of each item kind, in constructor order. Formats: struct
+# integer codes, "b" bytes and "s" strings (length prefixed)
+ITEM_FIELDS = {
+    src.agentQueue.ONU_DISC: (src.agentQueue.OnuDisc, (("intf_id", "I"), ("vendor_id", "b"),
+                                                       ("vendor_specific", "b"))),
+    src.agentQueue.ONU_IND: (src.agentQueue.OnuInd, (("intf_id", "I"), ("onu_id", "I"), ("oper_state", "s"),
+                                                     ("admin_state", "s"), ("fail_reason", "I"))),
+    src.agentQueue.FLOW_STATS: (src.agentQueue.FlowStatsInd, (("flow_id", "Q"), ("rx_bytes", "Q"),
+                                                              ("rx_packets", "Q"), ("tx_bytes", "Q"),
+                                                              ("tx_packets", "Q"), ("timestamp", "Q"))),
+    src.agentQueue.FLOW: (src.agentQueue.Flow, (("flow_id", "Q"), ("flow_action", "B"))),
+}
+
+def _pack_fields(data, fields):
+    parts = []
+    for name, fmt in fields:
+        value = getattr(data, name)
+        if fmt in ("b", "s"):
+            if fmt == "s":
+                value = str(value).encode("utf-8")
+            parts.append(_bytes_length.pack(len(value)))
+            parts.append(bytes(value))
+        else:
+            parts.append(struct.pack("!" + fmt, int(getattr(value, "value", value))))
+
+    return b"".join(parts)
+
+def _unpack_fields(payload, offset, fields):
+    values = []
+    for name, fmt in fields:
+        if fmt in ("b", "s"):
+            length = _bytes_length.unpack_from(payload, offset)[0]
+            offset += _bytes_length.size
+            value = bytes(payload[offset:offset + length])
+            offset += length
+            values.append(value.decode("utf-8") if fmt == "s" else value)
+        else:
+            values.append(struct.unpack_from("!" + fmt, payload, offset)[0])
+            offset += struct.calcsize("!" + fmt)
+
+    return values
+
+def encode_item(item):
+    """Payload of an ITEM record"""
+
+    data_class, fields = ITEM_FIELDS[item.kind]
+    return _item_header.pack(item.kind, SOURCES.index(item.source)) + _pack_fields(item.data, fields)
+
+def decode_item(datapath_id, payload):
+    """Rebuild the QueueItem of an ITEM record. The flow_action of a Flow is
+        kept as an int.
+    """
+
+    kind, source = _item_header.unpack_from(payload, 0)
+    data_class, fields = ITEM_FIELDS[kind]
+    data = data_class(*_unpack_fields(payload, _item_header.size, fields))
+
+    return src.agentQueue.QueueItem(datapath_id, SOURCES[source], data)
+
+def decode_omci(payload):
+    """Get (intf_id, onu_id, OMCI frame) of an OMCI record"""
+
+    intf_id, onu_id = _omci_header.unpack_from(payload, 0)
+    return intf_id, onu_id, bytes(payload[_omci_header.size:])
+
+class EventJournal:
+    """Append-only binary journal of the agent inputs: the items entering
+        the OLT queue, the OpenFlow messages received from the controller
+        and the OMCI responses of the ONUs, with their arrival time.
+
+        The records can be called from any thread. The file is buffered
+        and flushed every flush_interval seconds by its own thread, even
+        when no record arrives, and on close(). With a flush_interval of 0
+        every record is flushed.
+        The journal is read with read_journal() and replayed with
+        benchmarks/journalReplay.py.
+    """
+
+    def __init__(self, path, flush_interval = 1.0):
+        """Initialize variables:
+                path (string): journal file, it is overwritten
+                flush_interval (float): maximum seconds of records kept in memory
+        """
+
+        self.path = path
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._fp = open(path, "wb")
+        self._start = time.monotonic()
+        self._dirty = False # Records written since the last flush
+        self._datapaths = dict() # datapath_id -> index
+        self.records = 0
+
+        self._fp.write(_file_header.pack(MAGIC, VERSION, time.time()))
+
+        self._closed = threading.Event()
+        self._thread = None
+        if flush_interval > 0:
+            self._thread = threading.Thread(target = self._run, name = "event-journal", daemon = True)
+            self._thread.start()
+
+    def record_item(self, item):
+        self._record(ITEM, item.datapath_id, encode_item(item))
+
+    def record_frame(self, datapath_id, frame):
+        self._record(OF_FRAME, datapath_id, frame)
+
+    def record_omci(self, datapath_id, intf_id, onu_id, frame):
+        self._record(OMCI, datapath_id, _omci_header.pack(intf_id, onu_id) + bytes(frame))
+
+    def _record(self, record_type, datapath_id, payload):
+        now = time.monotonic()
+
+        with self._lock:
+            if self._fp is None:
+                return
+
+            index = self._datapaths.get(datapath_id)
+            if index is None:
+                index = self._datapaths[datapath_id] = len(self._datapaths)
+                name = str(datapath_id).encode("utf-8")
+                self._fp.write(_record_header.pack(DATAPATH, now - self._start, index, len(name)))
+                self._fp.write(name)
+
+            self._fp.write(_record_header.pack(record_type, now - self._start, index, len(payload)))
+            self._fp.write(payload)
+            self.records += 1
+            self._dirty = True
+
+            if self._thread is None:
+                self._flush()
+
+    def _run(self):
+        while not self._closed.wait(self.flush_interval):
+            with self._lock:
+                self._flush()
+
+    def _flush(self):
+        if self._fp is not None and self._dirty:
+            self._fp.flush()
+            self._dirty = False
+
+    def close(self):
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+        logging.info("Event journal %s closed, %d records", self.path, self.records)
+
+def read_journal(path):
+    """Generator of the records of a journal as (type, seconds since the
+        start, datapath_id, payload). The DATAPATH records are consumed.
+        A record cut by the end of the file (agent killed) is ignored.
+    """
+
+    datapaths = []
+
+    with open(path, "rb") as fp:
+        magic, version, start = _file_header.unpack(fp.read(_file_header.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not an event journal (version %d)" % (path, VERSION))
+
+        while True:
+            header = fp.read(_record_header.size)
+            if len(header) < _record_header.size:
+                return
+
+            record_type, timestamp, index, length = _record_header.unpack(header)
+            payload = fp.read(length)
+            if len(payload) < length:
+                logging.warning("Event journal %s truncated", path)
+                return
+
+            if record_type == DATAPATH:
+                datapaths.append(payload.decode("utf-8"))
+                continue
+
+            yield record_type, timestamp, datapaths[index], payload
@@ -0,0 +1,275 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Local imports
+from src.agentMetrics import registry
+from src.agentQueue import FlowStatsInd
+
+# Flows taken per round of the stats lane
+STATS_BATCH = 256
+
+class IndicationLane:
+    """FIFO of indications handled by its own thread"""
+
+    def __init__(self, name):
+        """Initialize variables:
+                name (string): lane name, for the thread and the metrics
+        """
+
+        self.name = name
+
+        self._items = deque() # (adaptor, kind, data, time.monotonic())
+        self._notEmpty = threading.Condition(threading.Lock())
+        self._thread = None
+        self._stopped = False
+
+        self.max_depth = 0
+        self.handled = 0
+        self.merged = 0
+
+    def start(self):
+        self._thread = threading.Thread(target = self._run, name = "indications-%s" % self.name, daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        """End the lane thread, the indications still waiting are discarded"""
+
+        with self._notEmpty:
+            self._stopped = True
+            self._notEmpty.notify()
+
+    def put(self, adaptor, kind, data):
+        with self._notEmpty:
+            self._items.append((adaptor, kind, data, time.monotonic()))
+            if len(self._items) > self.max_depth:
+                self.max_depth = len(self._items)
+            self._notEmpty.notify()
+
+    def _take(self):
+        """Wait for the next indications, None once the lane is stopped"""
+
+        with self._notEmpty:
+            self._notEmpty.wait_for(lambda: self._items or self._stopped)
+            if self._stopped:
+                return None
+
+            return [self._items.popleft()]
+
+    def _handle(self, batch):
+        now = time.monotonic()
+        for adaptor, kind, data, received in batch:
+            registry.observe("indication_wait", now - received, self.name)
+
+            # The indications still waiting for a removed OLT are discarded
+            if adaptor.closed():
+                continue
+
+            try:
+                getattr(adaptor, IndicationDemux.handlers[kind])(data)
+            except Exception:
+                logging.exception("Error handling %s indication of OLT %s:%d", kind,
+                                  adaptor.ip_address, adaptor.port)
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+
+            self._handle(batch)
+            self.handled += len(batch)
+
+    def depth(self):
+        with self._notEmpty:
+            return {"depth": len(self._items), "max_depth": self.max_depth,
+                    "handled": self.handled, "merged": self.merged}
+
+class StatsLane(IndicationLane):
+    """Lane of the flow stats.
+
+        The stats still waiting for a flow are merged with the new ones
+        (FlowStatsInd.merge), so the lane holds at most one item per flow
+        and OLT and no counter is lost. Each round takes up to 'batch'
+        flows and hands those of an OLT off at once (flowStats_indications).
+    """
+
+    def __init__(self, name, batch):
+        super().__init__(name)
+        self.batch = batch
+        self._items = OrderedDict() # (adaptor, flow_id) -> [FlowStatsInd, time.monotonic()]
+
+    def put(self, adaptor, kind, data):
+        stats = FlowStatsInd(data.flow_id, data.rx_bytes, data.rx_packets,
+                             data.tx_bytes, data.tx_packets, data.timestamp)
+
+        with self._notEmpty:
+            waiting = self._items.get((adaptor, data.flow_id))
+            if waiting is not None:
+                waiting[0].merge(stats)
+                self.merged += 1
+                return
+
+            self._items[(adaptor, data.flow_id)] = [stats, time.monotonic()]
+            if len(self._items) > self.max_depth:
+                self.max_depth = len(self._items)
+            self._notEmpty.notify()
+
+    def _take(self):
+        with self._notEmpty:
+            self._notEmpty.wait_for(lambda: self._items or self._stopped)
+            if self._stopped:
+                return None
+
+            return [self._items.popitem(last = False) for i in range(min(self.batch, len(self._items)))]
+
+    def _handle(self, batch):
+        now = time.monotonic()
+        flowStats = dict() # adaptor -> [FlowStatsInd]
+        for (adaptor, flow_id), (stats, received) in batch:
+            registry.observe("indication_wait", now - received, self.name)
+            flowStats.setdefault(adaptor, []).append(stats)
+
+        for adaptor, stats in flowStats.items():
+            # The stats still waiting for a removed OLT are discarded
+            if adaptor.closed():
+                continue
+
+            try:
+                adaptor.flowStats_indications(stats)
+            except Exception:
+                logging.exception("Error handling flow_stats indications of OLT %s:%d",
+                                  adaptor.ip_address, adaptor.port)
+
+class IndicationDemux:
+    """Hands the OLT indications off to a lane per type.
+
+        The stream readers only classify the indications, so a burst of
+        flow stats can not delay the OMCI responses the ONU workers are
+        waiting for:
+            omci: OMCI responses, one at a time, a lane per OLT
+            stats: flow stats merged per flow, handled in batches
+            control: ONU discoveries and ONU indications
+    """
+
+    # Lane and OLTadaptor handler of each Indication field
+    lanes_by_kind = {
+        "omci_ind": "omci",
+        "flow_stats": "stats",
+        "onu_disc_ind": "control",
+        "onu_ind": "control"
+    }
+
+    handlers = {
+        "omci_ind": "omci_indication",
+        "flow_stats": "flowStats_indications",
+        "onu_disc_ind": "onu_discovery",
+        "onu_ind": "onu_indication"
+    }
+
+    def __init__(self):
+        self.lanes = {
+            "stats": StatsLane("stats", STATS_BATCH),
+            "control": IndicationLane("control")
+        }
+        self.omciLanes = dict() # OLTadaptor -> IndicationLane
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        """Start the lane threads, on the first indication"""
+
+        with self._lock:
+            if self._started:
+                return
+
+            for lane in self.lanes.values():
+                lane.start()
+            registry.register_gauge("indication_lanes", self.depth)
+            self._started = True
+
+    def omci_lane(self, adaptor):
+        """Get the OMCI lane of an OLT, None once it is disconnected"""
+
+        lane = self.omciLanes.get(adaptor)
+        if lane is None:
+            with self._lock:
+                lane = self.omciLanes.get(adaptor)
+                if lane is None and not adaptor.closed():
+                    lane = IndicationLane("omci-%s:%d" % (adaptor.ip_address, adaptor.port))
+                    lane.start()
+                    self.omciLanes[adaptor] = lane
+
+        return lane
+
+    def remove(self, adaptor):
+        """Stop the OMCI lane of a disconnected OLT"""
+
+        with self._lock:
+            lane = self.omciLanes.pop(adaptor, None)
+
+        if lane is not None:
+            lane.stop()
+
+    def dispatch(self, adaptor, ind):
+        """Queue an indication on its lane. It does not block, so it can be
+            called from the stream thread or the event loop.
+
+        Args:
+                adaptor (OLTadaptor): OLT of the indication
+                ind (Indication): indication received from the OLT
+        """
+
+        kind = ind.WhichOneof("data")
+        lane = self.lanes_by_kind.get(kind)
+        if lane is None:
+            return
+
+        if not self._started:
+            self.start()
+
+        if lane == "omci":
+            lane = self.omci_lane(adaptor)
+            if lane is None:
+                return
+        else:
+            lane = self.lanes[lane]
+
+        lane.put(adaptor, kind, getattr(ind, kind))
+
+    def depth(self):
+        """Get the metrics of each lane as dict(lane, dict(depth, max_depth, handled, merged))"""
+
+        with self._lock:
+            lanes = list(self.lanes.items()) + [(lane.name, lane) for lane in self.omciLanes.values()]
+
+        return {name: lane.depth() for name, lane in lanes}
+
+    def log_depth(self):
+        lanes = self.depth()
+        if not any(lane["depth"] for lane in lanes.values()):
+            return
+
+        logging.info("Indication lanes: %s", ", ".join("%s %d (max %d, merged %d)" %
+                                                        (name, depth["depth"], depth["max_depth"], depth["merged"])
+                                                        for name, depth in lanes.items()))
+
+indicationDemux = IndicationDemux()
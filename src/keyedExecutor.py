@@ -0,0 +1,93 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+class KeyedExecutor:
+    """Runs the tasks with the same key in submission order and the tasks
+        with different keys concurrently, on a bounded pool of threads.
+
+        It is used to handle the work of different ONUs of an OLT in
+        parallel while the work of each ONU stays ordered.
+    """
+
+    def __init__(self, max_workers = 8, name = "keyed-executor"):
+        """Initialize variables:
+                max_workers (int): maximum number of tasks running at once
+                name (string): prefix of the thread names
+        """
+
+        self._pool = ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = name)
+        self._lock = threading.Lock()
+        self._lanes = dict() # key -> deque of waiting tasks, present while a task of the key runs
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs) after the tasks already submitted
+            with the same key.
+
+        Return:
+            concurrent.futures.Future of the task.
+        """
+
+        task = (Future(), fn, args, kwargs)
+
+        with self._lock:
+            lane = self._lanes.get(key)
+            if lane is None:
+                self._lanes[key] = deque()
+            else:
+                lane.append(task)
+
+        if lane is None:
+            self._pool.submit(self._run, key, task)
+
+        return task[0]
+
+    def _run(self, key, task):
+        future, fn, args, kwargs = task
+
+        if future.set_running_or_notify_cancel():
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        # The next task of the key goes back to the pool, so a busy key
+        # does not keep a thread while other keys are waiting
+        with self._lock:
+            lane = self._lanes[key]
+            if lane:
+                task = lane.popleft()
+            else:
+                del self._lanes[key]
+                task = None
+
+        if task is not None:
+            self._pool.submit(self._run, key, task)
+
+    def pending(self):
+        """Number of tasks running or waiting"""
+
+        with self._lock:
+            return sum(len(lane) + 1 for lane in self._lanes.values())
+
+    def shutdown(self, wait = True):
+        self._pool.shutdown(wait = wait)
@@ -0,0 +1,99 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import logging
+import threading
+import time
+from collections import deque
+
+class BarrierTracker:
+    """Defers the OFPT_BARRIER_REPLY until the work queued before the
+        OFPT_BARRIER_REQUEST has been completed.
+
+        Every item put on the agent queue by the controller session takes a
+        sequence number (queued) and gives it back when it has been handled
+        (completed), in any order. A barrier waits for every sequence
+        number taken before it.
+    """
+
+    def __init__(self, send_reply):
+        """Initialize variables:
+                send_reply (callable): function called as send_reply(xid)
+                                       to send the OFPT_BARRIER_REPLY
+        """
+
+        self.send_reply = send_reply
+
+        self._lock = threading.Lock()
+        # Held while barriers are released and sent, so the replies of two
+        # threads completing items at once keep the order of the requests
+        self._sendLock = threading.Lock()
+        self._next = 0 # Next sequence number
+        self._low = 0 # Every sequence number below it is completed
+        self._done = set() # Completed sequence numbers above _low
+        self._barriers = deque() # (sequence, xid, arrival time)
+
+        # Seconds that the last barrier has waited for the queued work
+        self.lastWait = 0.0
+
+    def queued(self):
+        """Take the sequence number of a new queued item"""
+
+        with self._lock:
+            seq = self._next
+            self._next += 1
+
+        return seq
+
+    def completed(self, seq):
+        """Mark a queued item as handled and send the barriers released"""
+
+        with self._sendLock:
+            with self._lock:
+                self._done.add(seq)
+                while self._low in self._done:
+                    self._done.remove(self._low)
+                    self._low += 1
+
+                released = []
+                while self._barriers and self._barriers[0][0] <= self._low:
+                    released.append(self._barriers.popleft())
+
+            for _, xid, start in released:
+                self.lastWait = time.monotonic() - start
+                logging.info("OFPT_BARRIER xid %d released after %.3f s", xid, self.lastWait)
+                self.send_reply(xid)
+
+    def barrier(self, xid):
+        """Send the OFPT_BARRIER_REPLY now if there is no pending work,
+            otherwise when the work queued until now is completed.
+        """
+
+        with self._sendLock:
+            with self._lock:
+                pending = self._low < self._next
+                if pending:
+                    self._barriers.append((self._next, xid, time.monotonic()))
+
+            if not pending:
+                self.send_reply(xid)
+
+    def pending(self):
+        """Number of queued items not completed yet"""
+
+        with self._lock:
+            return self._next - self._low - len(self._done)
@@ -0,0 +1,139 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import logging
+import struct
+
+OFP_HEADER_LEN = 8
+
+_ofp_length = struct.Struct("!H")
+
+class OFReceiveBuffer:
+    """Reassembly buffer for the OpenFlow stream received from the controller.
+
+        The bytes read from the socket are stored in a single bytearray and
+        the complete OpenFlow messages are returned as memoryview slices of
+        it, so a message split between TCP segments is kept until the rest
+        of it arrives and no copy is made per message.
+
+        A returned frame is only valid until the next read on the buffer.
+        Any data that must be kept must be copied with bytes(frame).
+    """
+
+    def __init__(self, size = 65536, min_read = 4096):
+        """Initialize variables:
+                size (int): initial capacity of the buffer in bytes
+                min_read (int): minimum free space offered to each read
+        """
+
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0 # First byte not consumed yet
+        self._end = 0 # First free byte
+        self._need = 0 # Length of the incomplete message at _start, if known
+        self._min_read = min_read
+
+    def __len__(self):
+        """Number of bytes received and not returned as a frame yet"""
+        return self._end - self._start
+
+    def recv_from(self, sock):
+        """Read from the socket directly into the free space of the buffer.
+
+        Return:
+            Number of bytes read, 0 when the connection has been closed.
+
+        Args:
+                sock (socket.socket): connected socket
+        """
+
+        self._reserve(self._min_read)
+        nbytes = sock.recv_into(self._view[self._end:])
+        self._end += nbytes
+
+        return nbytes
+
+    def feed(self, data):
+        """Append already received bytes to the buffer.
+
+        Args:
+                data (bytes-like): bytes received from the controller
+        """
+
+        nbytes = len(data)
+        self._reserve(nbytes)
+        self._buf[self._end:self._end + nbytes] = data
+        self._end += nbytes
+
+    def frames(self):
+        """Generator of the complete OpenFlow messages stored on the buffer.
+            Each message is returned as a memoryview with exactly the bytes
+            of the message (header included).
+        """
+
+        while self._end - self._start >= OFP_HEADER_LEN:
+            length = _ofp_length.unpack_from(self._buf, self._start + 2)[0]
+
+            if length < OFP_HEADER_LEN:
+                # The stream can not be re-synchronized after a bad header
+                logging.error("Error: Wrong OF message length %d, discarding %d bytes",
+                              length, self._end - self._start)
+                self.clear()
+                return
+
+            if self._end - self._start < length:
+                self._need = length
+                return
+
+            frame = self._view[self._start:self._start + length]
+            self._start += length
+            self._need = 0
+
+            yield frame
+
+    def clear(self):
+        """Discard every received byte"""
+
+        self._start = self._end = self._need = 0
+
+    def _reserve(self, size):
+        """Make room for at least 'size' bytes after the stored data. The
+            bytearray is never resized in place, so frames still referenced
+            by the caller do not block the buffer.
+        """
+
+        pending = self._end - self._start
+        if pending == 0:
+            self._start = self._end = 0
+
+        size = max(size, self._need - pending)
+        if len(self._buf) - self._end >= size:
+            return
+
+        if len(self._buf) - pending >= size:
+            # Move the incomplete message to the front of the buffer
+            remaining = bytes(self._view[self._start:self._end])
+            self._buf[0:pending] = remaining
+        else:
+            # Grow the buffer, keeping the incomplete message
+            newBuf = bytearray(max(2 * len(self._buf), pending + size))
+            newBuf[0:pending] = self._view[self._start:self._end]
+            self._buf = newBuf
+            self._view = memoryview(newBuf)
+
+        self._start = 0
+        self._end = pending
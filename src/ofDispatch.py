@@ -0,0 +1,106 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import logging
+import struct
+import time
+
+from pyof.v0x04.common.header import Type
+
+# Local imports
+from src.agentMetrics import registry
+
+_ofp_header = struct.Struct("!BBHI")
+
+class OFHeader:
+    """OpenFlow header read with struct. It replaces the pyof Header on the
+        receive path: the handlers only need the xid, the length and the
+        header size.
+    """
+
+    __slots__ = ("version", "message_type", "length", "xid")
+
+    def __init__(self, version, message_type, length, xid):
+        self.version = version
+        self.message_type = message_type
+        self.length = length
+        self.xid = xid
+
+    @classmethod
+    def unpack(cls, frame):
+        return cls(*_ofp_header.unpack_from(frame, 0))
+
+    def get_size(self):
+        return _ofp_header.size
+
+class OFDispatcher:
+    """Dispatch table of the OpenFlow messages received from the controller.
+
+        Each message type has a single handler, called as handler(header,
+        frame). The time spent in the handler is observed per message type
+        in the "of_dispatch" histograms of the metrics registry, whose count
+        is the number of messages received.
+    """
+
+    def __init__(self):
+        self.handlers = dict() # message type -> handler
+        self.names = dict() # message type -> metric label
+
+    def register(self, message_type, handler):
+        """Set the handler of a message type.
+
+        Args:
+                message_type (Type or int): OpenFlow message type
+                handler (callable): function called as handler(header, frame)
+        """
+
+        message_type = int(getattr(message_type, "value", message_type))
+        self.handlers[message_type] = handler
+        self.get_name(message_type)
+
+    def get_name(self, message_type):
+        name = self.names.get(message_type)
+        if name is None:
+            try:
+                name = Type(message_type).name
+            except ValueError:
+                name = str(message_type)
+            self.names[message_type] = name
+
+        return name
+
+    def dispatch(self, frame):
+        """Handle one complete OpenFlow message.
+
+        Args:
+                frame (bytes-like): OpenFlow message, header included
+        """
+
+        header = OFHeader.unpack(frame)
+        name = self.get_name(header.message_type)
+
+        handler = self.handlers.get(header.message_type)
+        if handler is None:
+            logging.debug("Unhandled OF message type %d", header.message_type)
+            registry.observe("of_dispatch", 0.0, name)
+            return
+
+        start = time.perf_counter()
+        try:
+            handler(header, frame)
+        finally:
+            registry.observe("of_dispatch", time.perf_counter() - start, name)
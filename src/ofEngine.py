@@ -0,0 +1,186 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import asyncio
+import concurrent.futures
+import logging
+
+# Local imports
+from src.agentLoop import AgentLoop
+from src.ofBuffer import OFReceiveBuffer
+from src.ofWriter import StreamOFWriter
+
+# Longest wait for room in a full OLT queue before checking the channel again
+QUEUE_FULL_WAIT = 1.0
+
+class OFChannel:
+    """OpenFlow connection of one OLT with the controller.
+
+        The connection is served by the OFChannelEngine event loop. The
+        received messages are handled by the ONOSAdaptor of the OLT and
+        its replies are written back through this channel.
+    """
+
+    def __init__(self, engine, controller):
+        """Initialize variables:
+                engine (OFChannelEngine): engine serving the channel
+                controller (ONOSAdaptor): OpenFlow handler of the OLT
+        """
+
+        self.engine = engine
+        self.controller = controller
+        self._reader = None
+        self._writer = None
+        self._ofWriter = None
+        self._task = None
+
+    async def connect(self):
+        """Open the TCP connection with the controller and send the OFPT_HELLO"""
+
+        self._reader, self._writer = await asyncio.open_connection(self.controller.ipONOS,
+                                                                   self.controller.portONOS)
+        self._ofWriter = StreamOFWriter(asyncio.get_running_loop(), self._writer,
+                                        self.controller.write_max_bytes, self.controller.write_max_delay)
+        self.controller.attach_channel(self)
+        self.controller.OFPT_HELLO_msg()
+
+    async def serve(self, session):
+        """Receive the controller messages until the connection is closed.
+
+        Args:
+                session (tuple): OLT parameters for ONOSAdaptor.start_session
+        """
+
+        self.controller.start_session(*session)
+
+        # Buffer to rebuild the OF messages split between TCP segments
+        rxBuffer = OFReceiveBuffer()
+
+        while True:
+            try:
+                data = await self._reader.read(65536)
+            except OSError as e:
+                logging.error("Connection with the controller lost: %s", e)
+                break
+
+            if not data:
+                logging.error("Connection closed by the controller")
+                break
+
+            rxBuffer.feed(data)
+            for frame in rxBuffer.frames():
+                if self.controller.queue_full():
+                    # Backpressure: a blocking put would stop the event loop of
+                    # every OLT, so this channel stops reading and waits for
+                    # room in an executor thread instead
+                    self._ofWriter.flush()
+                    loop = asyncio.get_running_loop()
+                    while self.controller.queue_full():
+                        await loop.run_in_executor(None, self.controller.wait_queue_not_full, QUEUE_FULL_WAIT)
+
+                try:
+                    self.controller.handle_message(frame)
+                except Exception:
+                    logging.exception("Error handling OF message from the controller")
+
+            # The replies of the received batch are sent together
+            self._ofWriter.flush()
+
+            # Stop reading while the controller does not read our replies
+            await self._writer.drain()
+
+        self.close()
+
+    def write(self, message):
+        """Send a packed OpenFlow message. It can be called from any thread.
+
+        Args:
+                message (bytes): packed OpenFlow message
+        """
+
+        self.engine.agentLoop.call_soon(self._write, message)
+
+    def _write(self, message):
+        if self._writer is None or self._writer.is_closing():
+            logging.error("OF message discarded, the connection with the controller is closed")
+            return
+
+        self._ofWriter.write(message)
+
+    def close(self):
+        """Close the connection with the controller. It can be called from any thread."""
+
+        self.engine.agentLoop.call_soon(self._close)
+
+    def _close(self):
+        if self._writer is not None and not self._writer.is_closing():
+            self._ofWriter.flush()
+            self._writer.close()
+
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+class OFChannelEngine:
+    """Serves the OpenFlow channels of every OLT on a single event loop"""
+
+    def __init__(self, agentLoop = None):
+        """Initialize variables:
+                agentLoop (AgentLoop): shared event loop, a new one is
+                                       created if it is not given
+        """
+
+        self.agentLoop = agentLoop if agentLoop is not None else AgentLoop()
+        self.channels = []
+
+    def start(self):
+        self.agentLoop.start()
+
+    def open_channel(self, controller, session, timeout = None):
+        """Connect an OLT with the controller and start serving the channel.
+            It blocks until the connection is established.
+
+        Return:
+            The OFChannel of the OLT.
+
+        Args:
+                controller (ONOSAdaptor): OpenFlow handler of the OLT
+                session (tuple): OLT parameters for ONOSAdaptor.start_session
+                timeout (float): seconds to wait for the connection
+        """
+
+        channel = OFChannel(self, controller)
+        connecting = self.agentLoop.submit(channel.connect())
+        try:
+            connecting.result(timeout)
+        except concurrent.futures.TimeoutError:
+            connecting.cancel()
+            raise
+        self.agentLoop.submit(self._serve(channel, session))
+        self.channels.append(channel)
+
+        return channel
+
+    async def _serve(self, channel, session):
+        channel._task = asyncio.current_task()
+
+        try:
+            await channel.serve(session)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if channel in self.channels:
+                self.channels.remove(channel)
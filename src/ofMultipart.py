@@ -0,0 +1,78 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import logging
+import struct
+
+from pyof.v0x04.common.header import Type
+from pyof.v0x04.controller2switch.multipart_reply import MultipartReplyFlags
+
+OFP_VERSION = 0x04
+OFP_MAX_LENGTH = 0xffff # Maximum value of the OpenFlow length field
+
+# ofp_header + multipart_type, flags and 4 bytes of padding
+_multipart_header = struct.Struct("!BBHIHH4x")
+MULTIPART_HEADER_LEN = _multipart_header.size
+
+def _pack_segment(xid, multipart_type, flags, body, length):
+    message = bytearray(MULTIPART_HEADER_LEN + length)
+    _multipart_header.pack_into(message, 0, OFP_VERSION, Type.OFPT_MULTIPART_REPLY.value,
+                                len(message), xid, multipart_type, flags)
+
+    offset = MULTIPART_HEADER_LEN
+    for packed in body:
+        message[offset:offset + len(packed)] = packed
+        offset += len(packed)
+
+    return bytes(message)
+
+def multipart_reply_segments(xid, multipart_type, items, max_length = OFP_MAX_LENGTH):
+    """Generator of the packed OFPT_MULTIPART_REPLY messages of a multipart
+        body. The items are packed one by one and grouped in messages of at
+        most 'max_length' bytes. Every message but the last one has the
+        OFPMPF_REPLY_MORE flag set, so only one segment is kept in memory
+        no matter how large the table is.
+
+    Args:
+            xid (int): xid of the OFPT_MULTIPART_REQUEST
+            multipart_type (MultipartType): type of the multipart body
+            items (iterable): pyof objects of the body (FlowStats, Port, ...)
+            max_length (int): maximum length of each message
+    """
+
+    multipart_type = int(multipart_type)
+    maxBody = max_length - MULTIPART_HEADER_LEN
+
+    body = []
+    length = 0
+
+    for item in items:
+        packed = item.pack()
+
+        if len(packed) > maxBody:
+            logging.error("Error: Multipart item of %d bytes can not be sent, discarding it", len(packed))
+            continue
+
+        if length + len(packed) > maxBody:
+            yield _pack_segment(xid, multipart_type, MultipartReplyFlags.OFPMPF_REPLY_MORE.value, body, length)
+            body = []
+            length = 0
+
+        body.append(packed)
+        length += len(packed)
+
+    yield _pack_segment(xid, multipart_type, 0, body, length)
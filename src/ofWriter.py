@@ -0,0 +1,243 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import logging
+import socket
+import threading
+import time
+
+# Maximum number of buffers given to a single sendmsg call
+IOV_MAX = 1024
+
+class OFWriter:
+    """Outbound queue of packed OpenFlow messages.
+
+        The messages are not sent one by one: they are queued and written
+        together when the queued bytes reach 'max_bytes' or when the first
+        queued message has waited 'max_delay' seconds, so a burst of
+        replies (e.g. the PORT_STATUS of every UNI of a new ONU) takes a
+        few writes instead of one syscall per message.
+    """
+
+    def __init__(self, max_bytes = 65536, max_delay = 0.001):
+        """Initialize variables:
+                max_bytes (int): queued bytes that force a write
+                max_delay (float): maximum seconds a message waits on the queue
+        """
+
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+        self._buffers = []
+        self._pending = 0
+
+        # Counters to check the coalescing ratio
+        self.messages = 0
+        self.writes = 0
+
+    def _queue(self, message):
+        """Queue a message. Return True if the byte budget is reached."""
+
+        self._buffers.append(message)
+        self._pending += len(message)
+        self.messages += 1
+
+        return self._pending >= self.max_bytes
+
+    def _take(self):
+        """Return the queued messages and empty the queue"""
+
+        buffers = self._buffers
+        self._buffers = []
+        self._pending = 0
+        self.writes += 1
+
+        return buffers
+
+    def _set_nodelay(self, sock):
+        """Disable Nagle's algorithm. The messages are already coalesced
+            here, so delaying the segments in the kernel only adds latency
+            to the replies the controller is waiting for (ECHO, BARRIER).
+        """
+
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError as e:
+            logging.warning("TCP_NODELAY can not be set on the controller socket: %s", e)
+
+class SocketOFWriter(OFWriter):
+    """OFWriter over a blocking socket. The writes are done by a dedicated
+        thread with vectored sends (sendmsg), handling the short writes.
+    """
+
+    def __init__(self, sock, max_bytes = 65536, max_delay = 0.001):
+        """Initialize variables:
+                sock (socket.socket): connected socket
+                max_bytes (int): queued bytes that force a write
+                max_delay (float): maximum seconds a message waits on the queue
+        """
+
+        super().__init__(max_bytes, max_delay)
+
+        self.sock = sock
+        self._set_nodelay(sock)
+
+        self._cond = threading.Condition()
+        self._flushNow = False
+        self._closed = False
+
+        self._thread = threading.Thread(target = self._run, name = "of-writer", daemon = True)
+        self._thread.start()
+
+    def write(self, message):
+        """Queue a packed OpenFlow message. It can be called from any thread.
+
+        Args:
+                message (bytes): packed OpenFlow message
+        """
+
+        with self._cond:
+            if self._closed:
+                logging.error("OF message discarded, the connection with the controller is closed")
+                return
+
+            full = self._queue(message)
+            if full or len(self._buffers) == 1:
+                self._cond.notify()
+
+    def flush(self):
+        """Send the queued messages without waiting for the latency budget"""
+
+        with self._cond:
+            # With nothing queued the flag would skip the coalescing of the
+            # next message
+            if not self._buffers:
+                return
+
+            self._flushNow = True
+            self._cond.notify()
+
+    def close(self):
+        """Send the queued messages and stop the writer thread"""
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._buffers and not self._closed:
+                    self._cond.wait()
+
+                if not self._buffers:
+                    return
+
+                # Wait for more messages until a budget is reached
+                deadline = time.monotonic() + self.max_delay
+                while self._pending < self.max_bytes and not self._flushNow and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                self._flushNow = False
+                buffers = self._take()
+
+            try:
+                self._sendv(buffers)
+            except OSError as e:
+                logging.error("Error sending OF messages to the controller: %s", e)
+                with self._cond:
+                    self._closed = True
+                    self._buffers = []
+                    self._pending = 0
+                return
+
+    def _sendv(self, buffers):
+        """Send every buffer, continuing after short writes"""
+
+        if not hasattr(self.sock, "sendmsg"):
+            self.sock.sendall(b''.join(buffers))
+            return
+
+        views = [memoryview(buf) for buf in buffers]
+        first = 0
+
+        while first < len(views):
+            sent = self.sock.sendmsg(views[first:first + IOV_MAX])
+
+            # Skip the buffers already sent
+            while sent > 0:
+                size = len(views[first])
+                if sent >= size:
+                    sent -= size
+                    first += 1
+                else:
+                    views[first] = views[first][sent:]
+                    sent = 0
+
+class StreamOFWriter(OFWriter):
+    """OFWriter over an asyncio StreamWriter. Every method must be called
+        from the event loop thread. The coalesced messages are handed to the
+        transport with a single writelines call.
+    """
+
+    def __init__(self, loop, stream, max_bytes = 65536, max_delay = 0.001):
+        """Initialize variables:
+                loop (asyncio.AbstractEventLoop): loop serving the stream
+                stream (asyncio.StreamWriter): controller connection
+                max_bytes (int): queued bytes that force a write
+                max_delay (float): maximum seconds a message waits on the queue
+        """
+
+        super().__init__(max_bytes, max_delay)
+
+        self.loop = loop
+        self.stream = stream
+        self._timer = None
+
+        sock = stream.get_extra_info("socket")
+        if sock is not None:
+            self._set_nodelay(sock)
+
+    def write(self, message):
+        """Queue a packed OpenFlow message.
+
+        Args:
+                message (bytes): packed OpenFlow message
+        """
+
+        if self._queue(message):
+            self.flush()
+        elif self._timer is None:
+            self._timer = self.loop.call_later(self.max_delay, self.flush)
+
+    def flush(self):
+        """Send the queued messages"""
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if not self._buffers:
+            return
+
+        self.stream.writelines(self._take())
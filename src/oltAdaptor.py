@@ -18,6 +18,7 @@
 import logging
 import grpc
 import random
+import threading
 from voltha_protos import openolt_pb2_grpc
 from voltha_protos import openolt_pb2
 from voltha_protos import tech_profile_pb2_grpc
@@ -26,6 +27,9 @@ from voltha_protos import tech_profile_pb2
 # Local imports
 import src.agentQueue
 from src.agentQueue import oltQueue
+from src.indicationDemux import indicationDemux
+from src.oltChannel import AioOLTChannel, INDICATION_RETRY_FIRST, INDICATION_RETRY_MAX
+from src.rpcPolicy import RpcPolicy
 import external.omci.omci as omci
 from external.omci.omci_defs import OmciNullPointer
 
@@ -35,33 +39,51 @@ class OLTadaptor:
             Configures the network
     """
 
-    def __init__(self, ip_address = "0.0.0.0", port = 9191):
+    def __init__(self, ip_address = "0.0.0.0", port = 9191, agentLoop = None, rpc = None):
         """Initialize variables:
                 ip_address (string): OLT IP
                 port: connection port
+                agentLoop (AgentLoop): shared event loop for a grpc.aio
+                                       channel, None for a blocking channel
+                rpc (dict): RpcPolicy arguments (deadlines, retries, etc)
         """
 
         self.ip_address = ip_address
         self.port = port
 
         # Create the RPC channel
-        self.channel = grpc.insecure_channel(f"{self.ip_address}:{self.port}")
-        # Connect with the OLT
-        self.stub = openolt_pb2_grpc.OpenoltStub(self.channel)
+        if agentLoop is not None:
+            self.aio = AioOLTChannel(agentLoop, self.ip_address, self.port)
+            self.channel = self.aio.channel
+            self.stub = self.aio.stub
+        else:
+            self.aio = None
+            self.channel = grpc.insecure_channel(f"{self.ip_address}:{self.port}")
+            # Connect with the OLT
+            self.stub = openolt_pb2_grpc.OpenoltStub(self.channel)
+        self.indications = None # EnableIndication stream, or its task future with grpc.aio
+        self._closing = threading.Event() # Set by olt_disconnect, the stream is not reopened
+        self.rpcPolicy = RpcPolicy(f"{self.ip_address}:{self.port}", **(rpc or {}))
 
         # Initilice dicts
-        self.omci_queues = {} # Used for ONUs OMCI responds: key(TCI) value(array(intf_id, onu_id, OMCImsg))
+        self.omci_queues = {} # Used for ONUs OMCI responds: key(intf_id, onu_id, TCI) value(array(intf_id, onu_id, OMCImsg))
         self._omci_mibs = {} # ONU MIB map: key(intf_id, onu_id) value(class OnuMIB)
 
-    def olt_connect(self):
+    def olt_connect(self, timeout = None):
         try:
-            device_info = self.stub.GetDeviceInfo(openolt_pb2.Empty())
+            # The bring-up has its own retries
+            device_info = self._rpc("GetDeviceInfo", openolt_pb2.Empty(), timeout = timeout, retry = False)
         except grpc.RpcError as e:
             status_code = e.code()
             logging.error("RPC ERROR recived on OLT %s:%d | %s | Details: %s",
                           self.ip_address, self.port, status_code.name, e.details())
             return False
 
+        self._set_device_info(device_info)
+
+        return True
+
+    def _set_device_info(self, device_info):
         self.vendor = device_info.vendor
         self.model = device_info.model
         self.hw_version = device_info.hardware_version
@@ -79,14 +101,39 @@ class OLTadaptor:
         self.flow_id_start = device_info.flow_id_start
         self.flow_id_end = device_info.flow_id_end
 
-        return True
+    def _rpc(self, method, request, timeout = None, retry = True):
+        """Send an RPC to the OLT with the deadline, retries and circuit
+            breaker of its RpcPolicy. Raises grpc.RpcError.
+        """
+
+        return self.rpcPolicy.call(self.stub, method, request, timeout, retry)
+
+    def _rpc_future(self, method, request, timeout = None):
+        """Start an RPC to the OLT without waiting for it, see
+            RpcPolicy.call_future.
+        """
+
+        return self.rpcPolicy.call_future(self.stub, method, request, timeout)
+
+    def olt_disconnect(self):
+        """Cancel the indications stream and close the RPC channel"""
+
+        self._closing.set()
+        indicationDemux.remove(self)
+        if self.indications is not None:
+            self.indications.cancel()
+
+        if self.aio is not None:
+            self.aio.close()
+        else:
+            self.channel.close()
 
     def activate_onu(self, onu_id, intf_id, vendor_id, vendor_specific):
         serial_number = openolt_pb2.SerialNumber(vendor_id = vendor_id, vendor_specific = vendor_specific)
         onu = openolt_pb2.Onu(intf_id = intf_id, onu_id = onu_id, serial_number = serial_number)
 
         try:
-            self.stub.ActivateOnu(onu)
+            self._rpc("ActivateOnu", onu)
         except grpc.RpcError as e:
             status_code = e.code()
             logging.error("RPC ERROR recived on OLT %s:%d | %s | Details: %s",
@@ -94,7 +141,7 @@ class OLTadaptor:
 
     def flow_add(self, flow):
         try:
-            self.stub.FlowAdd(flow)
+            self._rpc("FlowAdd", flow)
         except grpc.RpcError as e:
             status_code = e.code()
             logging.error("RPC ERROR recived on OLT %s:%d | %s | Details: %s",
@@ -105,7 +152,7 @@ class OLTadaptor:
 
     def flow_remove(self, flow):
         try:
-            self.stub.FlowRemove(flow)
+            self._rpc("FlowRemove", flow)
         except grpc.RpcError as e:
             status_code = e.code()
             logging.error("RPC ERROR recived on OLT %s:%d | %s | Details: %s",
@@ -116,7 +163,7 @@ class OLTadaptor:
 
     def group_perform(self, group):
         try:
-            self.stub.PerformGroupOperation(group)
+            self._rpc("PerformGroupOperation", group)
         except grpc.RpcError as e:
             status_code = e.code()
             logging.error("RPC ERROR recived on OLT %s:%d | %s | Details: %s",
@@ -127,7 +174,7 @@ class OLTadaptor:
 
     def group_remove(self, group):
         try:
-            self.stub.DeleteGroup(group)
+            self._rpc("DeleteGroup", group)
         except grpc.RpcError as e:
             status_code = e.code()
             logging.error("RPC ERROR recived on OLT %s:%d | %s | Details: %s",
@@ -138,7 +185,7 @@ class OLTadaptor:
 
     def create_traffic_schedulers(self, trafficScheds):
         try:
-            self.stub.CreateTrafficSchedulers(trafficScheds)
+            self._rpc("CreateTrafficSchedulers", trafficScheds)
         except grpc.RpcError as e:
             status_code = e.code()
             logging.error("RPC ERROR recived on OLT %s:%d | %s | Details: %s",
@@ -149,7 +196,7 @@ class OLTadaptor:
 
     def remove_traffic_schedulers(self, trafficScheds):
         try:
-            self.stub.RemoveTrafficSchedulers(trafficScheds)
+            self._rpc("RemoveTrafficSchedulers", trafficScheds)
         except grpc.RpcError as e:
             status_code = e.code()
             logging.error("RPC ERROR recived on OLT %s:%d | %s | Details: %s",
@@ -160,7 +207,7 @@ class OLTadaptor:
 
     def create_traffic_queues(self, trafficQueues):
         try:
-            self.stub.CreateTrafficQueues(trafficQueues)
+            self._rpc("CreateTrafficQueues", trafficQueues)
         except grpc.RpcError as e:
             status_code = e.code()
             logging.error("RPC ERROR recived on OLT %s:%d | %s | Details: %s",
@@ -171,7 +218,7 @@ class OLTadaptor:
 
     def remove_traffic_queues(self, trafficQueues):
         try:
-            self.stub.RemoveTrafficQueues(trafficQueues)
+            self._rpc("RemoveTrafficQueues", trafficQueues)
         except grpc.RpcError as e:
             status_code = e.code()
             logging.error("RPC ERROR recived on OLT %s:%d | %s | Details: %s",
@@ -261,9 +308,13 @@ class OLTadaptor:
     def enable_indications(self, datapath_id):
         """This function subscribes the program to the OLT indications,
             once the connection is stablished, there is a bucle to keep
-            listening the indications.
+            listening the indications. When the stream is lost the OLT is
+            probed until it answers, the stream is opened again and the
+            OLT is resynced (see indications_resumed).
             
-            This function must be call throught a thread.
+            This function must be call throught a thread, except with a
+            grpc.aio channel: the stream is then read on the event loop and
+            the function returns at once.
 
         Args:
                 datapath_id (string): The identifier of the OLT, to put the
@@ -271,24 +322,91 @@ class OLTadaptor:
         """
 
         self.queue_id = datapath_id
-        indications = self.stub.EnableIndication(openolt_pb2.Empty())
 
-        # Bucle
-        while True:
-            try:
-                ind = next(indications)
-            except Exception as e:
-                logging.error("gRPC connection lost")
+        if self.aio is not None:
+            self.indications = self.aio.start_indications(self.handle_indication, self.indications_resumed,
+                                                          self.rpcPolicy.deadline("GetDeviceInfo"))
+            return
+
+        while not self._closing.is_set():
+            self.indications = indications = self.stub.EnableIndication(openolt_pb2.Empty())
+
+            # Bucle
+            while True:
+                try:
+                    ind = next(indications)
+                except Exception as e:
+                    break
+                else:
+                    self.handle_indication(ind)
+
+            if self._closing.is_set():
                 break
-            else:
-                if ind.HasField('onu_disc_ind'):
-                    self.onu_discovery(ind.onu_disc_ind)
-                elif ind.HasField('onu_ind'):
-                    self.onu_indication(ind.onu_ind)
-                elif ind.HasField('omci_ind'):
-                    self.omci_indication(ind.omci_ind)
-                elif ind.HasField('flow_stats'):
-                    self.flowStats_indication(ind.flow_stats)
+
+            logging.error("gRPC connection lost with OLT %s:%d", self.ip_address, self.port)
+            device_info = self.wait_olt()
+            if device_info is not None:
+                self.indications_resumed(device_info)
+
+    def wait_olt(self):
+        """Probe the OLT with backoff until it answers GetDeviceInfo, through
+            the circuit breaker of its RpcPolicy.
+
+        Return:
+            The DeviceInfo of the OLT, None if the adaptor is closed first.
+        """
+
+        delay = INDICATION_RETRY_FIRST
+        while not self._closing.wait(delay):
+            try:
+                return self._rpc("GetDeviceInfo", openolt_pb2.Empty(), retry = False)
+            except grpc.RpcError as e:
+                logging.error("OLT %s:%d does not respond (%s), retrying in %d s", self.ip_address, self.port,
+                              e.code().name, min(2 * delay, INDICATION_RETRY_MAX))
+            delay = min(2 * delay, INDICATION_RETRY_MAX)
+
+        return None
+
+    def indications_resumed(self, device_info):
+        """The OLT answers again after losing the indication stream. It is
+            called from the stream thread or the event loop, so it must not
+            block.
+
+        Args:
+                device_info (DeviceInfo): GetDeviceInfo answer of the OLT
+        """
+
+        if device_info.device_id != self.device_id:
+            logging.error("OLT %s:%d answers with device ID %s instead of %s", self.ip_address, self.port,
+                          device_info.device_id, self.device_id)
+        self._set_device_info(device_info)
+
+        # The probe of the asyncio channel bypasses the circuit breaker, the
+        # OLT is healthy again
+        if self.aio is not None:
+            self.rpcPolicy.breaker.record_success()
+
+        logging.info("Indications of OLT %s:%d resumed", self.ip_address, self.port)
+        self.resync()
+
+    def resync(self):
+        """Bring the OLT back in line with the agent after the indication
+            stream is resumed, nothing to do here
+        """
+        pass
+
+    def handle_indication(self, ind):
+        """Hand an indication of the OLT off to its lane (OMCI, stats or
+            control), see src.indicationDemux. It does not block, so it
+            can run on the event loop.
+        """
+
+        indicationDemux.dispatch(self, ind)
+
+    def closed(self):
+        """Check if the adaptor has been disconnected by olt_disconnect"""
+
+        return self._closing.is_set()
 
     # INDICATIONS FUNCTIONS
     def onu_discovery(self, onuDisc):
@@ -319,36 +437,35 @@ class OLTadaptor:
         item = src.agentQueue.QueueItem(self.queue_id, "olt", data)
         oltQueue.put(item)
 
-    def flowStats_indication(self, flowStats):
-        """FLOW stats indication"""
+    def flowStats_indications(self, flowStats):
+        """FLOW stats indications, already merged per flow by the stats lane
 
-        logging.info("FLOW stats received:")
-        logging.info("****OLT ID: %s", self.queue_id)
-        logging.info("****Flow ID: %d", flowStats.flow_id)
-        logging.info("****RX bytes: %d", flowStats.rx_bytes)
-        logging.info("****RX packets: %d", flowStats.rx_packets)
-        logging.info("****TX bytes: %d", flowStats.tx_bytes)
-        logging.info("****TX packets: %d", flowStats.tx_packets)
-        logging.info("****Timestamp: %d", flowStats.timestamp)
-
-        data = src.agentQueue.FlowStatsInd(flowStats.flow_id,
-                                           flowStats.rx_bytes,
-                                           flowStats.rx_packets,
-                                           flowStats.tx_bytes,
-                                           flowStats.tx_packets,
-                                           flowStats.timestamp)
-        item = src.agentQueue.QueueItem(self.queue_id, "olt", data)
-        oltQueue.put(item)
+        Args:
+                flowStats (list): src.agentQueue.FlowStatsInd of the flows
+        """
+
+        # Received in bursts, only logged when debugging
+        logging.debug("FLOW stats received:")
+        logging.debug("****OLT ID: %s", self.queue_id)
+        logging.debug("****Flows: %d", len(flowStats))
+
+        oltQueue.put_many([src.agentQueue.QueueItem(self.queue_id, "olt", data) for data in flowStats])
 
     def omci_indication(self, omciInd):
         """OMCI Indication"""
 
+        if oltQueue.journal is not None:
+            oltQueue.journal.record_omci(self.queue_id, omciInd.intf_id, omciInd.onu_id, omciInd.pkt)
+
         msg = omci.OmciFrame(omciInd.pkt[:44])
 
-        tci = msg.getfieldval("transaction_id")
-        if tci in self.omci_queues:
+        # Several ONUs are configured at the same time, the TCI is only
+        # unique per ONU
+        key = (omciInd.intf_id, omciInd.onu_id, msg.getfieldval("transaction_id"))
+        result_queue = self.omci_queues.get(key)
+        if result_queue is not None:
             item = (omciInd.intf_id, omciInd.onu_id, msg)
-            self.omci_queues[tci].put(item)
+            result_queue.put(item)
         else:
             pass
             #msg.show()
@@ -369,7 +486,8 @@ class OLTadaptor:
         # Create the queue for OMCI respond
         result_queue = src.agentQueue.queue.Queue()
         # Include the queue on the OMCI queues map
-        self.omci_queues[tci] = result_queue
+        key = (intf_id, onu_id, tci)
+        self.omci_queues[key] = result_queue
 
         # Generate the message for RPC communication
         packet = msg.build().hex()
@@ -380,12 +498,12 @@ class OLTadaptor:
         while retries < 6:
             try:
                 # Send the message
-                self.stub.OmciMsgOut(pkt)
+                self._rpc("OmciMsgOut", pkt)
             except grpc.RpcError as e:
                 status_code = e.code()
                 logging.error("RPC ERROR recived on OLT %s:%d | %s | Details: %s",
                               self.ip_address, self.port, status_code.name, e.details())
-                self.omci_queues.pop(tci)
+                self.omci_queues.pop(key, None)
                 return None
 
             # Retrieve the response from the Queue
@@ -395,7 +513,7 @@ class OLTadaptor:
                 retries += 1
                 continue
             else:
-                self.omci_queues.pop(tci)
+                self.omci_queues.pop(key, None)
 
                 # Check if the message is correct and return the message
                 if (result_msg[0] != intf_id or result_msg[1] != onu_id):
@@ -411,9 +529,28 @@ class OLTadaptor:
 
                 return omci_msg
 
-        self.omci_queues.pop(tci)
+        self.omci_queues.pop(key, None)
         return None
 
+    def omci_onu_configured(self, intf_id, onu_id):
+        """Check if the ONU keeps the configuration of the agent: its MIB is
+            known and the ONU still answers for the MAC bridge service
+            profile created by omci_onu_initialize.
+        """
+
+        mib_key = (intf_id, onu_id)
+        if mib_key not in self._omci_mibs:
+            return False
+
+        bridges = self._omci_mibs[mib_key].get_entity_ids(omci.MacBridgeServiceProfile.class_id)
+        if len(bridges) == 0:
+            return False
+
+        data = self.omci_update_entity_values(intf_id, onu_id, omci.MacBridgeServiceProfile, bridges[0],
+                                              ("spanning_tree_ind",))
+
+        return data is not None
+
     def omci_mib_reset(self, intf_id, onu_id):
         tci = random.randint(0, 32767)
         msg = omci.OmciFrame(
@@ -0,0 +1,159 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import asyncio
+import logging
+import grpc
+from voltha_protos import openolt_pb2_grpc
+from voltha_protos import openolt_pb2
+
+# Seconds before probing an OLT whose indication stream is lost, doubled on
+# each failed probe up to the maximum
+INDICATION_RETRY_FIRST = 1
+INDICATION_RETRY_MAX = 30
+
+class AioOLTChannel:
+    """gRPC connection of one OLT served by the shared AgentLoop.
+
+        The channel is a grpc.aio channel living on the event loop, so the
+        RPCs of every ONU lane of the OLT are multiplexed on it without
+        waiting for each other, and the EnableIndication stream of every
+        OLT is read by a task of the same loop instead of a thread each.
+    """
+
+    def __init__(self, agentLoop, ip_address, port):
+        """Initialize variables:
+                agentLoop (AgentLoop): event loop shared by every OLT
+                ip_address (string): OLT IP
+                port: connection port
+        """
+
+        self.agentLoop = agentLoop
+        self.target = f"{ip_address}:{port}"
+
+        # grpc.aio binds the channel to the loop where it is created
+        self.channel, self._stub = agentLoop.submit(self._open()).result()
+        self.stub = BlockingStub(self)
+
+    async def _open(self):
+        channel = grpc.aio.insecure_channel(self.target)
+        return channel, openolt_pb2_grpc.OpenoltStub(channel)
+
+    def call(self, method, request, timeout = None):
+        """Start an RPC on the event loop. It can be called from any thread.
+
+        Return:
+            concurrent.futures.Future with the RPC response, a failed RPC
+            raises grpc.RpcError (grpc.aio.AioRpcError).
+
+        Args:
+                method (string): Openolt RPC name (FlowAdd, OmciMsgOut, etc)
+                request (message): RPC request
+                timeout (float): RPC deadline in seconds
+        """
+
+        return self.agentLoop.submit(self._call(method, request, timeout))
+
+    async def _call(self, method, request, timeout):
+        return await getattr(self._stub, method)(request, timeout = timeout)
+
+    def start_indications(self, handler, resumed, timeout = None):
+        """Read the EnableIndication stream on the event loop. When the
+            stream is lost, the OLT is probed with GetDeviceInfo until it
+            answers and the stream is opened again.
+
+        Return:
+            concurrent.futures.Future of the reading task, cancel it to
+            close the stream.
+
+        Args:
+                handler (callable): called on the loop with every indication,
+                                    it must not block
+                resumed (callable): called on the loop with the DeviceInfo
+                                    of the OLT when the stream is opened
+                                    again, it must not block
+                timeout (float): deadline of the GetDeviceInfo probes
+        """
+
+        return self.agentLoop.submit(self._read_indications(handler, resumed, timeout))
+
+    async def _read_indications(self, handler, resumed, timeout):
+        while True:
+            call = self._stub.EnableIndication(openolt_pb2.Empty())
+
+            try:
+                async for ind in call:
+                    try:
+                        handler(ind)
+                    except Exception:
+                        logging.exception("Error handling indication of OLT %s", self.target)
+            except grpc.RpcError:
+                pass
+            finally:
+                call.cancel()
+
+            logging.error("gRPC connection lost with OLT %s", self.target)
+            device_info = await self._wait_olt(timeout)
+
+            try:
+                resumed(device_info)
+            except Exception:
+                logging.exception("Error resuming the indications of OLT %s", self.target)
+
+    async def _wait_olt(self, timeout):
+        """Probe the OLT with backoff until it answers GetDeviceInfo"""
+
+        delay = INDICATION_RETRY_FIRST
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                return await self._call("GetDeviceInfo", openolt_pb2.Empty(), timeout)
+            except grpc.RpcError as e:
+                logging.error("OLT %s does not respond (%s), retrying in %d s",
+                              self.target, e.code().name, min(2 * delay, INDICATION_RETRY_MAX))
+            delay = min(2 * delay, INDICATION_RETRY_MAX)
+
+    def close(self):
+        """Close the channel, cancelling the RPCs in progress"""
+
+        self.agentLoop.submit(self.channel.close()).result()
+
+class BlockingStub:
+    """Openolt stub for the worker threads: each RPC runs on the event loop
+        while the calling thread waits for its response, so several threads
+        can have RPCs in flight on the same channel.
+    """
+
+    def __init__(self, aioChannel):
+        self._aioChannel = aioChannel
+
+    def __getattr__(self, method):
+        aioChannel = self._aioChannel
+
+        def rpc(request, timeout = None):
+            if aioChannel.agentLoop.in_loop():
+                raise RuntimeError("Blocking RPC %s called from the event loop" % method)
+
+            return aioChannel.call(method, request, timeout).result()
+
+        def future(request, timeout = None):
+            return aioChannel.call(method, request, timeout)
+
+        # Same interface as the grpc stubs: stub.Method.future(request)
+        rpc.future = future
+
+        return rpc
@@ -46,7 +46,10 @@ import logging
 import json
 import os.path
 
+import src.agentQueue
 from src.oltAdaptor import OLTadaptor
+from src.keyedExecutor import KeyedExecutor
+from src.rpcPipeline import RpcPipeline
 from external.omci.omci_entities import *
 from external.omci.omci_defs import *
 from src.onosAdaptor import ONOSAdaptor
@@ -57,8 +60,9 @@ from voltha_protos import openolt_pb2
 
 class OLTDevice(OLTadaptor):
 
-    def __init__(self, ip_address = "0.0.0.0", port = 9191, voip_extensions_start = 1111, voip_extensions_end = 9999):
-        super().__init__(ip_address, port)
+    def __init__(self, ip_address = "0.0.0.0", port = 9191, voip_extensions_start = 1111, voip_extensions_end = 9999,
+                 onu_workers = 8, agentLoop = None, rpc = None):
+        super().__init__(ip_address, port, agentLoop, rpc)
 
         self.n_buffers = 256
         self.n_tables = 2
@@ -82,15 +86,91 @@ class OLTDevice(OLTadaptor):
 
         self.flow_ids_to_hash = {} # dict(key(hash_flow_id), values(list(flow_ids)))
 
-    def generate(self):
-        if (super().olt_connect()):
+        # The work of different ONUs runs in parallel, ordered per ONU
+        self.executor = KeyedExecutor(max_workers = onu_workers, name = "olt-%s" % ip_address)
+        self.lock = threading.RLock() # onus, net_gemports, olt_services and flow_ids_to_hash
+        self.onuLocks = {} # dict(key(intf_id, onu_id), value(RLock))
+        self.resyncPending = set() # (intf_id, onu_id) waiting for the resync of the OLT
+
+        self.controller = None # ONOSAdaptor, set by enable_controller
+
+    def generate(self, timeout = None):
+        if (super().olt_connect(timeout)):
             self.datapath_id = "00:00:" + self.device_id
         else:
             self.datapath_id = ""
 
         return self.datapath_id
 
+    def shutdown(self):
+        """Disconnect the OLT from the controller and stop its indications.
+            The services already installed on the OLT are kept.
+        """
+
+        if self.controller is not None:
+            self.controller.disconnect()
+        super().olt_disconnect()
+        self.executor.shutdown(wait = False)
+
+    def resync(self):
+        """Send the installed services again after the indication stream is
+            resumed, each one on the lane of its ONU. The OLT answers
+            ALREADY_EXISTS for what it kept, so only the state lost by an
+            OLT restart is installed again, without any OMCI. An ONU the
+            OLT activates again before its task runs is resynced by
+            create_ports, and the task skips it.
+        """
+
+        with self.lock:
+            onus = set((key[0], key[1]) for key, value in self.olt_services.items()
+                       if value[0] is not None or value[1] is not None)
+            self.resyncPending.update(onus)
+
+        for intf_id, onu_id in onus:
+            self.executor.submit((intf_id, onu_id), self.resync_pending, intf_id, onu_id)
+
+    def resync_pending(self, intf_id, onu_id):
+        """Resync the services of an ONU if the OLT resync still waits for it"""
+
+        with self.lock:
+            if (intf_id, onu_id) not in self.resyncPending:
+                return
+            self.resyncPending.discard((intf_id, onu_id))
+
+        self.resync_services(intf_id, onu_id)
+
+    def resync_services(self, intf_id, onu_id):
+        """Send again the OLT part (schedulers, queues, flows and groups) of
+            the services installed on an ONU. The multicast services use
+            the ONU (0, 0).
+        """
+
+        with self.onu_lock(intf_id, onu_id):
+            with self.lock:
+                services = [(key, value) for key, value in self.olt_services.items()
+                            if key[0] == intf_id and key[1] == onu_id]
+
+            for service_key, (dw_flow_id, up_flow_id, service) in services:
+                if service_key[3] == "multicast":
+                    if dw_flow_id is None:
+                        continue
+                    pipeline = self.multicast_pipeline(service, dw_flow_id)
+                elif dw_flow_id is None and up_flow_id is None:
+                    continue
+                else:
+                    pipeline = self.service_pipeline(service, dw_flow_id, up_flow_id)
+
+                if pipeline.run(resync = True):
+                    logging.info("Service %s resynced on OLT %s", service_key, self.datapath_id)
+                else:
+                    logging.error("Service %s not resynced on OLT %s", service_key, self.datapath_id)
+
     def enable_olt(self):
+        if self.aio is not None:
+            # The indications are read on the shared event loop
+            super().enable_indications(self.datapath_id)
+            return
+
         th = threading.Thread(target = super().enable_indications, args=(self.datapath_id,), daemon = True)
         th.start()
 
@@ -113,15 +193,104 @@ class OLTDevice(OLTadaptor):
 
         return capabilities
 
-    def enable_controller(self, ipONOS, portONOS):
-        self.controller = ONOSAdaptor(ipONOS, portONOS)
-        self.controller.connect()
-        self.controller.OFPT_HELLO_msg()
+    def enable_controller(self, ipONOS, portONOS, engine = None, write_max_bytes = 65536, write_max_delay = 0.001,
+                          timeout = None):
+        """Connect the OLT with the OpenFlow controller.
+
+        Args:
+                ipONOS (string): controller IP address
+                portONOS (int): controller port
+                engine (~src.ofEngine.OFChannelEngine): engine serving the
+                        OpenFlow channel. If it is None, the channel is served
+                        by a dedicated blocking thread.
+                write_max_bytes (int): queued bytes that force a write to the controller
+                write_max_delay (float): maximum seconds an OF message waits to be coalesced
+                timeout (float): seconds to wait for the connection, it raises
+                        OSError or TimeoutError when it can not be established
+        """
+
+        self.controller = ONOSAdaptor(ipONOS, portONOS, write_max_bytes, write_max_delay)
         capabilities = self.generate_capabilities()
+        session = (self.datapath_id, self.n_buffers, self.n_tables, self.auxiliary_id, capabilities,
+                   self.hw_version, self.fw_version, self.serial_num)
 
-        th = threading.Thread(target = self.controller.recieve_packets, args=(self.datapath_id, self.n_buffers, self.n_tables, self.auxiliary_id, capabilities, self.hw_version, self.fw_version, self.serial_num), daemon = True)
+        if engine is not None:
+            engine.open_channel(self.controller, session, timeout)
+            return
+
+        self.controller.connect(timeout)
+        self.controller.OFPT_HELLO_msg()
+
+        th = threading.Thread(target = self.controller.recieve_packets, args=session, daemon = True)
         th.start()
 
+    def onu_lock(self, intf_id, onu_id):
+        """Lock held while the services of an ONU are installed or removed.
+            The multicast services use the ONU (0, 0).
+        """
+
+        with self.lock:
+            lock = self.onuLocks.get((intf_id, onu_id))
+            if lock is None:
+                lock = self.onuLocks[(intf_id, onu_id)] = threading.RLock()
+
+        return lock
+
+    def item_key(self, item):
+        """Key of the ONU affected by a queue item, the items with the same
+            key are handled in order. None for the items of no known ONU
+            (e.g. flow stats): their lane is not a barrier and runs beside
+            the ONU lanes, so they must not configure an ONU.
+        """
+
+        if item.kind == src.agentQueue.ONU_IND:
+            return (item.data.intf_id, item.data.onu_id)
+        elif item.kind == src.agentQueue.ONU_DISC:
+            # Same lane as the ONU indications of the discovered ONU
+            onu_sn = item.data.vendor_id.decode("utf-8") + item.data.vendor_specific.hex()[:8]
+            return (item.data.intf_id, self.get_onu_id(item.data.intf_id, onu_sn))
+        elif item.kind == src.agentQueue.FLOW:
+            return self.flow_onu(item.data.flow_id)
+
+        return None
+
+    def flow_onu(self, flow_id):
+        """Get the (intf_id, onu_id) of the service of a Flow: the ONU of its
+            UNI port, following the links of a downstream Flow up to the one
+            with the output port. (0, 0) for multicast, as onu_lock. None
+            while the Flow does not lead to a single ONU.
+        """
+
+        listF = self.controller.listF
+        with listF.lock:
+            flow = listF.getFlow(flow_id)
+            visited = set()
+            while flow is not None and flow["flowId"] not in visited:
+                visited.add(flow["flowId"])
+                instructions = flow["instructions"]
+
+                if flow["flowType"] == "upstream":
+                    port_no = flow["match"].get("inPort")
+                    break
+                if "groupId" in instructions:
+                    return (0, 0)
+                if "outPort" in instructions:
+                    port_no = instructions["outPort"]
+                    break
+                if "gotoTable" not in instructions:
+                    return None
+
+                linked = listF.get_linked_flows(flow, instructions["gotoTable"])
+                flow = linked[0] if len(linked) == 1 else None
+            else:
+                return None
+
+        if port_no is None:
+            return None
+
+        intf_id, onu_id, _, _ = self.portNo_to_onu(port_no)
+        return (intf_id, onu_id)
+
     def initialize_onu(self, intf_id, vendor_id, vendor_specific):
         onu_sn = vendor_id.decode("utf-8") + vendor_specific.hex()[:8]
         onu_id = self.get_onu_id(intf_id, onu_sn)
@@ -274,10 +443,41 @@ class OLTDevice(OLTadaptor):
             service.generate_upstream_classifier(o_vid = c_tag, tag_type = "single_tag")
             service.generate_upstream_action(o_vid = s_tag, cmds = up_cmds)
 
-        self.olt_services[service_key] = (cf_dw_flow, cf_up_flow, service)
+        with self.lock:
+            self.olt_services[service_key] = (cf_dw_flow, cf_up_flow, service)
 
         return service_key
 
+    def service_pipeline(self, service, dw_flow_id = None, up_flow_id = None):
+        """RPC pipeline installing a unicast service (Internet or VoIP): the
+            schedulers, queues and flows of both directions are sent
+            together, each kind once the previous one is installed.
+        """
+
+        schedulers = []
+        queues = []
+        flows = []
+        symmetricFlows = []
+        dw_flow = None
+
+        if dw_flow_id is not None:
+            schedulers.append(("CreateTrafficSchedulers", service.get_downstream_trafficSchedulers()))
+            queues.append(("CreateTrafficQueues", service.get_downstream_trafficQueues()))
+            dw_flow = service.generate_downstream_flow(dw_flow_id)
+            flows.append(("FlowAdd", dw_flow))
+
+        if up_flow_id is not None:
+            schedulers.append(("CreateTrafficSchedulers", service.get_upstream_trafficSchedulers()))
+            queues.append(("CreateTrafficQueues", service.get_upstream_trafficQueues()))
+            up_flow = service.generate_upstream_flow(up_flow_id)
+            if dw_flow is not None and up_flow is not None and up_flow.symmetric_flow_id == dw_flow.flow_id:
+                # The OLT looks up the symmetric flow, it must be installed first
+                symmetricFlows.append(("FlowAdd", up_flow))
+            else:
+                flows.append(("FlowAdd", up_flow))
+
+        return RpcPipeline(self).stage(*schedulers).stage(*queues).stage(*flows).stage(*symmetricFlows)
+
     def install_VoipService (self, service_key, up_flow_id = None, dw_flow_id = None):
         cf_dw_flow, cf_up_flow, service = self.olt_services[service_key]
         direction = ""
@@ -288,58 +488,16 @@ class OLTDevice(OLTadaptor):
                 return False
             direction = "downstream"
 
-            # Install TrafficSchedulers
-            schedulers = service.get_downstream_trafficSchedulers()
-            check = super().create_traffic_schedulers(schedulers)
-            if not check:
-                super().remove_traffic_schedulers(schedulers)
-                return False
-
-            # Install Queues
-            dwQueues = service.get_downstream_trafficQueues()
-            check = super().create_traffic_queues(dwQueues)
-            if not check:
-                super().remove_traffic_queues(dwQueues)
-                super().remove_traffic_schedulers(schedulers)
-                return False
-            # Install Flows
-            dw_flow = service.generate_downstream_flow(dw_flow_id)
-            check = super().flow_add(dw_flow)
-            if not check:
-                super().flow_remove(dw_flow)
-                super().remove_traffic_queues(dwQueues)
-                super().remove_traffic_schedulers(schedulers)
-                return False
-
         # Upstream Service
         if up_flow_id is not None:
             if cf_up_flow is not None:
                 return False
             direction = "upstream" if direction == "" else "bidirectional"
 
-            # Install TrafficSchedulers
-            schedulers = service.get_upstream_trafficSchedulers()
-            check = super().create_traffic_schedulers(schedulers)
-            if not check:
-                super().remove_traffic_schedulers(schedulers)
-                return False
-
-            # Install Queues
-            upQueues = service.get_upstream_trafficQueues()
-            check = super().create_traffic_queues(upQueues)
-            if not check:
-                super().remove_traffic_queues(dwQueues)
-                super().remove_traffic_schedulers(schedulers)
-                return False
-
-            # Install Flows
-            up_flow = service.generate_upstream_flow(up_flow_id)
-            check = super().flow_add(up_flow)
-            if not check:
-                super().flow_remove(up_flow)
-                super().remove_traffic_queues(upQueues)
-                super().remove_traffic_schedulers(schedulers)
-                return False
+        # Install TrafficSchedulers, Queues and Flows
+        check = self.service_pipeline(service, dw_flow_id, up_flow_id).run()
+        if not check:
+            return False
 
         if not cf_dw_flow and not cf_up_flow:
             install = True
@@ -354,7 +512,8 @@ class OLTDevice(OLTadaptor):
         if not up_flow_id:
             up_flow_id = cf_up_flow
 
-        self.olt_services[service_key] = (dw_flow_id, up_flow_id, service)
+        with self.lock:
+            self.olt_services[service_key] = (dw_flow_id, up_flow_id, service)
 
         return True
 
@@ -416,13 +575,15 @@ class OLTDevice(OLTadaptor):
             delete = True
         else:
             delete = False
-            self.olt_services[service_key] = (cf_dw_flow, cf_up_flow, service)
+            with self.lock:
+                self.olt_services[service_key] = (cf_dw_flow, cf_up_flow, service)
 
         check = self.omci_remove_VoipService(service_key, direction, delete)
 
         if not cf_dw_flow and not cf_up_flow:
             self.free_gemport(service.gemport_id, service.intf_id)
-            self.olt_services.pop(service_key)
+            with self.lock:
+                self.olt_services.pop(service_key)
 
         return True
 
@@ -807,7 +968,8 @@ class OLTDevice(OLTadaptor):
             service.generate_upstream_classifier(o_vid = c_tag, tag_type = "single_tag")
             service.generate_upstream_action(o_vid = s_tag, cmds = up_cmds)
 
-        self.olt_services[service_key] = (cf_dw_flow, cf_up_flow, service)
+        with self.lock:
+            self.olt_services[service_key] = (cf_dw_flow, cf_up_flow, service)
 
         return service_key
 
@@ -821,58 +983,16 @@ class OLTDevice(OLTadaptor):
                 return False
             direction = "downstream"
 
-            # Install TrafficSchedulers
-            schedulers = service.get_downstream_trafficSchedulers()
-            check = super().create_traffic_schedulers(schedulers)
-            if not check:
-                super().remove_traffic_schedulers(schedulers)
-                return False
-
-            # Install Queues
-            dwQueues = service.get_downstream_trafficQueues()
-            check = super().create_traffic_queues(dwQueues)
-            if not check:
-                super().remove_traffic_queues(dwQueues)
-                super().remove_traffic_schedulers(schedulers)
-                return False
-            # Install Flows
-            dw_flow = service.generate_downstream_flow(dw_flow_id)
-            check = super().flow_add(dw_flow)
-            if not check:
-                super().flow_remove(dw_flow)
-                super().remove_traffic_queues(dwQueues)
-                super().remove_traffic_schedulers(schedulers)
-                return False
-
         # Upstream Service
         if up_flow_id is not None:
             if cf_up_flow is not None:
                 return False
             direction = "upstream" if direction == "" else "bidirectional"
 
-            # Install TrafficSchedulers
-            schedulers = service.get_upstream_trafficSchedulers()
-            check = super().create_traffic_schedulers(schedulers)
-            if not check:
-                super().remove_traffic_schedulers(schedulers)
-                return False
-
-            # Install Queues
-            upQueues = service.get_upstream_trafficQueues()
-            check = super().create_traffic_queues(upQueues)
-            if not check:
-                super().remove_traffic_queues(dwQueues)
-                super().remove_traffic_schedulers(schedulers)
-                return False
-
-            # Install Flows
-            up_flow = service.generate_upstream_flow(up_flow_id)
-            check = super().flow_add(up_flow)
-            if not check:
-                super().flow_remove(up_flow)
-                super().remove_traffic_queues(upQueues)
-                super().remove_traffic_schedulers(schedulers)
-                return False
+        # Install TrafficSchedulers, Queues and Flows
+        check = self.service_pipeline(service, dw_flow_id, up_flow_id).run()
+        if not check:
+            return False
 
         if not cf_dw_flow and not cf_up_flow:
             install = True
@@ -887,7 +1007,8 @@ class OLTDevice(OLTadaptor):
         if not up_flow_id:
             up_flow_id = cf_up_flow
 
-        self.olt_services[service_key] = (dw_flow_id, up_flow_id, service)
+        with self.lock:
+            self.olt_services[service_key] = (dw_flow_id, up_flow_id, service)
 
         return True
 
@@ -949,13 +1070,15 @@ class OLTDevice(OLTadaptor):
             delete = True
         else:
             delete = False
-            self.olt_services[service_key] = (cf_dw_flow, cf_up_flow, service)
+            with self.lock:
+                self.olt_services[service_key] = (cf_dw_flow, cf_up_flow, service)
 
         check = self.omci_remove_InternetService(service_key, direction, delete)
 
         if not cf_dw_flow and not cf_up_flow:
             self.free_gemport(service.gemport_id, service.intf_id)
-            self.olt_services.pop(service_key)
+            with self.lock:
+                self.olt_services.pop(service_key)
 
         return True
 
@@ -1159,10 +1282,27 @@ class OLTDevice(OLTadaptor):
         service.generate_classifiers(o_vid = classifier_o_vid, i_vid = classifier_i_vid, tag_type = tag_type)
         service.generate_action(cmds = cmds)
 
-        self.olt_services[service_key] = (cf_flow, None, service)
+        with self.lock:
+            self.olt_services[service_key] = (cf_flow, None, service)
 
         return service_key
 
+    def multicast_pipeline(self, service, flow_id):
+        """RPC pipeline installing a multicast service: the group and the
+            schedulers, queues and flows of every interface. The members
+            are added to the group once the flows are installed.
+        """
+
+        pipeline = RpcPipeline(self)
+        pipeline.stage(("PerformGroupOperation", service.get_Group()),
+                       *[("CreateTrafficSchedulers", sched) for sched in service.get_traffic_schedulers()])
+        pipeline.stage(*[("CreateTrafficQueues", queue) for queue in service.get_traffic_queues()])
+        pipeline.stage(*[("FlowAdd", flow) for flow in service.generate_flows(flow_id)])
+        # The group is deleted by the first stage
+        pipeline.stage(("PerformGroupOperation", service.get_Group_members(), None))
+
+        return pipeline
+
     def install_MulticastService (self, service_key, flow_id):
         cf_flow, _, service = self.olt_services[service_key]
         direction = "downstream"
@@ -1171,48 +1311,9 @@ class OLTDevice(OLTadaptor):
         if cf_flow is not None:
             return False
 
-        # Creating groups
-        group = service.get_Group()
-        check = super().group_perform(group)
-        if not check:
-            super().group_remove(group)
-            return False
-
-        # Install TrafficSchedulers
-        schedulers = service.get_traffic_schedulers()
-        for sched in schedulers:
-            check = super().create_traffic_schedulers(sched)
-            if not check:
-                super().remove_traffic_schedulers(sched)
-                return False
-
-        # Install Queues
-        Queues = service.get_traffic_queues()
-        for queue in Queues:
-            check = super().create_traffic_queues(queue)
-            if not check:
-                super().remove_traffic_queues(queue)
-                for sched in schedulers:
-                    super().remove_traffic_schedulers(sched)
-                return False
-
-        # Install Flows
-        flows = service.generate_flows(flow_id)
-        for flow in flows:
-            check = super().flow_add(flow)
-            if not check:
-                super().flow_remove(flow)
-                for queue in Queues:
-                    super().remove_traffic_queues(queue)
-                for sched in schedulers:
-                    super().remove_traffic_schedulers(sched)
-                return False
-
-        # Updating Group
-        groupMembers = service.get_Group_members()
-        check = super().group_perform(groupMembers)
+        # Install Groups, TrafficSchedulers, Queues and Flows
+        check = self.multicast_pipeline(service, flow_id).run()
         if not check:
-            super().group_remove(group)
             return False
 
         #if not cf_flow:
@@ -1222,7 +1323,8 @@ class OLTDevice(OLTadaptor):
 
         check = self.omci_configure_MulticastService(service_key)
 
-        self.olt_services[service_key] = (flow_id, None, service)
+        with self.lock:
+            self.olt_services[service_key] = (flow_id, None, service)
 
         return True
 
@@ -1267,7 +1369,8 @@ class OLTDevice(OLTadaptor):
         check = self.omci_remove_MulticastService(service_key)
 
         self.free_gemport(service.gemport_id)
-        self.olt_services.pop(service_key)
+        with self.lock:
+            self.olt_services.pop(service_key)
 
         return True
 
@@ -1384,6 +1487,11 @@ class OLTDevice(OLTadaptor):
         return True
 
     def create_ports (self, intf_id, onu_id, oper_state, admin_state):
+        # No service of the ONU is installed while it is being activated
+        with self.onu_lock(intf_id, onu_id):
+            self.activate_ports(intf_id, onu_id, oper_state, admin_state)
+
+    def activate_ports (self, intf_id, onu_id, oper_state, admin_state):
 
         if (oper_state == "down" or admin_state == "down"):
             logging.error("ONU ID %d on interface %d in bad state.", onu_id, intf_id)
@@ -1395,11 +1503,19 @@ class OLTDevice(OLTadaptor):
 
         onu_sn = self.get_onu_sn(intf_id, onu_id)
 
-        check = super().omci_onu_initialize(intf_id, onu_id)
-        if not check:
-            return
+        if super().omci_onu_configured(intf_id, onu_id):
+            # Activated again by the OLT (e.g. after an OLT restart): the ONU
+            # keeps its configuration, only the OLT part of its services is sent
+            logging.info("ONU ID %d on interface %d activated again, resyncing its services", onu_id, intf_id)
+            with self.lock:
+                self.resyncPending.discard((intf_id, onu_id))
+            self.resync_services(intf_id, onu_id)
+        else:
+            check = super().omci_onu_initialize(intf_id, onu_id)
+            if not check:
+                return
 
-        logging.info("ONU ID %d on interface %d successfully activated", onu_id, intf_id)
+            logging.info("ONU ID %d on interface %d successfully activated", onu_id, intf_id)
 
         PyPath_TP_UNI_ids = super().omci_get_entity_ids(intf_id, onu_id, PptpEthernetUni.class_id)
 
@@ -1506,105 +1622,111 @@ class OLTDevice(OLTadaptor):
             return (PortFeatures.OFPPF_OTHER | PortFeatures.OFPPF_COPPER), 0
 
     def get_onu_id(self, intf_id, onu_sn):
-        file = "subscribers.info"
+        with self.lock:
+            file = "subscribers.info"
 
-        if (len(self.onus) == 0) and (os.path.exists(file)):
-            with open(file) as fp:
-                self.onus = json.load(fp)
+            if (len(self.onus) == 0) and (os.path.exists(file)):
+                with open(file) as fp:
+                    self.onus = json.load(fp)
 
-        if onu_sn in self.onus:
-            return self.onus[onu_sn][1]
-        else:
-            i = 1
-            for onuId in sorted(self.onus.values()):
-                if (onuId[0] != intf_id):
-                    continue
-                if onuId[1] > i:
-                    break
-                else:
-                    i += 1
-                    continue
+            if onu_sn in self.onus:
+                return self.onus[onu_sn][1]
+            else:
+                i = 1
+                for onuId in sorted(self.onus.values()):
+                    if (onuId[0] != intf_id):
+                        continue
+                    if onuId[1] > i:
+                        break
+                    else:
+                        i += 1
+                        continue
 
-            onu = [intf_id, i]
-            self.onus[onu_sn] = onu
+                onu = [intf_id, i]
+                self.onus[onu_sn] = onu
             
-            with open(file, "w") as fp:
-                json.dump(self.onus, fp, indent=4)
+                with open(file, "w") as fp:
+                    json.dump(self.onus, fp, indent=4)
 
-            return i
+                return i
 
     def get_configured_voipExtensions(self):
-        extensions = []
+        with self.lock:
+            extensions = []
 
-        for onu in self.onus.values():
-            if len(onu) < 3:
-                continue
-            for port in onu[2].values():
-                extensions.append(port[0])
+            for onu in self.onus.values():
+                if len(onu) < 3:
+                    continue
+                for port in onu[2].values():
+                    extensions.append(port[0])
 
-        return extensions
+            return extensions
 
     def generate_voipExtension(self, intf_id, onu_id, pots_id):
-        file = "subscribers.info"
-        onu_sn = self.get_onu_sn(intf_id, onu_id)
+        with self.lock:
+            file = "subscribers.info"
+            onu_sn = self.get_onu_sn(intf_id, onu_id)
 
-        ext = self.voip_extensions_start
-        passw = ''
-        for i in range(4):
-            passw += random.choice(string.ascii_lowercase + string.digits)
+            ext = self.voip_extensions_start
+            passw = ''
+            for i in range(4):
+                passw += random.choice(string.ascii_lowercase + string.digits)
 
-        for extension in sorted(self.get_configured_voipExtensions()):
-            if extension > ext:
-                break
-            ext += 1
+            for extension in sorted(self.get_configured_voipExtensions()):
+                if extension > ext:
+                    break
+                ext += 1
 
-        if ext > self.voip_extensions_end:
-            return None, None
+            if ext > self.voip_extensions_end:
+                return None, None
 
-        block = [ext, passw]
+            block = [ext, passw]
 
-        if len(self.onus[onu_sn]) < 3:
-            self.onus[onu_sn].append({pots_id: block})
-        else:
-            self.onus[onu_sn][2].update({pots_id: block})
+            if len(self.onus[onu_sn]) < 3:
+                self.onus[onu_sn].append({pots_id: block})
+            else:
+                self.onus[onu_sn][2].update({pots_id: block})
 
-        with open(file, "w") as fp:
-            json.dump(self.onus, fp, indent=4)
+            with open(file, "w") as fp:
+                json.dump(self.onus, fp, indent=4)
 
-        return block
+            return block
 
 
     def get_voipExtension(self, intf_id, onu_id, pots_id):
-        ext = None
-        passw = None
+        with self.lock:
+            ext = None
+            passw = None
 
-        for onu in self.onus.values():
-            if onu[0] != intf_id or onu[1] != onu_id:
-                continue
-            if len(onu) < 3:
-                break
-            if str(pots_id) not in onu[2]:
-                break
+            for onu in self.onus.values():
+                if onu[0] != intf_id or onu[1] != onu_id:
+                    continue
+                if len(onu) < 3:
+                    break
+                if str(pots_id) not in onu[2]:
+                    break
 
-            return onu[2][str(pots_id)][0], onu[2][str(pots_id)][1]
+                return onu[2][str(pots_id)][0], onu[2][str(pots_id)][1]
 
-        ext, passw = self.generate_voipExtension(intf_id, onu_id, pots_id)
+            ext, passw = self.generate_voipExtension(intf_id, onu_id, pots_id)
 
-        return ext, passw
+            return ext, passw
 
     def get_onu_sn(self, intf_id, onu_id):
-        for onu_item in self.onus.items():
-            if onu_item[1][0] == intf_id and onu_item[1][1] == onu_id:
-                return onu_item[0]
+        with self.lock:
+            for onu_item in self.onus.items():
+                if onu_item[1][0] == intf_id and onu_item[1][1] == onu_id:
+                    return onu_item[0]
 
-        return ""
+            return ""
 
     def onu_exists(self, intf_id, onu_id):
-        for onu in self.onus.values():
-            if onu[0] == intf_id and onu[1] == onu_id:
-                return True
+        with self.lock:
+            for onu in self.onus.values():
+                if onu[0] == intf_id and onu[1] == onu_id:
+                    return True
 
-        return False
+            return False
 
     def onu_to_portNo(self, intf_id, onu_id, PPTP, POTS = False):
         port_no = ((intf_id << 28) & 0xf0000000) | ((onu_id << 16) & 0x07ff0000) | (PPTP & 0x0000ffff)
@@ -1623,60 +1745,66 @@ class OLTDevice(OLTadaptor):
 
     def get_gemport_unicast(self, intf_id):
 
-        if intf_id not in self.net_gemports:
-            self.net_gemports[intf_id] = [self.gemport_id_start]
-            return self.gemport_id_start
+        with self.lock:
+            if intf_id not in self.net_gemports:
+                self.net_gemports[intf_id] = [self.gemport_id_start]
+                return self.gemport_id_start
 
-        for Gport in range(self.gemport_id_start, self.alloc_id_end):
-            if Gport not in self.net_gemports[intf_id]:
-                self.net_gemports[intf_id].append(Gport)
-                return Gport
+            for Gport in range(self.gemport_id_start, self.alloc_id_end):
+                if Gport not in self.net_gemports[intf_id]:
+                    self.net_gemports[intf_id].append(Gport)
+                    return Gport
 
-        return None
+            return None
 
     def get_gemport_multicast(self):
-        if 0 not in self.net_gemports:
-            self.net_gemports[0] = [self.gemport_id_mc_start]
-            return self.gemport_id_mc_start
+        with self.lock:
+            if 0 not in self.net_gemports:
+                self.net_gemports[0] = [self.gemport_id_mc_start]
+                return self.gemport_id_mc_start
 
-        for Gport in range(self.gemport_id_mc_start, self.gemport_id_end):
-            if Gport not in self.net_gemports[0]:
-                self.net_gemports[0].append(Gport)
-                return Gport
+            for Gport in range(self.gemport_id_mc_start, self.gemport_id_end):
+                if Gport not in self.net_gemports[0]:
+                    self.net_gemports[0].append(Gport)
+                    return Gport
 
-        return None
+            return None
 
     def free_gemport(self, gemport_id, intf_id = 0):
-        if intf_id not in self.net_gemports:
-            return
+        with self.lock:
+            if intf_id not in self.net_gemports:
+                return
 
-        if gemport_id not in self.net_gemports[intf_id]:
-            return
+            if gemport_id not in self.net_gemports[intf_id]:
+                return
 
-        self.net_gemports[intf_id].remove(gemport_id)
+            self.net_gemports[intf_id].remove(gemport_id)
 
     def get_Service_from_flow(self, flow_id):
-        for key, value in self.olt_services.items():
-            if value[0] == flow_id:
-                return key, ("multicast" if key[3] == "multicast" else "downstream")
-            elif  value[1] == flow_id:
-                return key, "upstream"
+        with self.lock:
+            for key, value in self.olt_services.items():
+                if value[0] == flow_id:
+                    return key, ("multicast" if key[3] == "multicast" else "downstream")
+                elif  value[1] == flow_id:
+                    return key, "upstream"
 
-        return None, None
+            return None, None
 
     def remove_gemport_unicast(self, intf_id, gemport):
-        if intf_id not in self.net_gemports:
-            return
+        with self.lock:
+            if intf_id not in self.net_gemports:
+                return
 
-        self.net_gemports[intf_id].remove(gemport)
+            self.net_gemports[intf_id].remove(gemport)
 
     def get_flowHash (self, flow_id):
-        hash_list = []
-        for ha in self.flow_ids_to_hash.items():
-            if flow_id in ha[1]:
-                hash_list.append(ha[0])
+        with self.lock:
+            hash_list = []
+            for ha in self.flow_ids_to_hash.items():
+                if flow_id in ha[1]:
+                    hash_list.append(ha[0])
 
-        return hash_list
+            return hash_list
 
     def configureFlows(self, flow_id, flow_action):
 
@@ -1703,40 +1831,45 @@ class OLTDevice(OLTadaptor):
                 if service_key is None:
                     continue
 
-                _,_,_,serType = service_key
-
-                if serType == "multicast":
-                    _, _, service = self.olt_services[service_key]
-                    cf_ports = self.controller.groupId_to_ports(service.group_id)
-                    check = self.uninstall_MulticastService(service_key = service_key)
-                    if not check:
-                        deleted = False
-                        continue
-                    for port_no in cf_ports:
-                        deletedPorts.append({"port_no": port_no, "flowType": "downstream"})
-                elif serType == "voip":
-                    port_no = self.onu_to_portNo(service_key[0], service_key[1], service_key[2])
-
-                    check = self.uninstall_VoipService(service_key = service_key, direction = flowType)
-                    if not check:
-                        deleted = False
-                        continue
-                    deletedPorts.append({"port_no": port_no, "flowType": flowType})
-                else:
-                    port_no = self.onu_to_portNo(service_key[0], service_key[1], service_key[2])
-
-                    check = self.uninstall_InternetService(service_key = service_key, direction = flowType)
-                    if not check:
-                        deleted = False
-                        continue
-                    deletedPorts.append({"port_no": port_no, "flowType": flowType})
-
-                self.flow_ids_to_hash.pop(hashFlow)
-
+                # Services of the same ONU are removed one at a time
+                with self.onu_lock(*((0, 0) if service_key[3] == "multicast" else service_key[:2])):
+                    _,_,_,serType = service_key
+
+                    if serType == "multicast":
+                        _, _, service = self.olt_services[service_key]
+                        cf_ports = self.controller.groupId_to_ports(service.group_id)
+                        check = self.uninstall_MulticastService(service_key = service_key)
+                        if not check:
+                            deleted = False
+                            continue
+                        for port_no in cf_ports:
+                            deletedPorts.append({"port_no": port_no, "flowType": "downstream"})
+                    elif serType == "voip":
+                        port_no = self.onu_to_portNo(service_key[0], service_key[1], service_key[2])
+
+                        check = self.uninstall_VoipService(service_key = service_key, direction = flowType)
+                        if not check:
+                            deleted = False
+                            continue
+                        deletedPorts.append({"port_no": port_no, "flowType": flowType})
+                    else:
+                        port_no = self.onu_to_portNo(service_key[0], service_key[1], service_key[2])
+
+                        check = self.uninstall_InternetService(service_key = service_key, direction = flowType)
+                        if not check:
+                            deleted = False
+                            continue
+                        deletedPorts.append({"port_no": port_no, "flowType": flowType})
+
+                    with self.lock:
+                        self.flow_ids_to_hash.pop(hashFlow)
+
+            # Once the flow is gone only the chains it linked are matched again
+            relinked = None
             if deleted:
-                self.controller.delete_flow(flow_id = flow_id)
+                relinked = self.controller.delete_flow(flow_id = flow_id)
 
-            serviceList = self.controller.matchPorts(deletedPorts)
+            serviceList = self.controller.matchPorts(deletedPorts, relinked)
 
             for service in serviceList:
                 check = self.install_received_service(service)
@@ -1771,6 +1904,16 @@ class OLTDevice(OLTadaptor):
         return c_tag, s_tag
 
     def install_received_service(self, service):
+        if service.get("serviceType") == "multicast":
+            intf_id = onu_id = 0
+        else:
+            intf_id, onu_id, _, _ = self.portNo_to_onu(service.get("ONUport", 0))
+
+        # Services of the same ONU are installed one at a time
+        with self.onu_lock(intf_id, onu_id):
+            return self._install_received_service(service)
+
+    def _install_received_service(self, service):
         fmt = ""
         for i in service["flowIds"]:
             fmt += "L"
@@ -1856,7 +1999,8 @@ class OLTDevice(OLTadaptor):
             logging.error("Failed to install %s service to port %d from flow %d.", service["flowType"], port_no, hash_flow_id)
             return False
 
-        self.flow_ids_to_hash[hash_flow_id] = service["flowIds"]
+        with self.lock:
+            self.flow_ids_to_hash[hash_flow_id] = service["flowIds"]
 
         return True
 
@@ -1913,7 +2057,8 @@ class OLTDevice(OLTadaptor):
             logging.error("Failed to install %s service to port %d from flow %d.", service["flowType"], port_no, hash_flow_id)
             return False
 
-        self.flow_ids_to_hash[hash_flow_id] = service["flowIds"]
+        with self.lock:
+            self.flow_ids_to_hash[hash_flow_id] = service["flowIds"]
 
         return True
 
@@ -1957,11 +2102,15 @@ class OLTDevice(OLTadaptor):
             logging.error("Failed to install %s service to group %d from flow %d.", service["flowType"], group_id, hash_flow_id)
             return False
 
-        self.flow_ids_to_hash[hash_flow_id] = service["flowIds"]
+        with self.lock:
+            self.flow_ids_to_hash[hash_flow_id] = service["flowIds"]
 
         return True
 
     def update_Flow_statistics(self, hash_flow_id, rx_bytes, rx_packets, tx_bytes, tx_packets, timestamp):
 
-        for flow_id in self.flow_ids_to_hash[hash_flow_id]:
+        with self.lock:
+            flow_ids = list(self.flow_ids_to_hash.get(hash_flow_id, ()))
+
+        for flow_id in flow_ids:
             self.controller.update_Flow_statistics(flow_id, tx_packets, tx_bytes, timestamp)
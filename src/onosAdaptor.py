@@ -14,8 +14,11 @@
     limitations under the License.
 """
 
+import bisect
+import itertools
 import logging
 import socket
+import threading
 import time
 import math
 from pyof.v0x04.symmetric.hello import *
@@ -27,6 +30,7 @@ from pyof.v0x04.asynchronous.port_status import *
 from pyof.v0x04.controller2switch import features_reply
 from pyof.foundation.base import *
 from pyof.foundation.basic_types import *
+from pyof.foundation.exceptions import WrongListItemType
 from pyof.v0x04.common.header import Header, Type
 from pyof.v0x04.common.flow_match import *
 from pyof.v0x04.common.flow_instructions import *
@@ -46,99 +50,263 @@ from pyof.v0x04.controller2switch.group_mod import *
 
 import src.agentQueue
 from src.agentQueue import oltQueue
+from src.ofBarrier import BarrierTracker
+from src.ofBuffer import OFReceiveBuffer
+from src.ofDispatch import OFDispatcher
+from src.ofMultipart import multipart_reply_segments
+from src.ofWriter import SocketOFWriter
+
+class FlowsByPriority(list):
+    """Flows of a table ordered by priority, highest first. Flows with the
+        same priority keep their insertion order.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._keys = [] # Negated priorities, parallel to the list
+
+    def add(self, flow):
+        key = -flow["priority"]
+        pos = bisect.bisect_right(self._keys, key)
+        self._keys.insert(pos, key)
+        self.insert(pos, flow)
+
+    def discard(self, flow):
+        key = -flow["priority"]
+        start = bisect.bisect_left(self._keys, key)
+        end = bisect.bisect_right(self._keys, key)
+        for pos in range(start, end):
+            if self[pos] is flow:
+                del self[pos]
+                del self._keys[pos]
+                return True
+        return False
 
 class ListOfFlows(dict):
-    """List of Flow elements"""
+    """List of Flow elements.
+
+        The flows are stored by table (table_id -> FlowsByPriority) and
+        indexed by cookie, input port, output port, group and meter, so the
+        lookups done for every FLOW_MOD do not scan the tables.
+
+        It also keeps the service graph: the links of each flow with the
+        flows of the previous/next table (get_linked_flows). A link is
+        computed once and only dropped when a flow is added to or removed
+        from the (table, inPort) it was matched against. Deleting a flow
+        returns the flows whose links were dropped, so only the chains
+        going through them are matched again (chain_changed).
+    """
 
     def __init__(self, items=None):
         super().__init__()
+
+        self.cookies = {} # flowId -> flow
+        self.inPorts = {} # inPort -> {flowId: flow}
+        self.outPorts = {} # outPort -> {flowId: flow}
+        self.groups = {} # groupId -> {flowId: flow}
+        self.meters = {} # meterId -> {flowId: flow}
+
+        self._tableInPort = {} # (tableId, inPort) -> FlowsByPriority
+        self.links = {} # flowId -> {tableId: linked flows}
+        self._linkLookups = {} # (tableId, inPort) -> flowIds with links to it
+        self._lookupKeys = {} # flowId -> (tableId, inPort) it has links to
+        self._order = {} # flowId -> insertion sequence
+        self._sequence = itertools.count()
+
+        # Held by the ONU workers while they match services, the lookups
+        # also update the link cache
+        self.lock = threading.RLock()
+
         if isinstance(items, list):
             for item in items:
                 self.append(item)
 
     def append(self, item):
         table_id = item.get("tableId")
+        flow_id = item["flowId"]
+
+        # A new flow with the same cookie replaces the stored one
+        oldFlow = self.cookies.get(flow_id)
+        if oldFlow is not None:
+            self._remove(oldFlow)
+
         if table_id not in self.keys():
-            self.update({table_id : []})
-        listTable = self.get(table_id)
-        listTable.append(item)
-        self.update({table_id : listTable})
+            self.update({table_id : FlowsByPriority()})
+        self.get(table_id).add(item)
+
+        inPort = item["match"]["inPort"]
+        self._tableInPort.setdefault((table_id, inPort), FlowsByPriority()).add(item)
+        self._unlink(table_id, inPort)
+
+        self.cookies[flow_id] = item
+        self._order[flow_id] = next(self._sequence)
+        self._index(self.inPorts, inPort, item)
+        self._index(self.outPorts, item["instructions"].get("outPort"), item)
+        self._index(self.groups, item["instructions"].get("groupId"), item)
+        self._index(self.meters, item["instructions"].get("meterId"), item)
+
+    def _remove(self, flow):
+        table_id = flow["tableId"]
+        flow_id = flow["flowId"]
+        inPort = flow["match"]["inPort"]
+
+        self.get(table_id).discard(flow)
+
+        flows = self._tableInPort[(table_id, inPort)]
+        flows.discard(flow)
+        if len(flows) == 0:
+            del self._tableInPort[(table_id, inPort)]
+
+        self.links.pop(flow_id, None)
+        for key in self._lookupKeys.pop(flow_id, ()):
+            lookups = self._linkLookups.get(key)
+            if lookups is not None:
+                lookups.discard(flow_id)
+                if len(lookups) == 0:
+                    del self._linkLookups[key]
+        relinked = self._unlink(table_id, inPort)
+
+        del self.cookies[flow_id]
+        del self._order[flow_id]
+        self._unindex(self.inPorts, inPort, flow)
+        self._unindex(self.outPorts, flow["instructions"].get("outPort"), flow)
+        self._unindex(self.groups, flow["instructions"].get("groupId"), flow)
+        self._unindex(self.meters, flow["instructions"].get("meterId"), flow)
+
+        return relinked
+
+    def _unlink(self, table_id, inPort):
+        """Drop the links computed against the flows of (table_id, inPort),
+            returns the flowIds that had them
+        """
 
-    def exist(self, itemCookie, itemTableId):
-        if itemTableId in self.keys():
-            for flow in self.get(itemTableId):
-                if flow["flowId"] == itemCookie:
+        relinked = self._linkLookups.pop((table_id, inPort), set())
+        for flow_id in relinked:
+            links = self.links.get(flow_id)
+            if links is not None:
+                links.pop(table_id, None)
+            keys = self._lookupKeys.get(flow_id)
+            if keys is not None:
+                keys.discard((table_id, inPort))
+                if len(keys) == 0:
+                    del self._lookupKeys[flow_id]
+
+        return relinked
+
+    def get_linked_flows(self, flowParams, table_id):
+        """Flows of 'table_id' linked with a stored flow, as returned by
+            get_matched_flow. The result is kept until the flows of the
+            table with the same input port change.
+        """
+
+        flow_id = flowParams["flowId"]
+        if self.cookies.get(flow_id) is not flowParams:
+            return self.get_matched_flow(flowParams, table_id)
+
+        links = self.links.setdefault(flow_id, {})
+        flows = links.get(table_id)
+        if flows is None:
+            flows = self.get_matched_flow(flowParams, table_id)
+            links[table_id] = flows
+            key = (table_id, flowParams["match"]["inPort"])
+            self._linkLookups.setdefault(key, set()).add(flow_id)
+            self._lookupKeys.setdefault(flow_id, set()).add(key)
+
+        return list(flows)
+
+    def chain_changed(self, flow, relinked):
+        """True if a chain of 'flow' goes through one of the 'relinked'
+            flows, or spans several tables and was never matched
+        """
+
+        pending = [flow]
+        visited = set()
+        while pending:
+            flow = pending.pop()
+            flow_id = flow["flowId"]
+            if flow_id in visited:
+                continue
+            visited.add(flow_id)
+
+            if flow_id in relinked:
+                return True
+
+            links = self.links.get(flow_id)
+            if links is None:
+                if flow["tableId"] > 0 or "gotoTable" in flow["instructions"]:
                     return True
+                continue
+            for flows in links.values():
+                pending.extend(flows)
+
         return False
 
+    def _index(self, index, key, flow):
+        if key is not None:
+            index.setdefault(key, {})[flow["flowId"]] = flow
+
+    def _unindex(self, index, key, flow):
+        flows = index.get(key)
+        if flows is not None:
+            flows.pop(flow["flowId"], None)
+            if len(flows) == 0:
+                del index[key]
+
+    def _match_order(self, flow):
+        # Highest table first, then highest priority, then insertion order
+        return (-flow["tableId"], -flow["priority"], self._order[flow["flowId"]])
+
+    def exist(self, itemCookie, itemTableId):
+        flow = self.cookies.get(itemCookie)
+        return flow is not None and flow["tableId"] == itemTableId
+
     def delete(self, itemCookie, itemTableId):
-        if itemTableId in self.keys():
-            for flow in self.get(itemTableId):
-                if flow["flowId"] == itemCookie:
-                    self.get(itemTableId).remove(flow) # Deleting the Flow
-                    return True
-        return False
+        """Returns the flowIds whose links were dropped, None if the flow
+            does not exist
+        """
+        if not self.exist(itemCookie, itemTableId):
+            return None
+
+        return self._remove(self.cookies[itemCookie]) # Deleting the Flow
 
     def getFlow(self, itemFlowId):
-        for table_id in self.keys():
-            for flow in self.get(table_id):
-                if flow["flowId"] == itemFlowId:
-                    return flow
-        return None
+        return self.cookies.get(itemFlowId)
 
     def getFlowsTable(self, itemTableId):
         return self.get(itemTableId)
 
     def attachedMeter(self, itemMeterId):
-        for table_id in self.keys():
-            for flow in self.get(table_id):
-                if "meterId" in flow["instructions"] and flow["instructions"]["meterId"] == itemMeterId:
-                    return True
-        return False
+        return itemMeterId in self.meters
 
     def attachedGroup(self, itemGroupId):
-        for table_id in self.keys():
-            for flow in self.get(table_id):
-                if "groupId" in flow["instructions"] and flow["instructions"]["groupId"] == itemGroupId:
-                    return True
-        return False
+        return itemGroupId in self.groups
 
     def get_port_matched_flows(self, port_no, direction, groupIDs = []):
-        flows = []
-        start_table_id = max(self.keys()) if direction == "downstream" else 0
-        # Ceck groups
+        flows = {}
 
-        for table_id in range(start_table_id, -1, -1):
-            bw_table_flows = self.getFlowsTable(table_id)
-            if bw_table_flows is None or len(bw_table_flows) == 0:
-                continue
+        if direction == "upstream":
+            # Only the first table matches on the UNI port
+            for flow in self.inPorts.get(port_no, {}).values():
+                if flow["tableId"] == 0:
+                    flows[flow["flowId"]] = flow
 
-            for flow in sorted(bw_table_flows, key = lambda x: (x['priority']), reverse = True):
-                if direction == "upstream" and flow["match"]["inPort"] == port_no:
-                    flows.append(flow)
-                    continue
+        elif direction == "downstream":
+            for groupId in groupIDs:
+                flows.update(self.groups.get(groupId, {}))
+            flows.update(self.outPorts.get(port_no, {}))
 
-                if direction == "downstream" and "groupId" in flow["instructions"]:
-                    if flow["instructions"]["groupId"] in groupIDs:
-                        flows.append(flow)
-                        continue
-
-                if direction == "downstream" and "outPort" in flow["instructions"]:
-                    if flow["instructions"]["outPort"] == port_no:
-                        flows.append(flow)
-                        continue
-
-        return flows
+        return sorted(flows.values(), key = self._match_order)
 
     def get_matched_flow (self, flowParams, table_id):
         logging.info("Matching flow from table %d", table_id)
         logging.info("Received flow table %d", flowParams["tableId"])
         flows = []
-        bw_table_flows = self.getFlowsTable(table_id)
-        if bw_table_flows is None or len(bw_table_flows) == 0:
+        # Only the flows of the table with the same input port can match
+        bw_table_flows = self._tableInPort.get((table_id, flowParams["match"]["inPort"]))
+        if bw_table_flows is None:
             return []
 
-        for flow in sorted(bw_table_flows, key = lambda x: (x['priority']), reverse = True):
+        for flow in bw_table_flows:
             flowMatched = False
 
             if flow["match"]["inPort"] != flowParams["match"]["inPort"]:
@@ -236,64 +404,143 @@ class ListOfFlowMod(dict):
         else:
             return FlowData
 
-class ListOfGroups(FixedTypeList):
-    """List of GroupMod elements.
+class KeyedList:
+    """pyof objects indexed by their identifier.
 
-    Represented by instances of GroupMod.
+        The objects are kept in an insertion ordered dict, so they are found,
+        updated and deleted in constant time and iterated in arrival order to
+        pack the multipart replies. append(), pack() and get_size() behave as
+        in FixedTypeList. Subclasses keep their own indexes up to date with
+        _stored() and _discarded().
+    """
+
+    def __init__(self, pyof_class, items=None):
+        self._pyof_class = pyof_class
+        self._items = dict()
+
+        if items is not None:
+            self.append(items)
+
+    def _key(self, item):
+        """Identifier of an object"""
+        raise NotImplementedError
+
+    def _stored(self, key, item):
+        """Called after an object is stored"""
+
+    def _discarded(self, key, item):
+        """Called after an object is deleted or replaced"""
+
+    def append(self, item):
+        if isinstance(item, list):
+            for it in item:
+                self.append(it)
+        elif issubclass(item.__class__, self._pyof_class):
+            key = self._key(item)
+            oldItem = self._items.pop(key, None)
+            if oldItem is not None:
+                self._discarded(key, oldItem)
+
+            self._items[key] = item
+            self._stored(key, item)
+        else:
+            raise WrongListItemType(item.__class__.__name__, self._pyof_class.__name__)
+
+    def delete(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._discarded(key, item)
+
+    def get(self, key):
+        return self._items.get(key)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        # Snapshot, the lists are updated from other threads
+        return iter(list(self._items.values()))
+
+    def pack(self, value=None):
+        return b''.join(item.pack() for item in self)
+
+    def get_size(self, value=None):
+        return sum(item.get_size() for item in self)
+
+class KeyedStatsList(KeyedList):
+    """KeyedList of statistics, storing the creation time of each object"""
+
+    def __init__(self, pyof_class, items=None):
+        self.start_time = dict()
+        super().__init__(pyof_class, items)
+
+    def _stored(self, key, item):
+        self.start_time[key] = int(time.time())
+
+    def _discarded(self, key, item):
+        self.start_time.pop(key, None)
+
+class ListOfGroups(KeyedList):
+    """List of GroupDescStats indexed by group_id.
+
+        It keeps the output ports of every group and the reverse index
+        port -> groups, so the groups of a port are found without walking
+        the buckets.
     """
 
     def __init__(self, items=None):
         """Create a ListOfGroups with the optional parameters below.
 
         Args:
-        items (GroupMod): Instance or a list of instances.
+        items (GroupDescStats): Instance or a list of instances.
         """
+        self.groupPorts = dict() # group_id -> output ports
+        self.portGroups = dict() # port_no -> {group_id: None}
         super().__init__(pyof_class=GroupDescStats, items=items)
 
-    def delete(self, itemGroupId):
-        for groupObj in self.copy():
-            if groupObj.group_id.value == itemGroupId:
-                self.remove(groupObj)
-
-    def get_group (self, groupId):
-        for group in self.copy():
-            if group.group_id.value == groupId:
-                return group
-        return None
-
-    def exists (self, groupId):
-        if self.get_group(groupId) is None:
-            return False
-        else:
-            return True
+    def _key(self, item):
+        return item.group_id.value
 
-    def get_group_ports(self, groupId):
+    def _stored(self, groupId, group):
         ports = list()
-        group = self.get_group(groupId)
-
         for bucket in group.buckets:
             for action in bucket.actions:
                 if action.action_type == ActionType.OFPAT_OUTPUT:
                     ports.append(action.port.value)
-        return ports
 
-    def get_groupsByPort(self, port_id):
-        groups = list()
+        self.groupPorts[groupId] = ports
+        for port in ports:
+            self.portGroups.setdefault(port, dict())[groupId] = None
+
+    def _discarded(self, groupId, group):
+        for port in self.groupPorts.pop(groupId, []):
+            groups = self.portGroups.get(port)
+            if groups is not None:
+                groups.pop(groupId, None)
+                if len(groups) == 0:
+                    del self.portGroups[port]
+
+    def get_group (self, groupId):
+        return self.get(groupId)
 
-        for group in self.copy():
-            for bucket in group.buckets:
-                for action in bucket.actions:
-                    if (action.action_type == ActionType.OFPAT_OUTPUT
-                            and action.port.value == port_id):
-                        groups.append(group.group_id.value)
+    def exists (self, groupId):
+        return groupId in self
 
-        return groups
+    def get_group_ports(self, groupId):
+        return list(self.groupPorts.get(groupId, []))
 
+    def get_groupsByPort(self, port_id):
+        return list(self.portGroups.get(port_id, {}))
 
-class ListOfMeters(FixedTypeList):
-    """List of MeterMod elements.
+class ListOfMeters(KeyedList):
+    """List of MeterMod indexed by meter_id.
 
-    Represented by instances of MeterMod.
+        The bandwidth of each meter is computed from its bands the first
+        time it is requested and kept until the meter is replaced or
+        deleted by a METER_MOD.
     """
 
     def __init__(self, items=None):
@@ -302,25 +549,35 @@ class ListOfMeters(FixedTypeList):
         Args:
         items (MeterMod): Instance or a list of instances.
         """
+        self.bandwidthCache = dict() # meter_id -> bandwidth
         super().__init__(pyof_class=MeterMod, items=items)
 
-    def delete(self, itemMeterId):
-        for meterObj in self.copy():
-            if meterObj.meter_id.value == itemMeterId:
-                self.remove(meterObj)
+    def _key(self, item):
+        return item.meter_id.value
+
+    def _discarded(self, meterId, meter):
+        self.bandwidthCache.pop(meterId, None)
 
     def get_meter (self, meterId):
-        for meter in self.copy():
-            if meter.meter_id == meterId:
-                return meter
-        return None
+        return self.get(meterId)
 
     def get_meterId_bandwidth(self, meterId):
-        bandwidth = {}
+        bandwidth = self.bandwidthCache.get(meterId)
+        if bandwidth is None:
+            meter = self.get(meterId)
+            if meter is None:
+                return None
 
-        meter = self.get_meter(meterId)
-        if meter is None:
-            return None
+            bandwidth = self.meter_bandwidth(meter)
+            self.bandwidthCache[meterId] = bandwidth
+
+        # The callers modify the returned dict
+        return dict(bandwidth)
+
+    def meter_bandwidth(self, meter):
+        """Get the cir, pir and pbs of the DROP bands of a meter"""
+
+        bandwidth = {}
 
         for band in meter.bands:
             if band.band_type != MeterBandType.OFPMBT_DROP:
@@ -339,17 +596,16 @@ class ListOfMeters(FixedTypeList):
             if "pbs" not in bandwidth.keys() or bandwidth["pbs"] < band.burst_size.value:
                 bandwidth["pbs"] = band.burst_size.value
 
+        if "cir" not in bandwidth.keys():
+            return {}
+
         if "pir" not in bandwidth.keys():
             bandwidth["pir"] = bandwidth["cir"]
 
         return bandwidth
 
-
-class ListOfFlowStats(FixedTypeList):
-    """List of FlowStats.
-
-    Represented by instances of FlowStats.
-    """
+class ListOfFlowStats(KeyedStatsList):
+    """List of FlowStats indexed by cookie."""
 
     def __init__(self, items=None):
         """Create a ListOfFlowStats with the optional parameters below.
@@ -358,46 +614,24 @@ class ListOfFlowStats(FixedTypeList):
         items (FlowStats): Instance or a list of instances.
         """
         super().__init__(pyof_class=FlowStats, items=items)
-        self.flow_start_time = dict()
-        if isinstance(items, list):
-            for item in items:
-                self.flow_start_time.update({item.cookie.value: int(time.time())})
 
-    def append(self, item):
-        super().append(item)
-
-        if isinstance(item, list):
-            for it in item:
-                self.flow_start_time.update({it.cookie.value: int(time.time())})
-        elif issubclass(item.__class__, self._pyof_class):
-            self.flow_start_time.update({item.cookie.value: int(time.time())})
-
-    def delete(self, itemCookie):
-        for flowObj in self.copy():
-            if flowObj.cookie.value == itemCookie:
-                self.remove(flowObj) #Eliminamos el flow de la lista de estadisticas de flows
-                self.flow_start_time.pop(itemCookie)
-                break
+    def _key(self, item):
+        return item.cookie.value
 
     def get_flowStats(self, itemCookie):
-        for flowObj in self.copy():
-            if flowObj.cookie.value == itemCookie:
-                return flowObj
-        return None
+        return self.get(itemCookie)
 
     def update_statistics(self, itemCookie, packet_count, byte_count, timestamp):
-        life = timestamp - self.flow_start_time[itemCookie]
-
-        flowObj = self.get_flowStats(itemCookie)
+        flowObj = self.get(itemCookie)
         if flowObj is None:
             return
 
         flowObj.packet_count += packet_count
         flowObj.byte_count += byte_count
-        flowObj.duration_sec = life
+        flowObj.duration_sec = timestamp - self.start_time[itemCookie]
 
     def get_associated_meter (self, itemCookie):
-        flowObj = self.get_flowStats(itemCookie)
+        flowObj = self.get(itemCookie)
         if flowObj is None:
             return None
 
@@ -406,11 +640,8 @@ class ListOfFlowStats(FixedTypeList):
                 return instruction.meter_id.value
         return None
 
-class ListOfGroupStats(FixedTypeList):
-    """List of GroupStats.
-
-    Represented by instances of GroupStats.
-    """
+class ListOfGroupStats(KeyedStatsList):
+    """List of GroupStats indexed by group_id."""
 
     def __init__(self, items=None):
         """Create a ListOfGroupStats with the optional parameters below.
@@ -420,54 +651,27 @@ class ListOfGroupStats(FixedTypeList):
         """
         super().__init__(pyof_class=GroupStats, items=items)
 
-        self.group_start_time = dict()
-        if isinstance(items, list):
-            for item in items:
-                self.group_start_time.update({item.group_id.value: int(time.time())})
-
-    def append(self, item):
-        super().append(item)
-
-        if isinstance(item, list):
-            for it in item:
-                self.group_start_time.update({it.group_id.value: int(time.time())})
-        elif issubclass(item.__class__, self._pyof_class):
-            self.group_start_time.update({item.group_id.value: int(time.time())})
-
-
-    def delete(self, itemGroupId):
-        for groupObj in self.copy():
-            if groupObj.group_id.value == itemGroupId:
-                self.remove(groupObj) # Deleting the group from the statistics list
-                self.group_start_time.pop(itemGroupId)
-                break
+    def _key(self, item):
+        return item.group_id.value
 
     def get_groupStats(self, itemGroupId):
-        for GroupObj in self.copy():
-            if GroupObj.group_id.value == itemGroupId:
-                return GroupObj
-        return None
+        return self.get(itemGroupId)
 
     def update_statistics(self, itemGroupId, packet_count, byte_count, timestamp):
-        life = timestamp - self.group_start_time[itemGroupId]
-
-        GroupObj = self.get_groupStats(itemGroupId)
+        GroupObj = self.get(itemGroupId)
         if GroupObj is None:
             return
 
         GroupObj.packet_count += packet_count
         GroupObj.byte_count += byte_count
-        GroupObj.duration_sec = life
+        GroupObj.duration_sec = timestamp - self.start_time[itemGroupId]
 
         for band in GroupObj.bucket_stats:
             band.packet_count += packet_count
             band.byte_count += byte_count
 
-class ListOfMeterStats(FixedTypeList):
-    """List of MeterStats.
-
-    Represented by instances of MeterStats.
-    """
+class ListOfMeterStats(KeyedStatsList):
+    """List of MeterStats indexed by meter_id."""
 
     def __init__(self, items=None):
         """Create a ListOfMeterStats with the optional parameters below.
@@ -477,44 +681,20 @@ class ListOfMeterStats(FixedTypeList):
         """
         super().__init__(pyof_class=MeterStats, items=items)
 
-        self.meter_start_time = dict()
-        if isinstance(items, list):
-            for item in items:
-                self.meter_start_time.update({item.meter_id.value: int(time.time())})
-
-    def append(self, item):
-        super().append(item)
-
-        if isinstance(item, list):
-            for it in item:
-                self.meter_start_time.update({it.meter_id.value: int(time.time())})
-        elif issubclass(item.__class__, self._pyof_class):
-            self.meter_start_time.update({item.meter_id.value: int(time.time())})
-
-
-    def delete(self, itemMeterId):
-        for meterObj in self.copy():
-            if meterObj.meter_id.value == itemMeterId:
-                self.remove(meterObj) #Eliminamos el meter de la lista de estadisticas de meters
-                self.meter_start_time.pop(itemMeterId)
-                break
+    def _key(self, item):
+        return item.meter_id.value
 
     def get_meterStats(self, itemMeterId):
-        for MeterObj in self.copy():
-            if MeterObj.meter_id.value == itemMeterId:
-                return MeterObj
-        return None
+        return self.get(itemMeterId)
 
     def update_statistics(self, itemMeterId, packet_count, byte_count, timestamp):
-        life = timestamp - self.meter_start_time[itemMeterId]
-
-        MeterObj = self.get_meterStats(itemMeterId)
+        MeterObj = self.get(itemMeterId)
         if MeterObj is None:
             return
 
         MeterObj.packet_in_count += packet_count
         MeterObj.byte_in_count += byte_count
-        MeterObj.duration_sec = life
+        MeterObj.duration_sec = timestamp - self.start_time[itemMeterId]
 
         packet_band_count = math.floor(packet_count / len (MeterObj.band_stats))
         byte_band_count = math.floor(byte_count / len (MeterObj.band_stats))
@@ -526,10 +706,26 @@ class ListOfMeterStats(FixedTypeList):
 class ONOSAdaptor:
     """Establishes and manages the communication with the OpenFlow Controller"""
 
-    def __init__(self, ipONOS = "0.0.0.0", portONOS = 6633):
+    def __init__(self, ipONOS = "0.0.0.0", portONOS = 6633, write_max_bytes = 65536, write_max_delay = 0.001):
         self.ipONOS = ipONOS
         self.portONOS = portONOS
 
+        # Coalescing budget of the outbound OF messages (see src.ofWriter)
+        self.write_max_bytes = write_max_bytes
+        self.write_max_delay = write_max_delay
+
+        # OFChannel when the connection is served by the OFChannelEngine
+        self.channel = None
+        self.socket = None
+        self.writer = None
+
+        # OFPT_BARRIER_REPLYs waiting for the queued FLOW_MODs
+        self.barriers = BarrierTracker(self.send_OFPT_BARRIER_REPLY)
+
+        # Handlers of the received OF messages, timed per type in the registry
+        self.dispatcher = OFDispatcher()
+        self.register_handlers()
+
         #FlowStats
         self.listF = ListOfFlows()
         self.listFS = ListOfFlowStats()
@@ -551,9 +747,45 @@ class ONOSAdaptor:
         self.bandTypes = 0 | 1 << MeterBandType.OFPMBT_DROP.value | 0 << MeterBandType.OFPMBT_DSCP_REMARK.value
         self.meterFlags = MeterFlags.OFPMF_KBPS
 
-    def connect(self):
-        self.socket = socket.socket()
-        self.socket.connect((self.ipONOS, self.portONOS))
+    def connect(self, timeout = None):
+        self.socket = socket.create_connection((self.ipONOS, self.portONOS), timeout)
+        self.socket.settimeout(None)
+        self.writer = SocketOFWriter(self.socket, self.write_max_bytes, self.write_max_delay)
+
+    def disconnect(self):
+        """Close the connection with the controller, the receive loop ends.
+            It can be called from any thread.
+        """
+
+        if self.channel is not None:
+            self.channel.close()
+        elif self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def attach_channel(self, channel):
+        """Send the OpenFlow messages through an OFChannel of the
+            OFChannelEngine instead of the blocking socket.
+
+        Args:
+                channel (~src.ofEngine.OFChannel): controller connection
+        """
+
+        self.channel = channel
+
+    def send_message(self, message):
+        """Send a packed OpenFlow message to the controller.
+
+        Args:
+                message (bytes): packed OpenFlow message
+        """
+
+        if self.channel is not None:
+            self.channel.write(message)
+        else:
+            self.writer.write(message)
 
     def OFPT_HELLO_msg(self):
         element = HelloElemHeader(element_type=HelloElemType.OFPHET_VERSIONBITMAP,
@@ -561,15 +793,28 @@ class ONOSAdaptor:
         le = ListOfHelloElements(items=[element])
         sendHello = Hello(elements=le)
         message = sendHello.pack()
-        self.socket.send(message)  #Enviamos un mensaje OFPT_HELLO al controlador
+        self.send_message(message)  #Enviamos un mensaje OFPT_HELLO al controlador
+
+    def start_session(self, olt_datapath_id, olt_n_buffers, olt_n_tables, olt_auxiliary_id,
+                      olt_capabilities, olt_hw_version, olt_fw_version, olt_serial_num):
+        """Store the OLT parameters announced to the controller and install
+            the NNI Port. It must be called before handling any message.
+        """
 
-    def recieve_packets(self, olt_datapath_id, olt_n_buffers, olt_n_tables, olt_auxiliary_id,
-                        olt_capabilities, olt_hw_version, olt_fw_version, olt_serial_num):
         self.queue_id = olt_datapath_id
         self.switchTables = olt_n_tables
 
+        self.olt_datapath_id = olt_datapath_id
+        self.olt_n_buffers = olt_n_buffers
+        self.olt_n_tables = olt_n_tables
+        self.olt_auxiliary_id = olt_auxiliary_id
+        self.olt_capabilities = olt_capabilities
+        self.olt_hw_version = olt_hw_version
+        self.olt_fw_version = olt_fw_version
+        self.olt_serial_num = olt_serial_num
+
         #Variable de control para el OFPT_ROLE_REQUEST/REPLY
-        storeRole = None
+        self.storeRole = None
 
         # Installing NNI Port
         state = PortState.OFPPS_LIVE
@@ -584,61 +829,74 @@ class ONOSAdaptor:
 
         self.listPorts.append(self.puertoNNI)
 
-        while True:  # Bucle exterior, gestiona los paquetes
-            extraByte = 0  # Variable para el acceso relativo a los mensajes
-            data = self.socket.recv(10240)  # Recibimos el paquete
-            longReal = len(data)  # Longitud del paquete
+    def recieve_packets(self, olt_datapath_id, olt_n_buffers, olt_n_tables, olt_auxiliary_id,
+                        olt_capabilities, olt_hw_version, olt_fw_version, olt_serial_num):
+        """Blocking receive loop over the controller socket.
 
-            #Tamaño mínimo de un mensaje OF
-            if longReal < 8: continue
+            This function must be call throught a thread.
+        """
 
-            while True:  #Bucle interior, gestiona los mensajes de un paquete
-                #Cabecera de los mensajes OpenFlow recibidos
-                header = Header()
-                header.unpack(data, extraByte)
-                tipo = header.message_type
+        self.start_session(olt_datapath_id, olt_n_buffers, olt_n_tables, olt_auxiliary_id,
+                           olt_capabilities, olt_hw_version, olt_fw_version, olt_serial_num)
 
-                if tipo == Type.OFPT_HELLO:
-                    self.get_OFPT_HELLO_RESPONSE()
+        # Buffer to rebuild the OF messages split between TCP segments
+        self.rxBuffer = OFReceiveBuffer()
 
-                if tipo == Type.OFPT_ECHO_REQUEST: #OFPT_ECHO_REPLY
-                    self.send_OFPT_ECHO_REPLY(header)
+        while True:  # Bucle exterior, gestiona los paquetes
+            try:
+                nbytes = self.rxBuffer.recv_from(self.socket)  # Recibimos el paquete
+            except OSError as e:
+                logging.error("Connection with the controller lost: %s", e)
+                break
 
-                if tipo == Type.OFPT_FEATURES_REQUEST: #OFPT_FEATURES_REQUEST
-                    self.send_OFPT_FEATURES_REPLY(header, olt_datapath_id, olt_n_buffers, olt_n_tables,
-                                             olt_auxiliary_id, olt_capabilities)
+            if nbytes == 0:
+                logging.error("Connection closed by the controller")
+                break
 
-                if tipo == Type.OFPT_GET_CONFIG_REQUEST: #OFPT_GET_CONFIG_REQUEST
-                    self.send_OFPT_GET_CONFIG_REPLY(header)
+            for frame in self.rxBuffer.frames():  #Bucle interior, gestiona los mensajes completos recibidos
+                self.handle_message(frame)
 
-                if tipo == Type.OFPT_FLOW_MOD: #OFPT_FLOW_MOD
-                    self.get_OFPT_FLOW_MOD(extraByte, header, data)
+            # The replies of the received batch are sent together
+            self.writer.flush()
 
-                if tipo == Type.OFPT_MULTIPART_REQUEST: #OFPT_MULTIPART_REQUEST
-                    self.send_OFPT_MULTIPART_REPLY(extraByte, header, data, olt_hw_version, olt_fw_version,
-                                                   olt_serial_num)
+        self.writer.close()
+        self.socket.close()
 
-                if tipo == Type.OFPT_BARRIER_REQUEST: #OFPT_BARRIER_REQUEST
-                    self.send_OFPT_BARRIER_REPLY(header)
+    def handle_message(self, frame):
+        """Handle one complete OpenFlow message received from the controller.
 
-                if tipo == Type.OFPT_ROLE_REQUEST: #OFPT_ROLE_REQUEST
-                    storeRole = self.send_OFPT_ROLE_REPLY(extraByte, header, data, storeRole)
+        Args:
+                frame (bytes-like): OpenFlow message, header included
+        """
 
-                if tipo == Type.OFPT_METER_MOD: #OFPT_METER_MOD
-                    self.get_OFPT_METER_MOD(extraByte, header, data)
+        if oltQueue.journal is not None:
+            oltQueue.journal.record_frame(self.queue_id, frame)
 
-                if tipo == Type.OFPT_GROUP_MOD: #OFPT_GROUP_MOD
-                    self.get_OFPT_GROUP_MOD(extraByte, header, data)
+        self.dispatcher.dispatch(frame)
 
-                # Comprobamos si hay mas mensajes en el paquete
-                if longReal > header.length: #Si hay mas mensajes, procesamos el siguiente mensaje
-                    longReal -= header.length.value
-                    extraByte += header.length.value
-                elif longReal == header.length: #Si no hay mas mensajes, pasamos al siguiente paquete
-                    break
-                else:
-                    logging.error("Error: Not enough bytes from packet to read new OF messages")
-                    break
+    def register_handlers(self):
+        """Fill the dispatch table with the handlers of the controller messages"""
+
+        register = self.dispatcher.register
+
+        register(Type.OFPT_HELLO, lambda header, frame: self.get_OFPT_HELLO_RESPONSE())
+        register(Type.OFPT_ECHO_REQUEST, lambda header, frame: self.send_OFPT_ECHO_REPLY(header))
+        register(Type.OFPT_FEATURES_REQUEST,
+                 lambda header, frame: self.send_OFPT_FEATURES_REPLY(header, self.olt_datapath_id, self.olt_n_buffers,
+                                                                     self.olt_n_tables, self.olt_auxiliary_id,
+                                                                     self.olt_capabilities))
+        register(Type.OFPT_GET_CONFIG_REQUEST, lambda header, frame: self.send_OFPT_GET_CONFIG_REPLY(header))
+        register(Type.OFPT_FLOW_MOD, self.get_OFPT_FLOW_MOD)
+        register(Type.OFPT_MULTIPART_REQUEST,
+                 lambda header, frame: self.send_OFPT_MULTIPART_REPLY(header, frame, self.olt_hw_version,
+                                                                      self.olt_fw_version, self.olt_serial_num))
+        register(Type.OFPT_BARRIER_REQUEST, self.get_OFPT_BARRIER_REQUEST)
+        register(Type.OFPT_ROLE_REQUEST, self.get_OFPT_ROLE_REQUEST)
+        register(Type.OFPT_METER_MOD, self.get_OFPT_METER_MOD)
+        register(Type.OFPT_GROUP_MOD, self.get_OFPT_GROUP_MOD)
+
+    def get_OFPT_ROLE_REQUEST(self, header, frame):
+        self.storeRole = self.send_OFPT_ROLE_REPLY(header, frame, self.storeRole)
 
     def get_OFPT_HELLO_RESPONSE(self):
         logging.info("OFPT_HELLO_RESPONSE")
@@ -646,7 +904,7 @@ class ONOSAdaptor:
     def send_OFPT_ECHO_REPLY(self, header):
         sendEchoReply = EchoReply(xid=header.xid)
         message = sendEchoReply.pack()
-        self.socket.send(message)
+        self.send_message(message)
         logging.info("OFPT_ECHO_REPLY")
 
     def send_OFPT_FEATURES_REPLY(self, header, olt_datapath_id, olt_n_buffers, olt_n_tables,
@@ -656,19 +914,20 @@ class ONOSAdaptor:
                                           auxiliary_id=olt_auxiliary_id, capabilities=olt_capabilities,
                                           reserved=0)
         message = sendFeaturesReply.pack()
-        self.socket.send(message)
+        self.send_message(message)
         logging.info("OFPT_FEATURES_REPLY")
 
     def send_OFPT_GET_CONFIG_REPLY(self, header):
         sendGetConfigReply = GetConfigReply(xid=header.xid, flags=ConfigFlag.OFPC_FRAG_NORMAL,
                                             miss_send_len=ControllerMaxLen.OFPCML_NO_BUFFER)
         message = sendGetConfigReply.pack()
-        self.socket.send(message)
+        self.send_message(message)
         logging.info("OFPT_GET_CONFIG_REPLY")
 
-    def get_OFPT_FLOW_MOD(self, extraByte, header, data):
+    def get_OFPT_FLOW_MOD(self, header, frame):
         flowMod = FlowMod(xid=header.xid)
-        flowMod.unpack(data[extraByte:extraByte+header.length.value], header.get_size())
+        # The FlowMod is stored, so it must not reference the receive buffer
+        flowMod.unpack(bytes(frame), header.get_size())
         flowMod.header.length = header.length
 
         if flowMod.command == FlowModCommand.OFPFC_ADD: #Si el tipo es OFPFC_ADD
@@ -700,14 +959,15 @@ class ONOSAdaptor:
         if flowConfig is None:
             return
 
-        check = self.check_flows(flowConfig)
-        if not check:
-            logging.error("WRONG FLOW received")
-            self.listFS.delete(flowConfig["flowId"])
-            return
+        with self.listF.lock:
+            check = self.check_flows(flowConfig)
+            if not check:
+                logging.error("WRONG FLOW received")
+                self.listFS.delete(flowConfig["flowId"])
+                return
 
-        #Añadimos el Flow a la lista
-        self.listF.append(flowConfig)
+            #Añadimos el Flow a la lista
+            self.listF.append(flowConfig)
         self.cookie_to_flowMod.append(flowMod)
 
         print("Flow creado asociado a un servicio -> A la cola")
@@ -716,9 +976,9 @@ class ONOSAdaptor:
 
         logging.info("OFPT_FLOW_MOD")
 
-    def send_OFPT_MULTIPART_REPLY(self, extraByte, header, data, olt_hw_version, olt_fw_version, olt_serial_num):
+    def send_OFPT_MULTIPART_REPLY(self, header, frame, olt_hw_version, olt_fw_version, olt_serial_num):
         multipartRequest = MultipartRequest(xid=header.xid)
-        multipartRequest.unpack(data, extraByte+header.get_size())
+        multipartRequest.unpack(bytes(frame), header.get_size())
         tipoM = multipartRequest.multipart_type
 
         if tipoM == MultipartType.OFPMP_DESC: #OFPMP_DESC
@@ -727,72 +987,37 @@ class ONOSAdaptor:
             sendMultipartReply = MultipartReply(xid=multipartRequest.header.xid, multipart_type=tipoM,
                                                 flags=multipartRequest.flags, body=pruebaDesc)
             message = sendMultipartReply.pack()
-            self.socket.send(message)
+            self.send_message(message)
             logging.info("OFPMP_DESC")
 
         if tipoM == MultipartType.OFPMP_FLOW: #OFPMP_FLOW
-            if len(self.listFS) != 0: #Enviamos los flows al controlador si existe alguno
-                sendMultipartReply = MultipartReply(xid=multipartRequest.header.xid, multipart_type=tipoM,
-                                                    flags=multipartRequest.flags, body=self.listFS)
-            else:
-                sendMultipartReply = MultipartReply(xid=multipartRequest.header.xid, multipart_type=tipoM,
-                                                    flags=multipartRequest.flags, body=None)
-            message = sendMultipartReply.pack()
-            self.socket.send(message)
+            self.send_multipart_reply(multipartRequest.header.xid, tipoM, self.listFS)
             logging.info("OFPMP_FLOW")
 
         if tipoM == MultipartType.OFPMP_TABLE: #OFPMP_TABLE
             sendMultipartReply = MultipartReply(xid=multipartRequest.header.xid, multipart_type=tipoM,
                                                 flags=multipartRequest.flags, body=None)
             message = sendMultipartReply.pack()
-            self.socket.send(message)
+            self.send_message(message)
             logging.info("OFPMP_TABLE")
 
         if tipoM == MultipartType.OFPMP_PORT_STATS: #OFPMP_PORT_STATS
             sendMultipartReply = MultipartReply(xid=multipartRequest.header.xid, multipart_type=tipoM,
                                                 flags=multipartRequest.flags, body=None)
             message = sendMultipartReply.pack()
-            self.socket.send(message)
+            self.send_message(message)
             logging.info("OFPMP_PORT_STATS")
 
         if tipoM == MultipartType.OFPMP_GROUP: #OFPMP_GROUP
-            if len(self.listGrS) != 0: # If exists, sends the group Stats
-                sendMultipartReply = MultipartReply(xid=multipartRequest.header.xid, multipart_type=tipoM,
-                                                    flags=multipartRequest.flags, body=self.listGrS)
-
-                descLength = self.listGrS[0].get_size()
-
-            else:
-                sendMultipartReply = MultipartReply(xid=multipartRequest.header.xid, multipart_type=tipoM,
-                                                    flags=multipartRequest.flags, body=None)
-
-            message = sendMultipartReply.pack()
-            self.socket.send(message)
+            self.send_multipart_reply(multipartRequest.header.xid, tipoM, self.listGrS)
             logging.info("OFPMP_GROUP")
 
         if tipoM == MultipartType.OFPMP_GROUP_DESC: #OFPMP_GROUP_DESC
-            if len(self.listGr) != 0: # If exists, sends the group Description
-                sendMultipartReply = MultipartReply(xid=multipartRequest.header.xid, multipart_type=tipoM,
-                                                    flags=multipartRequest.flags, body=self.listGr)
-                descLength = self.listGr.get_size()
-
-            else:
-                sendMultipartReply = MultipartReply(xid=multipartRequest.header.xid, multipart_type=tipoM,
-                                                    flags=multipartRequest.flags, body=None)
-
-            message = sendMultipartReply.pack()
-            self.socket.send(message)
+            self.send_multipart_reply(multipartRequest.header.xid, tipoM, self.listGr)
             logging.info("OFPMP_GROUP_DESC")
 
         if tipoM == MultipartType.OFPMP_METER: #OFPMP_METER
-            if len(self.listMS) != 0: #Enviamos los meters al controlador si existe alguno
-                sendMultipartReply = MultipartReply(xid=multipartRequest.header.xid, multipart_type=tipoM,
-                                                    flags=multipartRequest.flags, body=self.listMS)
-            else:
-                sendMultipartReply = MultipartReply(xid=multipartRequest.header.xid, multipart_type=tipoM,
-                                                    flags=multipartRequest.flags, body=None)
-            message = sendMultipartReply.pack()
-            self.socket.send(message)
+            self.send_multipart_reply(multipartRequest.header.xid, tipoM, self.listMS)
             logging.info("OFPMP_METER")
 
         if tipoM == MultipartType.OFPMP_METER_FEATURES: #OFPMP_METER_FEATURES
@@ -801,25 +1026,40 @@ class ONOSAdaptor:
             sendMultipartReply = MultipartReply(xid=multipartRequest.header.xid, multipart_type=tipoM,
                                                 flags=multipartRequest.flags, body=meterFeatures)
             message = sendMultipartReply.pack()
-            self.socket.send(message)
+            self.send_message(message)
             logging.info("OFPMP_METER_FEATURES")
 
         if tipoM == MultipartType.OFPMP_PORT_DESC: #OFPMP_PORT_DESC
-            sendMultipartReply = MultipartReply(xid=multipartRequest.header.xid, multipart_type=tipoM,
-                                                flags=multipartRequest.flags, body=self.listPorts)
-            message = sendMultipartReply.pack()
-            self.socket.send(message)
+            self.send_multipart_reply(multipartRequest.header.xid, tipoM, self.listPorts)
             logging.info("OFPMP_PORT_DESC")
 
-    def send_OFPT_BARRIER_REPLY(self, header):
-        sendBarrierReply = BarrierReply(xid=header.xid)
+    def send_multipart_reply(self, xid, multipart_type, items):
+        """Send a multipart body split in as many OFPT_MULTIPART_REPLY
+            messages as needed (OFPMPF_REPLY_MORE), so large tables do not
+            overflow the OpenFlow length field.
+
+        Args:
+                xid (int): xid of the OFPT_MULTIPART_REQUEST
+                multipart_type (MultipartType): type of the multipart body
+                items (iterable): pyof objects of the body
+        """
+
+        for message in multipart_reply_segments(xid, multipart_type, items):
+            self.send_message(message)
+
+    def get_OFPT_BARRIER_REQUEST(self, header, frame):
+        # The reply waits for the FLOW_MODs still on the agent queue
+        self.barriers.barrier(header.xid)
+
+    def send_OFPT_BARRIER_REPLY(self, xid):
+        sendBarrierReply = BarrierReply(xid=xid)
         message = sendBarrierReply.pack()
-        self.socket.send(message)
+        self.send_message(message)
         logging.info("OFPT_BARRIER_REPLY")
 
-    def send_OFPT_ROLE_REPLY(self, extraByte, header, data, storeRole):
+    def send_OFPT_ROLE_REPLY(self, header, frame, storeRole):
         roleRequest = RoleRequest(xid=header.xid)
-        roleRequest.unpack(data, extraByte+header.get_size())
+        roleRequest.unpack(bytes(frame), header.get_size())
         role = roleRequest.role
         generationID = roleRequest.generation_id
 
@@ -827,25 +1067,25 @@ class ONOSAdaptor:
             storeRole = ControllerRole.OFPCR_ROLE_EQUAL
             sendRoleReply = RoleReply(xid=roleRequest.header.xid, role=storeRole)
             message = sendRoleReply.pack()
-            self.socket.send(message)
+            self.send_message(message)
             logging.info("OFPT_ROLE_REPLY 1")
         elif role == ControllerRole.OFPCR_ROLE_NOCHANGE:
             sendRoleReply = RoleReply(xid=roleRequest.header.xid, role=storeRole, generation_id=generationID)
             message = sendRoleReply.pack()
-            self.socket.send(message)
+            self.send_message(message)
             logging.info("OFPT_ROLE_REPLY 2")
         else:
             storeRole = role
             sendRoleReply = RoleReply(xid=roleRequest.header.xid, role=role, generation_id=generationID)
             message = sendRoleReply.pack()
-            self.socket.send(message)
+            self.send_message(message)
             logging.info("OFPT_ROLE_REPLY 3")
 
         return storeRole
 
-    def get_OFPT_METER_MOD(self, extraByte, header, data):
+    def get_OFPT_METER_MOD(self, header, frame):
         meterMod = MeterMod(xid=header.xid)
-        meterMod.unpack(data[extraByte:extraByte+header.length.value], header.get_size())
+        meterMod.unpack(bytes(frame), header.get_size())
 
         if meterMod.command == MeterModCommand.OFPMC_ADD: #Si el tipo es OFPMC_ADD
             lBS = [] #Creamos una lista para guardar los "band stats"
@@ -869,9 +1109,9 @@ class ONOSAdaptor:
 
         logging.info("OFPT_METER_MOD")
 
-    def get_OFPT_GROUP_MOD(self, extraByte, header, data):
+    def get_OFPT_GROUP_MOD(self, header, frame):
         groupMod = GroupMod(xid=header.xid)
-        groupMod.unpack(data[extraByte:extraByte+header.length.value], header.get_size())
+        groupMod.unpack(bytes(frame), header.get_size())
 
         if groupMod.command == GroupModCommand.OFPGC_DELETE:
             logging.info("Group deletion")
@@ -943,7 +1183,7 @@ class ONOSAdaptor:
         # Send OFPT_PORT_STATUS message
         port_status = PortStatus(xid=None, reason=reason, desc=port)
         message = port_status.pack()
-        self.socket.send(message)
+        self.send_message(message)
 
         # Add Port to List of Ports
         self.listPorts.append(port)
@@ -968,7 +1208,7 @@ class ONOSAdaptor:
 
         error_msg = ErrorMsg(xid = flowMod.header.xid, error_type = ErrorType.OFPET_FLOW_MOD_FAILED, code = ErrorCode, data = flowData)
         message = error_msg.pack()
-        self.socket.send(message)
+        self.send_message(message)
 
         logging.info("Send OFPT_ERROR")
 
@@ -997,10 +1237,24 @@ class ONOSAdaptor:
         logging.info("****Flow ID: %d", flow_id)
         logging.info("****Action: %s", flow_action)
 
+        seq = self.barriers.queued()
+
         data = src.agentQueue.Flow(flow_id, flow_action)
-        item = src.agentQueue.QueueItem(self.queue_id, "onos", data)
+        item = src.agentQueue.QueueItem(self.queue_id, "onos", data,
+                                        on_done = lambda: self.barriers.completed(seq))
+        # Blocks while the OLT queue is full, so the controller stops being read
         oltQueue.put(item)
 
+    def queue_full(self):
+        """True while a FLOW_MOD could not be queued without blocking"""
+
+        return oltQueue.partition(self.queue_id).full(src.agentQueue.CONTROL)
+
+    def wait_queue_not_full(self, timeout = None):
+        """Block until a FLOW_MOD can be queued. Returns False on timeout."""
+
+        return oltQueue.partition(self.queue_id).wait_not_full(src.agentQueue.CONTROL, timeout)
+
     def getFlowParameters(self, flow_struct):
         """Get Flow parameters"""
 
@@ -1146,34 +1400,47 @@ class ONOSAdaptor:
         """Find all related Flows to create a Service"""
         service = None
 
-        flowParams = self.listF.getFlow(flow_id)
-        if flowParams is None:
-            logging.error("Error: Flow with id %d doesn't exist", flow_id)
-            return None
+        with self.listF.lock:
+            flowParams = self.listF.getFlow(flow_id)
+            if flowParams is None:
+                logging.error("Error: Flow with id %d doesn't exist", flow_id)
+                return None
 
-        if flowParams["tableId"] > 0:
-            service = self.backwardTable(flowParams)
-            if service is None:
-                return []
+            if flowParams["tableId"] > 0:
+                service = self.backwardTable(flowParams)
+                if service is None:
+                    return []
 
-        services = self.forwardTable(flowParams, service)
+            services = self.forwardTable(flowParams, service)
 
         return services
 
-    def matchPorts(self, portsList):
+    def matchPorts(self, portsList, relinked = None):
+        """Services of the flows on the ports. With 'relinked' (flowIds
+            returned by delete_flow) only the chains going through them
+            are matched again
+        """
         services = []
+        chains = set() # Flow chains already found from another port
         for port in portsList:
-            groupIDs = self.listGr.get_groupsByPort(port)
+            groupIDs = self.listGr.get_groupsByPort(port["port_no"])
 
-            flows = self.listF.get_port_matched_flows(port["port_no"], port["flowType"], groupIDs)
+            with self.listF.lock:
+                flows = self.listF.get_port_matched_flows(port["port_no"], port["flowType"], groupIDs)
 
-            for f in flows:
-                services.extend(self.matchFlows(flow_id = f["flowId"]))
+                for f in flows:
+                    if relinked is not None and not self.listF.chain_changed(f, relinked):
+                        continue
+                    for service in self.matchFlows(flow_id = f["flowId"]):
+                        chain = tuple(service["flowIds"])
+                        if chain not in chains:
+                            chains.add(chain)
+                            services.append(service)
 
         return services
 
     def backwardTable(self, flowParams, service = None):
-        backFlows = self.listF.get_matched_flow(flowParams, (flowParams["tableId"] - 1))
+        backFlows = self.listF.get_linked_flows(flowParams, (flowParams["tableId"] - 1))
         if len(backFlows) != 1:
             logging.error("Can't mach backward Flow. Matched Flows: %d", len(backFlows))
             return None
@@ -1325,21 +1592,24 @@ class ONOSAdaptor:
         if serviceEnd:
             services.append(service)
         elif nextTable is not None:
-            fwFlows = self.listF.get_matched_flow(flowParams, nextTable)
+            fwFlows = self.listF.get_linked_flows(flowParams, nextTable)
             for fwFlow in fwFlows:
                 services.extend(self.forwardTable(fwFlow, service))
 
         return services
 
     def delete_flow(self, flow_id):
-        flowParams = self.listF.getFlow(flow_id)
-        if flowParams is None:
-            logging.error("Error: Flow with id %d doesn't exist", flow_id)
-            return None
+        with self.listF.lock:
+            flowParams = self.listF.getFlow(flow_id)
+            if flowParams is None:
+                logging.error("Error: Flow with id %d doesn't exist", flow_id)
+                return None
 
-        self.listF.delete(flow_id, flowParams["tableId"])
+            relinked = self.listF.delete(flow_id, flowParams["tableId"])
         self.listFS.delete(flow_id)
 
+        return relinked
+
     def free_flowMod(self, flow_id):
         if flow_id in self.cookie_to_flowMod:
             self.cookie_to_flowMod.pop(flow_id)
@@ -0,0 +1,115 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import logging
+import grpc
+
+# RPC that undoes each install RPC, with the same request
+UNDO_RPCS = {
+    "CreateTrafficSchedulers": "RemoveTrafficSchedulers",
+    "CreateTrafficQueues": "RemoveTrafficQueues",
+    "FlowAdd": "FlowRemove",
+    "PerformGroupOperation": "DeleteGroup"
+}
+
+class RpcPipeline:
+    """Install RPCs of a service grouped in stages.
+
+        The RPCs of a stage are independent, so they are sent together and
+        only their slowest answer is waited for. A stage starts once every
+        RPC of the previous one has succeeded, for the objects the OLT
+        requires to exist first (e.g. schedulers, then queues, then flows).
+        When an RPC fails, every RPC sent is undone, the last stage first.
+    """
+
+    def __init__(self, olt):
+        """Initialize variables:
+                olt (OLTadaptor): OLT receiving the RPCs
+        """
+
+        self.olt = olt
+        self.stages = []
+
+    def stage(self, *calls):
+        """Add a stage. Each call is a tuple (method, request), or
+            (method, request, undo_method) with None when it needs no undo.
+            The calls with a None request are skipped.
+
+        Return:
+            The pipeline, so the stages can be chained.
+        """
+
+        calls = [call if len(call) == 3 else (call[0], call[1], UNDO_RPCS.get(call[0]))
+                 for call in calls if call[1] is not None]
+        if calls:
+            self.stages.append(calls)
+
+        return self
+
+    def run(self, resync = False):
+        """Send the stages in order.
+
+        Return:
+            True when every RPC succeeded, False when the pipeline has
+            been rolled back.
+
+        Args:
+                resync (bool): the RPCs were already sent to the OLT, an
+                               ALREADY_EXISTS answer counts as installed and
+                               nothing is rolled back when an RPC fails
+        """
+
+        sent = [] # Stages sent: list(list(undo_method, request))
+
+        for calls in self.stages:
+            futures = [(call, self.olt._rpc_future(call[0], call[1])) for call in calls]
+
+            ok = True
+            for (method, request, undo), future in futures:
+                try:
+                    future.result()
+                except grpc.RpcError as e:
+                    if resync and e.code() == grpc.StatusCode.ALREADY_EXISTS:
+                        continue
+                    logging.error("RPC ERROR recived on OLT %s:%d | %s | Details: %s",
+                                  self.olt.ip_address, self.olt.port, e.code().name, e.details())
+                    ok = False
+
+            # The failed RPCs are undone too, they may be partially applied
+            sent.append([(undo, request) for method, request, undo in calls if undo is not None])
+
+            if not ok:
+                if not resync:
+                    self.rollback(sent)
+                return False
+
+        return True
+
+    def rollback(self, sent):
+        """Undo the stages sent, in reverse order. The undo RPCs of a stage
+            are sent together, their errors are only logged.
+        """
+
+        for undos in reversed(sent):
+            futures = [self.olt._rpc_future(undo, request) for undo, request in undos]
+
+            for future in futures:
+                try:
+                    future.result()
+                except grpc.RpcError as e:
+                    logging.error("RPC ERROR recived on OLT %s:%d | %s | Details: %s",
+                                  self.olt.ip_address, self.olt.port, e.code().name, e.details())
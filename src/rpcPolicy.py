@@ -0,0 +1,255 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import concurrent.futures
+import logging
+import random
+import threading
+import time
+import grpc
+
+# Local imports
+from src.agentMetrics import registry
+
+# Deadline in seconds of each Openolt RPC, "default" for the rest
+DEFAULT_DEADLINES = {
+    "default": 10,
+    "GetDeviceInfo": 5,
+    "OmciMsgOut": 3
+}
+
+# RPCs that can be sent again when the OLT did not answer
+IDEMPOTENT_RPCS = frozenset(("GetDeviceInfo", "FlowRemove", "DeleteGroup",
+                             "RemoveTrafficSchedulers", "RemoveTrafficQueues"))
+
+# Status codes of an OLT that did not answer: they are retried and
+# counted by the circuit breaker. Any other error is an answer of the OLT.
+TRANSIENT_CODES = frozenset((grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED))
+
+class CircuitOpenError(grpc.RpcError):
+    """RPC not sent because the circuit breaker of the OLT is open"""
+
+    def __init__(self, name, remaining):
+        super().__init__()
+        self.name = name
+        self.remaining = remaining
+
+    def code(self):
+        return grpc.StatusCode.UNAVAILABLE
+
+    def details(self):
+        return "OLT %s unhealthy, RPCs fail fast for %.1f s" % (self.name, self.remaining)
+
+    def __str__(self):
+        return self.details()
+
+class CircuitBreaker:
+    """Circuit breaker of the RPCs of one OLT.
+
+        After 'failures' consecutive RPCs without answer the circuit opens
+        and the RPCs fail at once for 'reset_timeout' seconds. Then a single
+        RPC is let through: the circuit closes if the OLT answers it and
+        opens again otherwise, also when it is cancelled first.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name, failures = 5, reset_timeout = 30):
+        """Initialize variables:
+                name (string): OLT of the circuit, for the logs
+                failures (int): consecutive failures that open the circuit
+                reset_timeout (float): seconds before trying the OLT again
+        """
+
+        self.name = name
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self._count = 0 # Consecutive failures
+        self._opened = 0 # time.monotonic() when the circuit opened
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Check if an RPC can be sent, only one while half-open"""
+
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN and self.remaining() == 0:
+                self.state = self.HALF_OPEN
+                return True
+
+            return False
+
+    def remaining(self):
+        """Seconds until the open circuit lets an RPC through"""
+
+        return max(0, self._opened + self.reset_timeout - time.monotonic())
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logging.info("OLT %s answers again, circuit breaker closed", self.name)
+            self.state = self.CLOSED
+            self._count = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._count += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._count >= self.failures):
+                logging.error("OLT %s does not answer, circuit breaker open for %g s", self.name, self.reset_timeout)
+                self.state = self.OPEN
+                self._opened = time.monotonic()
+
+    def record_cancelled(self):
+        """An RPC was cancelled before the OLT answered. Only one RPC is let
+            through while half-open, so it was the probe: the circuit opens
+            again, otherwise no RPC would ever be allowed.
+        """
+
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                logging.warning("Probe RPC to OLT %s cancelled, circuit breaker open for %g s",
+                                self.name, self.reset_timeout)
+                self.state = self.OPEN
+                self._opened = time.monotonic()
+
+class RpcPolicy:
+    """Deadline, retries and circuit breaker of the RPCs sent to one OLT"""
+
+    def __init__(self, name, deadlines = None, retries = 3, backoff = 0.1, max_backoff = 2,
+                 breaker_failures = 5, breaker_reset = 30):
+        """Initialize variables:
+                name (string): OLT of the RPCs
+                deadlines (dict): seconds per RPC name, merged with DEFAULT_DEADLINES
+                retries (int): extra attempts of the idempotent RPCs
+                backoff (float): delay before the first retry, doubled on each one
+                max_backoff (float): maximum delay between retries
+                breaker_failures (int): see CircuitBreaker
+                breaker_reset (float): see CircuitBreaker
+        """
+
+        self.name = name
+        self.deadlines = dict(DEFAULT_DEADLINES)
+        self.deadlines.update(deadlines or {})
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker(name, breaker_failures, breaker_reset)
+
+    def deadline(self, method):
+        return self.deadlines.get(method, self.deadlines["default"])
+
+    def call(self, stub, method, request, timeout = None, retry = True):
+        """Send an RPC with its deadline, retrying it with exponential
+            backoff while the OLT does not answer, if it is idempotent.
+
+        Return:
+            The RPC response. Raises grpc.RpcError as the stub does, or
+            CircuitOpenError while the OLT is unhealthy.
+
+        Args:
+                stub (OpenoltStub): stub of the OLT channel
+                method (string): RPC name
+                request (message): RPC request
+                timeout (float): deadline of this call instead of the configured one
+                retry (bool): False to send the RPC once
+        """
+
+        if timeout is None:
+            timeout = self.deadline(method)
+        attempts = 1 + self.retries if (retry and method in IDEMPOTENT_RPCS) else 1
+        delay = self.backoff
+
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                raise CircuitOpenError(self.name, self.breaker.remaining())
+
+            start = time.monotonic()
+            try:
+                response = getattr(stub, method)(request, timeout = timeout)
+            except grpc.RpcError as e:
+                if e.code() == grpc.StatusCode.CANCELLED:
+                    self.breaker.record_cancelled()
+                    raise
+                if e.code() not in TRANSIENT_CODES:
+                    self.breaker.record_success()
+                    raise
+
+                self.breaker.record_failure()
+                if attempt + 1 == attempts:
+                    raise
+
+                logging.warning("RPC %s to OLT %s failed (%s), retry %d of %d",
+                                method, self.name, e.code().name, attempt + 1, self.retries)
+                # Jitter, so the ONU lanes of the OLT do not retry together
+                time.sleep(delay * random.uniform(0.5, 1))
+                delay = min(2 * delay, self.max_backoff)
+            else:
+                self.breaker.record_success()
+                return response
+            finally:
+                registry.observe("rpc_time", time.monotonic() - start, self.name, method)
+
+    def call_future(self, stub, method, request, timeout = None):
+        """Start an RPC with its deadline and return at once. The RPC is not
+            retried, so it is meant for the RPCs that are not idempotent.
+
+        Return:
+            Future of the RPC (grpc.Future or concurrent.futures.Future),
+            result() returns the response or raises grpc.RpcError.
+            CircuitOpenError is raised through the future as well.
+
+        Args:
+                stub (OpenoltStub): stub of the OLT channel
+                method (string): RPC name
+                request (message): RPC request
+                timeout (float): deadline of this call instead of the configured one
+        """
+
+        if not self.breaker.allow():
+            future = concurrent.futures.Future()
+            future.set_exception(CircuitOpenError(self.name, self.breaker.remaining()))
+            return future
+
+        if timeout is None:
+            timeout = self.deadline(method)
+
+        start = time.monotonic()
+        future = getattr(stub, method).future(request, timeout = timeout)
+        future.add_done_callback(lambda f: self._record(f, method, start))
+
+        return future
+
+    def _record(self, future, method, start):
+        registry.observe("rpc_time", time.monotonic() - start, self.name, method)
+
+        if future.cancelled():
+            self.breaker.record_cancelled()
+            return
+
+        error = future.exception()
+        if isinstance(error, grpc.RpcError) and error.code() == grpc.StatusCode.CANCELLED:
+            self.breaker.record_cancelled()
+        elif isinstance(error, grpc.RpcError) and error.code() in TRANSIENT_CODES:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
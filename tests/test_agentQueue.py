@@ -0,0 +1,148 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import queue
+import threading
+
+import pytest
+
+# Local imports
+from src.agentQueue import (ACTIVATION, CONTROL, STATS, ClassQueue, Flow, FlowStatsInd, OnuInd,
+                            QueueItem, ShardedQueue)
+
+DATAPATH = "00:00:0000000000000001"
+
+def flow(cookie):
+    return QueueItem(DATAPATH, "onos", Flow(cookie, 0))
+
+def onu_ind(onu_id):
+    return QueueItem(DATAPATH, "olt", OnuInd(1, onu_id, "up", "up", 0))
+
+def stats(flow_id, rx_bytes = 1, timestamp = 1):
+    return QueueItem(DATAPATH, "olt", FlowStatsInd(flow_id, rx_bytes, 1, 0, 0, timestamp))
+
+def drain(classQueue):
+    items = []
+    while classQueue.qsize() > 0:
+        items.append(classQueue.get(block = False))
+        classQueue.task_done()
+    return items
+
+def test_weighted_round_robin():
+    classQueue = ClassQueue(weights = {CONTROL: 2, ACTIVATION: 1, STATS: 1})
+    for i in range(3):
+        classQueue.put(stats(i))
+        classQueue.put(onu_ind(i))
+        classQueue.put(flow(i))
+
+    kinds = [item.kind for item in drain(classQueue)]
+    control, activation, flowStats = flow(0).kind, onu_ind(0).kind, stats(0).kind
+    assert kinds == [control, control, activation, flowStats,
+                     control, activation, flowStats, activation, flowStats]
+
+def test_stats_merged_per_flow():
+    classQueue = ClassQueue()
+    classQueue.put(stats(1, rx_bytes = 10, timestamp = 5))
+    classQueue.put(stats(2))
+    classQueue.put(stats(1, rx_bytes = 5, timestamp = 7))
+
+    items = drain(classQueue)
+    assert [item.data.flow_id for item in items] == [1, 2]
+    assert items[0].data.rx_bytes == 15
+    assert items[0].data.rx_packets == 2
+    assert items[0].data.timestamp == 7
+    assert classQueue.merged == 1
+
+def test_drop_oldest_stats():
+    classQueue = ClassQueue(limits = {STATS: 2})
+    for flow_id in range(3):
+        classQueue.put(stats(flow_id))
+
+    assert classQueue.dropped == 1
+    assert [item.data.flow_id for item in drain(classQueue)] == [1, 2]
+
+    # The dropped flow is not merged into a waiting item any more
+    classQueue.put(stats(0))
+    assert classQueue.merged == 0
+
+def test_block_when_control_is_full():
+    classQueue = ClassQueue(limits = {CONTROL: 1})
+    classQueue.put(flow(1))
+
+    with pytest.raises(queue.Full):
+        classQueue.put(flow(2), block = False)
+    with pytest.raises(queue.Full):
+        classQueue.put(flow(2), timeout = 0.01)
+    assert classQueue.full(CONTROL)
+
+    # A blocked producer goes on once a worker takes an item
+    producer = threading.Thread(target = classQueue.put, args = (flow(3),))
+    producer.start()
+    assert classQueue.get(timeout = 5).data.flow_id == 1
+    producer.join(timeout = 5)
+    assert not producer.is_alive()
+    assert classQueue.get(timeout = 5).data.flow_id == 3
+
+def test_wait_not_full():
+    classQueue = ClassQueue(limits = {CONTROL: 1})
+    classQueue.put(flow(1))
+    assert not classQueue.wait_not_full(CONTROL, timeout = 0.01)
+
+    threading.Timer(0.05, classQueue.get).start()
+    assert classQueue.wait_not_full(CONTROL, timeout = 5)
+
+def test_spill_read_back_in_order(tmp_path):
+    classQueue = ClassQueue(limits = {ACTIVATION: 2}, spill_dir = str(tmp_path))
+    for onu_id in range(6):
+        classQueue.put(onu_ind(onu_id))
+
+    assert classQueue.spilled == 4
+    assert classQueue.qsize() == 6
+    assert classQueue.depth()[ACTIVATION][0] == 6
+
+    # Interleaved puts keep the order of the class
+    assert classQueue.get().data.onu_id == 0
+    classQueue.put(onu_ind(6))
+    assert [item.data.onu_id for item in drain(classQueue)] == [1, 2, 3, 4, 5, 6]
+
+    # The spill file is reused once it is empty
+    classQueue.put(onu_ind(7))
+    assert classQueue.get().data.onu_id == 7
+
+@pytest.mark.parametrize("limit", [0, -1])
+def test_limit_below_one_rejected(limit):
+    with pytest.raises(ValueError):
+        ClassQueue(limits = {STATS: limit})
+
+    shardedQueue = ShardedQueue()
+    with pytest.raises(ValueError):
+        shardedQueue.configure(limits = {ACTIVATION: limit})
+    assert shardedQueue.limits[ACTIVATION] > 0
+
+def test_partition_per_olt():
+    shardedQueue = ShardedQueue()
+    shardedQueue.put(flow(1))
+    shardedQueue.put_many([stats(1), stats(1, rx_bytes = 2)])
+    other = QueueItem("00:00:0000000000000002", "onos", Flow(2, 0))
+    shardedQueue.put(other)
+
+    assert shardedQueue.qsize() == 3
+    assert shardedQueue.partition(DATAPATH).qsize() == 2
+    assert shardedQueue.partition(DATAPATH).merged == 1
+
+    shardedQueue.remove_partition(DATAPATH)
+    assert shardedQueue.qsize() == 1
@@ -0,0 +1,65 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import threading
+import time
+
+import pytest
+
+# Local imports
+from src.keyedExecutor import KeyedExecutor
+
+@pytest.fixture
+def executor():
+    executor = KeyedExecutor(max_workers = 4, name = "test")
+    yield executor
+    executor.shutdown()
+
+def test_same_key_in_submission_order(executor):
+    done = []
+
+    def task(i):
+        # The first tasks are the slowest, a reordering would show
+        time.sleep(0.001 * (20 - i) / 4)
+        done.append(i)
+
+    futures = [executor.submit((0, 1), task, i) for i in range(20)]
+    for future in futures:
+        future.result(timeout = 5)
+
+    assert done == list(range(20))
+    assert executor.pending() == 0
+
+def test_different_keys_run_concurrently(executor):
+    # Each task waits for the other one, it only ends if both run at once
+    meeting = threading.Barrier(2, timeout = 5)
+
+    futures = [executor.submit((0, onu_id), meeting.wait) for onu_id in (1, 2)]
+    for future in futures:
+        future.result(timeout = 5)
+
+def test_exception_in_the_future(executor):
+    def fail():
+        raise ValueError("wrong")
+
+    failed = executor.submit("key", fail)
+    after = executor.submit("key", lambda: "next")
+
+    with pytest.raises(ValueError):
+        failed.result(timeout = 5)
+    # The lane goes on after the error
+    assert after.result(timeout = 5) == "next"
@@ -0,0 +1,70 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import random
+import threading
+
+# Local imports
+from src.ofBarrier import BarrierTracker
+
+def test_reply_without_pending_work():
+    replies = []
+    barriers = BarrierTracker(replies.append)
+
+    barriers.barrier(1)
+    assert replies == [1]
+
+def test_reply_held_until_the_queued_items_are_handled():
+    replies = []
+    barriers = BarrierTracker(replies.append)
+
+    first = barriers.queued()
+    second = barriers.queued()
+    barriers.barrier(10)
+
+    # An item queued after the barrier does not hold it
+    third = barriers.queued()
+    barriers.barrier(11)
+
+    barriers.completed(second)
+    assert replies == []
+    assert barriers.pending() == 2
+
+    barriers.completed(first)
+    assert replies == [10]
+
+    barriers.completed(third)
+    assert replies == [10, 11]
+    assert barriers.pending() == 0
+
+def test_replies_in_xid_order_from_several_threads():
+    replies = []
+    barriers = BarrierTracker(replies.append)
+
+    seqs = []
+    for xid in range(200):
+        seqs.append(barriers.queued())
+        barriers.barrier(xid)
+    random.Random(1).shuffle(seqs)
+
+    threads = [threading.Thread(target = barriers.completed, args = (seq,)) for seq in seqs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert replies == list(range(200))
@@ -0,0 +1,86 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import struct
+
+from pyof.v0x04.common.header import Type
+from pyof.v0x04.controller2switch.multipart_reply import MultipartReplyFlags
+from pyof.v0x04.controller2switch.common import MultipartType
+
+# Local imports
+from src.ofMultipart import MULTIPART_HEADER_LEN, OFP_MAX_LENGTH, multipart_reply_segments
+
+REPLY_MORE = MultipartReplyFlags.OFPMPF_REPLY_MORE.value
+
+class Packed:
+    """Multipart body item packed as 'size' bytes of 'value'"""
+
+    def __init__(self, size, value = 0):
+        self.data = bytes([value % 256]) * size
+
+    def pack(self):
+        return self.data
+
+def unpack(segment):
+    version, message_type, length, xid, multipart_type, flags = struct.unpack_from("!BBHIHH", segment, 0)
+    return {"version": version, "type": message_type, "length": length, "xid": xid,
+            "multipart_type": multipart_type, "flags": flags, "body": segment[MULTIPART_HEADER_LEN:]}
+
+def test_split_with_reply_more():
+    items = [Packed(6107, i) for i in range(31)]
+    segments = [unpack(segment) for segment in multipart_reply_segments(7, MultipartType.OFPMP_FLOW, items)]
+
+    # 10 items fit in each message, the last one takes the rest
+    assert [segment["length"] for segment in segments] == [61086, 61086, 61086, 6123]
+    assert [segment["flags"] for segment in segments] == [REPLY_MORE, REPLY_MORE, REPLY_MORE, 0]
+    for segment in segments:
+        assert segment["length"] <= OFP_MAX_LENGTH
+        assert segment["type"] == Type.OFPT_MULTIPART_REPLY.value
+        assert segment["xid"] == 7
+        assert segment["multipart_type"] == MultipartType.OFPMP_FLOW.value
+
+    # The items are sent whole and in order
+    assert b"".join(segment["body"] for segment in segments) == b"".join(item.pack() for item in items)
+
+def test_body_filling_the_message():
+    maxBody = OFP_MAX_LENGTH - MULTIPART_HEADER_LEN
+    segments = [unpack(segment) for segment in
+                multipart_reply_segments(1, MultipartType.OFPMP_PORT_STATS, [Packed(maxBody), Packed(1)])]
+
+    assert [segment["length"] for segment in segments] == [OFP_MAX_LENGTH, MULTIPART_HEADER_LEN + 1]
+    assert [segment["flags"] for segment in segments] == [REPLY_MORE, 0]
+
+def test_empty_body():
+    segments = [unpack(segment) for segment in multipart_reply_segments(3, MultipartType.OFPMP_GROUP, [])]
+
+    assert len(segments) == 1
+    assert segments[0]["length"] == MULTIPART_HEADER_LEN
+    assert segments[0]["flags"] == 0
+
+def test_oversized_item_discarded():
+    items = [Packed(10, 1), Packed(OFP_MAX_LENGTH, 2), Packed(10, 3)]
+    segments = [unpack(segment) for segment in multipart_reply_segments(5, MultipartType.OFPMP_FLOW, items)]
+
+    assert len(segments) == 1
+    assert segments[0]["body"] == items[0].pack() + items[2].pack()
+
+def test_max_length():
+    segments = [unpack(segment) for segment in
+                multipart_reply_segments(9, MultipartType.OFPMP_FLOW, [Packed(100, i) for i in range(5)], max_length = 250)]
+
+    assert [segment["length"] for segment in segments] == [216, 216, 116]
+    assert [segment["flags"] for segment in segments] == [REPLY_MORE, REPLY_MORE, 0]
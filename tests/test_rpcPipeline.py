@@ -0,0 +1,112 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import concurrent.futures
+
+import grpc
+
+# Local imports
+from src.rpcPipeline import RpcPipeline
+
+class RpcError(grpc.RpcError):
+    def __init__(self, code):
+        super().__init__()
+        self._code = code
+
+    def code(self):
+        return self._code
+
+    def details(self):
+        return self._code.name
+
+class FakeOLT:
+    """OLT answering the RPCs at once, with the error set for a (method, request)"""
+
+    ip_address = "10.0.0.1"
+    port = 9191
+
+    def __init__(self, errors = None):
+        self.errors = errors or {}
+        self.sent = [] # (method, request)
+
+    def _rpc_future(self, method, request):
+        self.sent.append((method, request))
+        future = concurrent.futures.Future()
+        error = self.errors.get((method, request))
+        if error is not None:
+            future.set_exception(RpcError(error))
+        else:
+            future.set_result(None)
+        return future
+
+def service(olt):
+    return (RpcPipeline(olt)
+            .stage(("CreateTrafficSchedulers", "us-sched"), ("CreateTrafficSchedulers", "ds-sched"))
+            .stage(("CreateTrafficQueues", "us-queue"), ("CreateTrafficQueues", None))
+            .stage(("FlowAdd", "us-flow"), ("FlowAdd", "ds-flow")))
+
+def test_stages_in_order():
+    olt = FakeOLT()
+
+    assert service(olt).run()
+    # The calls with a None request are skipped
+    assert olt.sent == [("CreateTrafficSchedulers", "us-sched"), ("CreateTrafficSchedulers", "ds-sched"),
+                        ("CreateTrafficQueues", "us-queue"),
+                        ("FlowAdd", "us-flow"), ("FlowAdd", "ds-flow")]
+
+def test_failure_rolls_back_last_stage_first():
+    olt = FakeOLT({("CreateTrafficQueues", "us-queue"): grpc.StatusCode.INTERNAL})
+
+    assert not service(olt).run()
+    # The flows are never sent, the failed RPC is undone as well
+    assert olt.sent[3:] == [("RemoveTrafficQueues", "us-queue"),
+                            ("RemoveTrafficSchedulers", "us-sched"), ("RemoveTrafficSchedulers", "ds-sched")]
+
+def test_rollback_goes_on_after_undo_errors():
+    olt = FakeOLT({("FlowAdd", "ds-flow"): grpc.StatusCode.UNAVAILABLE,
+                   ("FlowRemove", "us-flow"): grpc.StatusCode.NOT_FOUND})
+
+    assert not service(olt).run()
+    assert [method for method, request in olt.sent[5:]] == ["FlowRemove", "FlowRemove", "RemoveTrafficQueues",
+                                                           "RemoveTrafficSchedulers", "RemoveTrafficSchedulers"]
+
+def test_call_without_undo():
+    olt = FakeOLT({("FlowAdd", "flow"): grpc.StatusCode.INTERNAL})
+    pipeline = RpcPipeline(olt).stage(("CreateTrafficSchedulers", "sched", None)).stage(("FlowAdd", "flow"))
+
+    assert not pipeline.run()
+    assert olt.sent == [("CreateTrafficSchedulers", "sched"), ("FlowAdd", "flow"), ("FlowRemove", "flow")]
+
+def test_resync_accepts_already_exists():
+    olt = FakeOLT({("CreateTrafficSchedulers", "us-sched"): grpc.StatusCode.ALREADY_EXISTS,
+                   ("FlowAdd", "us-flow"): grpc.StatusCode.ALREADY_EXISTS})
+
+    assert service(olt).run(resync = True)
+    assert len(olt.sent) == 5
+
+def test_resync_failure_not_rolled_back():
+    olt = FakeOLT({("CreateTrafficQueues", "us-queue"): grpc.StatusCode.INTERNAL})
+
+    assert not service(olt).run(resync = True)
+    assert [method for method, request in olt.sent] == ["CreateTrafficSchedulers", "CreateTrafficSchedulers",
+                                                       "CreateTrafficQueues"]
+
+def test_already_exists_fails_an_install():
+    olt = FakeOLT({("FlowAdd", "us-flow"): grpc.StatusCode.ALREADY_EXISTS})
+
+    assert not service(olt).run()
+    assert ("RemoveTrafficSchedulers", "us-sched") in olt.sent
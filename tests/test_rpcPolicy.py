@@ -0,0 +1,173 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import concurrent.futures
+import time
+
+import grpc
+import pytest
+
+# Local imports
+from src.rpcPolicy import CircuitBreaker, CircuitOpenError, RpcPolicy
+
+class RpcError(grpc.RpcError):
+    def __init__(self, code):
+        super().__init__()
+        self._code = code
+
+    def code(self):
+        return self._code
+
+    def details(self):
+        return self._code.name
+
+class Method:
+    """Stub method answering with the given results in turn, an exception
+        instance is raised
+    """
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = 0
+        self.futures = []
+
+    def __call__(self, request, timeout = None):
+        self.calls += 1
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def future(self, request, timeout = None):
+        self.calls += 1
+        future = concurrent.futures.Future()
+        self.futures.append(future)
+        return future
+
+class Stub:
+    def __init__(self, **methods):
+        self.__dict__.update(methods)
+
+UNAVAILABLE = grpc.StatusCode.UNAVAILABLE
+
+def policy(**kwargs):
+    kwargs.setdefault("backoff", 0)
+    return RpcPolicy("olt", **kwargs)
+
+def test_idempotent_rpc_retried():
+    method = Method(RpcError(UNAVAILABLE), RpcError(grpc.StatusCode.DEADLINE_EXCEEDED), "info")
+
+    assert policy(retries = 3).call(Stub(GetDeviceInfo = method), "GetDeviceInfo", None) == "info"
+    assert method.calls == 3
+
+def test_other_rpc_sent_once():
+    method = Method(RpcError(UNAVAILABLE), "done")
+
+    with pytest.raises(grpc.RpcError):
+        policy(retries = 3).call(Stub(FlowAdd = method), "FlowAdd", None)
+    assert method.calls == 1
+
+def test_answer_error_not_retried():
+    rpcPolicy = policy(retries = 3, breaker_failures = 1)
+    method = Method(RpcError(grpc.StatusCode.INVALID_ARGUMENT))
+
+    with pytest.raises(grpc.RpcError):
+        rpcPolicy.call(Stub(FlowRemove = method), "FlowRemove", None)
+    assert method.calls == 1
+    # The OLT answered, the circuit stays closed
+    assert rpcPolicy.breaker.state == CircuitBreaker.CLOSED
+
+def test_breaker_opens_and_fails_fast():
+    rpcPolicy = policy(retries = 0, breaker_failures = 2, breaker_reset = 60)
+    method = Method(RpcError(UNAVAILABLE), RpcError(UNAVAILABLE), "done")
+    stub = Stub(FlowAdd = method)
+
+    for i in range(2):
+        with pytest.raises(grpc.RpcError):
+            rpcPolicy.call(stub, "FlowAdd", None)
+    assert rpcPolicy.breaker.state == CircuitBreaker.OPEN
+
+    with pytest.raises(CircuitOpenError) as error:
+        rpcPolicy.call(stub, "FlowAdd", None)
+    assert error.value.code() == UNAVAILABLE
+    assert method.calls == 2
+
+    future = rpcPolicy.call_future(stub, "FlowAdd", None)
+    with pytest.raises(CircuitOpenError):
+        future.result()
+
+def open_breaker(reset_timeout = 0.01):
+    breaker = CircuitBreaker("olt", failures = 1, reset_timeout = reset_timeout)
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    time.sleep(reset_timeout)
+    return breaker
+
+def test_half_open_single_probe():
+    breaker = open_breaker()
+
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+def test_half_open_probe_failure_reopens():
+    breaker = open_breaker()
+
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+def test_cancelled_probe_reopens():
+    rpcPolicy = policy(breaker_failures = 1, breaker_reset = 0.01)
+    rpcPolicy.breaker.record_failure()
+    time.sleep(0.01)
+
+    method = Method()
+    rpcPolicy.call_future(Stub(FlowAdd = method), "FlowAdd", None)
+    assert rpcPolicy.breaker.state == CircuitBreaker.HALF_OPEN
+
+    method.futures[0].cancel()
+    assert rpcPolicy.breaker.state == CircuitBreaker.OPEN
+
+    # A new probe is let through after the reset timeout
+    time.sleep(0.01)
+    assert rpcPolicy.breaker.allow()
+
+def test_cancelled_call_is_not_an_answer():
+    rpcPolicy = policy(breaker_failures = 1, breaker_reset = 0.01)
+    rpcPolicy.breaker.record_failure()
+    time.sleep(0.01)
+
+    with pytest.raises(grpc.RpcError):
+        rpcPolicy.call(Stub(FlowAdd = Method(RpcError(grpc.StatusCode.CANCELLED))), "FlowAdd", None)
+    assert rpcPolicy.breaker.state == CircuitBreaker.OPEN
+
+def test_future_outcome_recorded():
+    rpcPolicy = policy(breaker_failures = 1, breaker_reset = 60)
+    method = Method()
+    stub = Stub(FlowAdd = method)
+
+    rpcPolicy.call_future(stub, "FlowAdd", None).set_result("done")
+    assert rpcPolicy.breaker.state == CircuitBreaker.CLOSED
+
+    rpcPolicy.call_future(stub, "FlowAdd", None).set_exception(RpcError(UNAVAILABLE))
+    assert rpcPolicy.breaker.state == CircuitBreaker.OPEN
@@ -0,0 +1,119 @@
+"""
+    Copyright 2023, University of Valladolid.
+    
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+    
+        http://www.apache.org/licenses/LICENSE-2.0
+    
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# System imports
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+# The agent needs the OLT protos (requirements.txt)
+openFlowAgent = pytest.importorskip("openFlowAgent", exc_type = ImportError)
+
+CONTROLLER = {"ip_address": "127.0.0.1", "port": 6653}
+
+class FakeManagedOLT:
+    """ManagedOLT that records the OLTs brought up and removed"""
+
+    started = []
+    removed = []
+
+    def __init__(self, olt, controller, engine, agentLoop = None):
+        self.olt = olt
+        self.controller = controller
+
+    def start(self):
+        self.started.append(self.olt)
+
+    def shutdown(self, workers):
+        self.removed.append(self.olt)
+
+@pytest.fixture
+def managed(monkeypatch):
+    FakeManagedOLT.started = []
+    FakeManagedOLT.removed = []
+    monkeypatch.setattr(openFlowAgent, "ManagedOLT", FakeManagedOLT)
+    monkeypatch.setattr(openFlowAgent, "managedOLTs", {})
+    return FakeManagedOLT
+
+def write_config(path, olts, controller = CONTROLLER):
+    path.write_text(json.dumps({"SDN-controller": controller, "olts": olts}))
+
+def test_reload_skips_bad_entries(tmp_path, managed):
+    path = tmp_path / "agent.config"
+    good = {"ip_address": "10.0.0.1", "port": 9191}
+    write_config(path, [{"ip_address": "10.0.0.2"}, good, {"port": 9191}, "olt"])
+
+    config = openFlowAgent.reload_config(str(path), {"SDN-controller": CONTROLLER}, CONTROLLER, None, None)
+
+    assert managed.started == [good]
+    assert config["olts"][1] == good
+
+def test_reload_keeps_olts_on_error(tmp_path, managed, monkeypatch):
+    path = tmp_path / "agent.config"
+    olt = {"ip_address": "10.0.0.1", "port": 9191}
+    write_config(path, [olt])
+    config = openFlowAgent.reload_config(str(path), {"SDN-controller": CONTROLLER}, CONTROLLER, None, None)
+
+    # Not JSON, "olts" not a list and a failure bringing up an OLT
+    path.write_text("{")
+    assert openFlowAgent.reload_config(str(path), config, CONTROLLER, None, None) is config
+    path.write_text(json.dumps({"SDN-controller": CONTROLLER, "olts": {}}))
+    assert openFlowAgent.reload_config(str(path), config, CONTROLLER, None, None) is config
+
+    def fail(*args):
+        raise RuntimeError("bring-up failed")
+    monkeypatch.setattr(FakeManagedOLT, "start", fail)
+    write_config(path, [olt, {"ip_address": "10.0.0.2", "port": 9191}])
+    openFlowAgent.reload_config(str(path), config, CONTROLLER, None, None)
+
+    assert managed.started == [olt]
+    assert managed.removed == []
+
+def test_controller_change_warned_once(tmp_path, managed, caplog):
+    path = tmp_path / "agent.config"
+    write_config(path, [], controller = {"ip_address": "127.0.0.2", "port": 6653})
+    config = {"SDN-controller": CONTROLLER}
+
+    with caplog.at_level(logging.WARNING):
+        for i in range(3):
+            config = openFlowAgent.reload_config(str(path), config, CONTROLLER, None, None)
+
+    assert len([r for r in caplog.records if "SDN-controller" in r.getMessage()]) == 1
+
+def test_sighup_with_missing_file_does_not_spin(tmp_path, managed, monkeypatch):
+    path = tmp_path / "agent.config"
+    checks = []
+
+    def config_mtime(file_json):
+        checks.append(file_json)
+        return None
+    monkeypatch.setattr(openFlowAgent, "config_mtime", config_mtime)
+
+    reload = threading.Event()
+    config = {"SDN-controller": CONTROLLER, "config_watch_interval": 3600}
+    watcher = threading.Thread(target = openFlowAgent.watch_config, args = (str(path), config, None, None),
+                               kwargs = {"reload": reload}, daemon = True)
+    watcher.start()
+
+    reload.set()
+    time.sleep(0.2)
+
+    # The start and the SIGHUP, then it waits for the next one
+    assert len(checks) == 2
+    assert not reload.is_set()